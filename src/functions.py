@@ -1,14 +1,36 @@
+import hashlib
 import os
+import queue
+import threading
+import time
 import warnings
 
-from itertools import permutations
+from collections import OrderedDict
+from functools import partial
+from itertools import product
 
 import numpy as np
 import nrrd
-import pandas as pd
-import pylidc as pl
-from pylidc.utils import consensus
-from radiomics import featureextractor
+import pydicom
+import radiomics
+from radiomics import featureextractor, getFeatureClasses
+from radiomics import gldm, glrlm, glszm, ngtdm
+
+#The statistical functions are in stability.py, which does not depend on the
+#imaging packages; they are also available from here
+from stability import arrange_ratings, avg_smape, bootstrap_stability, \
+    cached_avg_smape, fingerprint, grade_stability, icc, RunningStatistics, \
+    smape, stability_grades
+from scheduling import estimate_makespan, estimate_task_memory, \
+    FeatureCostModel, run_tasks
+
+#Numba is optional: the JIT-compiled texture matrices are only available if 
+#the package is installed, otherwise the pyradiomics backend is used
+try:
+    import numba
+    _numba_available = True
+except ImportError:
+    _numba_available = False
 
 feature_lut = {'firstorder/Energy' : {'firstorder' : ['Energy']},
                'firstorder/Entropy' : {'firstorder' : ['Entropy']},
@@ -102,36 +124,87 @@ feature_lut = {'firstorder/Energy' : {'firstorder' : ['Energy']},
                'shape/MaxAxialDiameter' : {'shape' : ['Maximum2DDiameterSlice']}
                }
 
-def preprocess_signal(signal_in, window = (-1350, 150), num_levels = 256,
-                      **kwargs):
-    """CT data preprocessing
+#Experimental conditions (other than patient, nodule and annotation) each 
+#feature depends on. Shape features depend on the mask only, therefore they 
+#are computed once per patient, nodule and annotation and the value is shared 
+#by all the combinations of window, num_levels and noise_scale. All the other
+#features depend on the window, on the quantisation levels and on the noise.
+_all_dependencies = ('window', 'num_levels', 'noise_scale')
+_dependencies_by_class = {'shape' : ()}
+for _feature_name, _entry in feature_lut.items():
+    _entry['depends_on'] = _dependencies_by_class.get(
+        _feature_name.split('/', 1)[0], _all_dependencies)
+
+def is_mask_only(feature_name):
+    """Whether the feature depends only on the mask (i.e. is invariant to
+    the number of quantisation levels and to the noise scale).
     
     Parameters
     ----------
-    signal_in : a 3D nparray of int or float 
-        The input CT data. May represent a whole scan or a part of it.
-    window : a list or tuple of float (lower_bound, upper_bound)
+    feature_name : str
+        The feature name. Possible values are the keys in feature_lut dict.
+        
+    Returns
+    -------
+    mask_only : bool
+        True if the feature depends only on the mask, False otherwise.
+    """
+    return len(feature_lut[feature_name]['depends_on']) == 0
+
+class QuantisedSignal():
+    """Quantised signal stored as level indices (uint8 for up to 256 levels,
+    uint16 for up to 65536) together with the window and number of levels 
+    needed for reconstructing the values in Hounsfield Units. Takes 1/8 
+    (1/4) of the memory of the same signal in float64.
+    
+    Attributes
+    ----------
+    levels : 3D nparray of unsigned int
+        The level index of each voxel (0 to num_levels - 1).
+    window : tuple of float (lower_bound, upper_bound)
         The window bounds in Hounsfield Units.
     num_levels : int (> 1)
-        The number of levels used signal image quantisation (resampling).
-    noise_scale : float (> 0.0, optional)
-        Scale of the Gaussian noise to be added to the original signal. The value
-        indicates the spread (standard deviation) of the noise as a percentage of 
-        the spread of the input signal. For instance, use noise_scale = 2.5 to
-        add Gaussian noise sampled from a normal distribution with spread =
-        0.025 that of the original signal.
+        The number of quantisation levels.
+    """
+    
+    def to_hu(self):
+        """The signal in Hounsfield Units (3D nparray of float64), identical 
+        to the output of preprocess_signal()"""
+        window = self.window
+        return (window[1] - window[0])*\
+            (self.levels/(self.num_levels - 1)) + window[0]
+    
+    @property
+    def nbytes(self):
+        return self.levels.nbytes
+    
+    def __init__(self, levels, window, num_levels):
+        self.levels = levels
+        self.window = tuple(window)
+        self.num_levels = num_levels
+
+def quantise_signal(signal_in, window = (-1350, 150), num_levels = 256,
+                    **kwargs):
+    """CT data preprocessing: optional Gaussian noise, windowing and 
+    quantisation into level indices.
+    
+    Parameters
+    ----------
+    signal_in, window, num_levels, noise_scale
+        See preprocess_signal().
      
     Returns
     -------
-    signal_out : a 3D array of int16 (same size as image_in)
+    signal_out : QuantisedSignal
+        The quantised signal (same size as signal_in).
     """
     
     #Convert the input signal to float
-    signal_in = signal_in.astype(np.float)
+    signal_in = signal_in.astype(np.float64)
     
 
     #Add Gaussian noise if required
-    if ('noise_scale' in kwargs.keys()) & (kwargs['noise_scale'] > 0.0):
+    if ('noise_scale' in kwargs.keys()) and (kwargs['noise_scale'] > 0.0):
         noise_scale = kwargs['noise_scale']/100
         
         #Normalise the input signal to zero mean and unit variance
@@ -153,22 +226,394 @@ def preprocess_signal(signal_in, window = (-1350, 150), num_levels = 256,
     normalised_image[normalised_image < 0.0] = 0.0
     normalised_image[normalised_image > 1.0] = 1.0
     
-    #Resample the signal to the number of levels required
-    signal_out = np.round(normalised_image*(num_levels - 1))/((num_levels - 1))
+    #Index of the level of each voxel (smallest unsigned type that fits)
+    levels = np.round(normalised_image*(num_levels - 1)).astype(
+        np.min_scalar_type(num_levels - 1))
+    
+    return QuantisedSignal(levels, window, num_levels)
+
+def preprocess_signal(signal_in, window = (-1350, 150), num_levels = 256,
+                      **kwargs):
+    """CT data preprocessing
+    
+    Parameters
+    ----------
+    signal_in : a 3D nparray of int or float 
+        The input CT data. May represent a whole scan or a part of it.
+    window : a list or tuple of float (lower_bound, upper_bound)
+        The window bounds in Hounsfield Units.
+    num_levels : int (> 1)
+        The number of levels used signal image quantisation (resampling).
+    noise_scale : float (> 0.0, optional)
+        Scale of the Gaussian noise to be added to the original signal. The value
+        indicates the spread (standard deviation) of the noise as a percentage of 
+        the spread of the input signal. For instance, use noise_scale = 2.5 to
+        add Gaussian noise sampled from a normal distribution with spread =
+        0.025 that of the original signal.
+     
+    Returns
+    -------
+    signal_out : a 3D array of float (same size as image_in)
+        The quantised signal in Hounsfield Units. Use quantise_signal() for 
+        the compact representation (level indices).
+    """
+    return quantise_signal(signal_in, window, num_levels, **kwargs).to_hu()
+
+def roi_digest(mask, signal = None, settings = None):
+    """Digest of the content of a ROI, used as key for storing and reusing 
+    the feature values computed on it (identical masks and signals give the 
+    same values regardless of the patient, nodule and annotation they come 
+    from). Only the bounding box of the foreground is hashed, since the 
+    features do not depend on the voxels outside the mask: the same ROI 
+    cropped with different margins (e.g. the 50% consensus, defined on the 
+    union of the bounding boxes of all the annotations, and the annotation 
+    it equals) gives the same digest.
     
-    #Covert back to the original units
-    signal_out = (window[1] - window[0])*signal_out + window[0]
+    Parameters
+    ----------
+    mask : 3D nparray or CompactMask
+        The mask of the ROI.
+    signal : 3D nparray (optional)
+        The preprocessed signal (e.g. the level indices of a 
+        QuantisedSignal), same shape as mask. Not needed for the features 
+        that depend only on the mask (see is_mask_only()).
+    settings : dict (optional)
+        The extraction and preprocessing settings that affect the feature 
+        values (e.g. the bin width, the window and number of levels).
     
-    return signal_out
+    Returns
+    -------
+    digest : str
+        The hexadecimal digest.
+    """
+    if not isinstance(mask, CompactMask):
+        mask = CompactMask(mask)
+    crop = mask.crop()
+    digest = hashlib.blake2b(digest_size = 16)
+    digest.update(repr((radiomics.__version__, crop.shape, 
+                        sorted((settings or {}).items()))).encode())
+    digest.update(np.packbits(crop))
+    if signal is not None:
+        signal = np.ascontiguousarray(signal[mask.bbox])
+        digest.update(signal.dtype.str.encode())
+        digest.update(signal)
+    return digest.hexdigest()
+
+def _sorted_dicom_files(scan):
+    """Paths to the DICOM files of a scan sorted by slice position, i.e. in 
+    the same order as the slices of scan.to_volume(). Only the headers are 
+    read. Follows pylidc's Scan.load_all_dicom_images(): files from other 
+    series/studies are discarded and of the slices sharing the same z 
+    coordinate the one with lower InstanceNumber is kept.
     
+    Parameters
+    ----------
+    scan : pylidc.Scan
+        The scan.
+        
+    Returns
+    -------
+    paths : list of str
+        The paths to the DICOM files, one per slice.
+    """
+    
+    dicom_folder = scan.get_path_to_dicom_files()
+    tags = ['SeriesInstanceUID', 'StudyInstanceUID', 'ImagePositionPatient',
+            'InstanceNumber']
+    
+    #Retain one file per z coordinate (the one with lower instance number)
+    paths_by_z = dict()
+    for fname in os.listdir(dicom_folder):
+        if not fname.endswith('.dcm') or fname.startswith('.'):
+            continue
+        path = os.path.join(dicom_folder, fname)
+        header = pydicom.dcmread(path, stop_before_pixels = True, 
+                                 specific_tags = tags)
+        if str(header.SeriesInstanceUID).strip() != scan.series_instance_uid or\
+           str(header.StudyInstanceUID).strip() != scan.study_instance_uid:
+            continue
+        z = float(header.ImagePositionPatient[-1])
+        instance_number = float(header.InstanceNumber)
+        if (z not in paths_by_z) or (instance_number < paths_by_z[z][0]):
+            paths_by_z[z] = (instance_number, path)
+        
+    return [paths_by_z[z][1] for z in sorted(paths_by_z.keys())]
+
+def load_volume_block(scan, bbox, sorted_dicom_files = None):
+    """Subset of a CT scan enclosed by a bounding box. Only the DICOM slices 
+    within the z-range of the bounding box are decoded. Equivalent to 
+    scan.to_volume()[bbox], but with a fraction of the I/O and memory.
+    
+    Parameters
+    ----------
+    scan : pylidc.Scan
+        The scan.
+    bbox : tuple of three slice
+        The bounding box in voxel coordinates (i, j, k), as returned by 
+        pylidc's Annotation.bbox().
+    sorted_dicom_files : list of str (optional)
+        The paths to the DICOM files sorted by slice position, as returned by
+        _sorted_dicom_files(). Pass these to avoid re-reading the headers when
+        loading multiple blocks from the same scan.
+        
+    Returns
+    -------
+    block : 3D nparray of int16
+        The CT values (HU) within the bounding box.
+    spacing : tuple of float
+        The voxel spacing (mm) along i, j and k.
+    """
+    
+    if sorted_dicom_files is None:
+        sorted_dicom_files = _sorted_dicom_files(scan)
+    
+    slices = list()
+    for path in sorted_dicom_files[bbox[2]]:
+        image = pydicom.dcmread(path)
+        slices.append((image.pixel_array[bbox[0], bbox[1]] * 
+                       image.RescaleSlope + image.RescaleIntercept))
+    block = np.stack(slices, axis = -1).astype(np.int16)
+    spacing = (scan.pixel_spacing, scan.pixel_spacing, scan.slice_spacing)
+    
+    return block, spacing
+
+def _bbox_union(bboxes):
+    """Smallest bounding box (tuple of slice) enclosing all the given ones"""
+    return tuple(slice(min([bbox[d].start for bbox in bboxes]),
+                       max([bbox[d].stop for bbox in bboxes]))
+                 for d in range(3))
+
+class CompactMask():
+    """Boolean mask stored as the bounding box of its foreground plus the 
+    bit-packed content of the bounding box (1 bit per voxel instead of 1 
+    byte; background outside the bounding box takes no space). Used for 
+    keeping the ROIs in memory and sending them to the worker processes.
+    
+    Behaves as a read-only array where a dense one is needed (np.asarray(),
+    astype()); this unpacks the mask into a new array.
+    
+    Attributes
+    ----------
+    shape : tuple of int
+        The shape of the (dense) mask.
+    bbox : tuple of slice
+        The bounding box of the foreground. Empty slices if the mask is 
+        empty.
+    num_voxels : int
+        The number of voxels in the mask.
+    """
+    
+    @property
+    def ndim(self):
+        return len(self.shape)
+    
+    @property
+    def bbox_volume(self):
+        """The number of voxels in the bounding box"""
+        return int(np.prod([b.stop - b.start for b in self.bbox]))
+    
+    @property
+    def nbytes(self):
+        return self._packed.nbytes
+    
+    def crop(self):
+        """Dense boolean mask of the bounding box only"""
+        bbox_shape = tuple(b.stop - b.start for b in self.bbox)
+        return np.unpackbits(self._packed, count = int(np.prod(bbox_shape))
+                             ).reshape(bbox_shape).astype(bool)
+    
+    def astype(self, dtype):
+        """Dense mask with the given data type"""
+        mask = np.zeros(self.shape, dtype = dtype)
+        mask[self.bbox] = self.crop()
+        return mask
+    
+    def __array__(self, dtype = None, copy = None):
+        return self.astype(bool if dtype is None else dtype)
+    
+    def __init__(self, mask):
+        mask = np.asarray(mask, dtype = bool)
+        self.shape = mask.shape
+        bbox = list()
+        for axis in range(mask.ndim):
+            other_axes = tuple(a for a in range(mask.ndim) if a != axis)
+            indices = np.flatnonzero(np.any(mask, axis = other_axes))
+            bbox.append(slice(indices[0], indices[-1] + 1) 
+                        if len(indices) > 0 else slice(0, 0))
+        self.bbox = tuple(bbox)
+        self.num_voxels = int(np.count_nonzero(mask))
+        self._packed = np.packbits(mask[self.bbox], axis = None)
+
+def _query_scan(patient_id):
+    """The pylidc scan of the given patient"""
+    
+    #Imported here since pylidc (and the database engine behind it) are slow
+    #to import and only needed for loading the scans
+    import pylidc as pl
+    return pl.query(pl.Scan).filter(pl.Scan.patient_id == patient_id).first()
+
+def _nodule_masks(scan):
+    """Masks and bounding boxes of the annotations of each nodule of a scan 
+    (computed from the contours, the DICOM files are not read), as
+    OrderedDict[nodule_id][annotation_id] = (mask, bbox). Annotation ids are
+    the indices of the annotations within each nodule plus -1 for the 50% 
+    consensus annotation."""
+    from pylidc.utils import consensus
+    
+    #Get all the nodules within this scan
+    nodules = scan.cluster_annotations(verbose = False)
+    
+    masks = OrderedDict()
+    for nodule_id, nodule in enumerate(nodules):
+        
+        #Get the masks and bounding boxes of the annotations
+        masks_and_bboxes = OrderedDict()
+        for annotation_id, annotation in enumerate(nodule):
+            masks_and_bboxes[annotation_id] = (
+                CompactMask(annotation.boolean_mask()), annotation.bbox())
+        
+        #Add the 50% consensus annotation
+        mask, bbox, _ = consensus(nodule, clevel=0.5)
+        masks_and_bboxes[-1] = (CompactMask(mask), bbox)
+        masks[nodule_id] = masks_and_bboxes
+    return masks
+
+def nodule_roi_sizes(patient_id):
+    """Sizes (see roi_size()) of the ROIs of all the nodules and annotations 
+    of a scan. Only the annotation contours are used, the scan is not 
+    loaded.
+    
+    Parameters
+    ----------
+    patient_id : str
+        The patient id.
+        
+    Returns
+    -------
+    sizes : OrderedDict
+        sizes[(nodule_id, annotation_id)] is a tuple (num_voxels, 
+        bbox_volume), with the same ids as load_nodule_rois().
+    """
+    sizes = OrderedDict()
+    for nodule_id, masks_and_bboxes in \
+        _nodule_masks(_query_scan(patient_id)).items():
+        for annotation_id, (mask, _) in masks_and_bboxes.items():
+            sizes[(nodule_id, annotation_id)] = roi_size(mask)
+    return sizes
+
+def load_nodule_rois(patient_id):
+    """Signals and masks of all the nodules and annotations of a scan.
+    
+    Parameters
+    ----------
+    patient_id : str
+        The patient id.
+        
+    Returns
+    -------
+    rois : OrderedDict of OrderedDict
+        rois[nodule_id][annotation_id] is a tuple (signal, mask) where signal
+        is the subset of the scan (original CT values) enclosed by the 
+        bounding box of the annotation and mask the corresponding boolean 
+        mask (CompactMask). Annotation ids are the indices of the annotations within each 
+        nodule plus -1 for the 50% consensus annotation.
+    """
+    
+    #Get the scan corresponding to the given patient_id
+    scan = _query_scan(patient_id)
+    
+    #Sort the slices once (headers only)
+    sorted_dicom_files = _sorted_dicom_files(scan)
+    
+    rois = OrderedDict()
+    for nodule_id, masks_and_bboxes in _nodule_masks(scan).items():
+        
+        #Only load the part of the scan enclosing all the annotations
+        union = _bbox_union([bbox for _, bbox in masks_and_bboxes.values()])
+        block, _ = load_volume_block(scan, union, sorted_dicom_files)
+        
+        rois[nodule_id] = OrderedDict()
+        for annotation_id, (mask, bbox) in masks_and_bboxes.items():
+            bbox_in_block = tuple(slice(bbox[d].start - union[d].start, 
+                                        bbox[d].stop - union[d].start)
+                                  for d in range(3))
+            rois[nodule_id][annotation_id] = (block[bbox_in_block], mask)
+    
+    return rois
+
+class ROIPrefetcher():
+    """Loads the nodule ROIs (see load_nodule_rois()) of a sequence of scans
+    in a background thread, so that DICOM decoding of the next scans overlaps
+    with the feature computation on the current one. Iterate over the 
+    instance to get tuples (patient_id, rois) in the same order as the 
+    patient ids given."""
+    
+    #Marks the end of the sequence in the queue
+    _end_of_sequence = object()
+    
+    def __init__(self, patient_ids, queue_depth = 1):
+        """
+        Parameters
+        ----------
+        patient_ids : iterable of str
+            The patient ids of the scans to load.
+        queue_depth : int (> 0)
+            The maximum number of scans loaded in advance. Bounds the memory 
+            used by the prefetcher.
+        """
+        self._patient_ids = list(patient_ids)
+        self._queue = queue.Queue(maxsize = queue_depth)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target = self._produce, daemon = True)
+        self._thread.start()
+        
+    def _put(self, item):
+        """Puts one item into the queue unless the prefetcher is stopped.
+        Returns False if stopped."""
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout = 0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+        
+    def _produce(self):
+        try:
+            for patient_id in self._patient_ids:
+                if not self._put((patient_id, load_nodule_rois(patient_id))):
+                    return
+        except Exception as exception:
+            #Forward the exception to the consumer
+            self._put(exception)
+            return
+        self._put(self.__class__._end_of_sequence)
+        
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is self.__class__._end_of_sequence:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+            
+    def close(self):
+        """Stops the background thread"""
+        self._stop.set()
+        self._thread.join()
+
 def get_feature_values(feature_names, patient_id, nodule_id, annotation_id, 
                        db_driver, window, num_levels, noise_scale, path_to_image, 
-                       path_to_mask, verbose=False):
+                       path_to_mask, backend = 'pyradiomics', roi = None, 
+                       verbose=False, class_seconds = None, records = None):
     """Value of a set of radiomic features for a given patient and nodule id. 
     The function parses the csv_cache first to check if all the requested 
     feature values are already there; if so reads the values and returns them, 
     otherwise computes the missing values, updates the cache and returns all
-    the requested values.
+    the requested values. Values computed on a ROI with the same content 
+    (mask, preprocessed signal and settings - see roi_digest()) are reused 
+    instead of being computed again.
     
     Parameters
     ----------
@@ -200,8 +645,24 @@ def get_feature_values(feature_names, patient_id, nodule_id, annotation_id,
     path_to_mask : str
         Path to the temporary file where the mask is to be stored. Needs to 
         be an .nrrd file.
+    backend : str
+        The backend used for computing the texture matrices. Can be 
+        'pyradiomics' or 'numba' (see compute_feature_values()).
+    roi : tuple (signal, mask) of 3D nparrays (optional)
+        The signal (original CT values) and the mask of the nodule, as 
+        returned by load_nodule_rois(). If not given these are loaded from
+        the scan when any of the features needs to be computed.
     verbose : bool
         Print details about the features being computed.
+    class_seconds : dict (optional)
+        If given, the time spent on each feature class (seconds) is added to
+        the corresponding entry (see compute_feature_values()).
+    records : list (optional)
+        If given, the values to be stored in the database (computed, reused 
+        or copied from other conditions) are appended to it as records for
+        DBDriver.write_feature_values() instead of being written, e.g. for 
+        writing them from another process. Otherwise these are written to
+        db_driver in one transaction.
     
     Returns
     -------
@@ -211,14 +672,37 @@ def get_feature_values(feature_names, patient_id, nodule_id, annotation_id,
     
     feature_names_and_values = dict()
     
+    #Values to be stored (written together at the end)
+    write_records = records is None
+    if write_records:
+        records = list()
+    
     #Read from the database the values of the features that have already been 
     #computed
     for feature_name in feature_names:
         feature_value = db_driver.read_feature_value(
             patient_id, nodule_id, annotation_id, num_levels, noise_scale, 
-            feature_name)
+            feature_name, window = window)
+        
+        #Features that do not depend on the window, on the number of levels 
+        #and/or on the noise scale can be resolved from any other condition 
+        #of the same patient, nodule and annotation. Store (fan out) the 
+        #value found so that the row for this condition is complete. For the
+        #other features this would repeat the query above.
+        depends_on = feature_lut[feature_name]['depends_on']
+        if (feature_value is None) and \
+           (set(depends_on) != set(_all_dependencies)):
+            feature_value = db_driver.resolve_feature_value(
+                patient_id, nodule_id, annotation_id, feature_name, 
+                num_levels = num_levels if 'num_levels' in depends_on else None,
+                noise_scale = noise_scale if 'noise_scale' in depends_on else None,
+                window = window if 'window' in depends_on else None)
+            if feature_value is not None:
+                records.append((patient_id, nodule_id, annotation_id, 
+                                num_levels, noise_scale, feature_name, 
+                                feature_value))
 
-        if feature_value:
+        if feature_value is not None:
             feature_names_and_values.update({feature_name : feature_value})
     
     if verbose:
@@ -243,48 +727,70 @@ def get_feature_values(feature_names, patient_id, nodule_id, annotation_id,
                 f'feature_names : {names_of_features_to_compute}'        
             print(f'Computing {record_str}')
     
-        #Get the scan corresponding to the given patient_id
-        scan = pl.query(pl.Scan).filter(pl.Scan.patient_id == patient_id).first()
-    
-        #Get the CT scan as a voxel model
-        voxel_model = scan.to_volume()    
+        #Get the signal and the mask of the nodule, load them from the scan
+        #if not given
+        if roi is None:
+            roi = load_nodule_rois(patient_id)[nodule_id][annotation_id]
+        signal, roi_mask = roi
+        mask = roi_mask.astype(np.uint8)
+        
+        #Preprocess the signal (level indices, the values in Hounsfield 
+        #Units are only reconstructed for pyradiomics)
+        signal = quantise_signal(signal_in = signal, 
+                                 window = window, 
+                                 num_levels = num_levels,
+                                 noise_scale = noise_scale)        
     
-        #Get the requested nodule within this scan
-        nodules = scan.cluster_annotations() 
-        nodule = nodules[nodule_id]
+        #Reuse the values computed on ROIs with the same content (e.g. 
+        #identical annotations from different readers). The signal features 
+        #of noisy signals are not stored, since these are never the same.
+        bin_width = (window[1] - window[0])/num_levels
+        if not isinstance(roi_mask, CompactMask):
+            roi_mask = CompactMask(mask)
+        digests = {True : roi_digest(roi_mask)}
+        if noise_scale == 0.0:
+            digests[False] = roi_digest(
+                roi_mask, signal.levels, {'bin_width' : bin_width, 
+                                      'window' : signal.window, 
+                                      'num_levels' : num_levels})
+        for mask_only, digest in digests.items():
+            stored_values = db_driver.read_roi_results(
+                digest, [f for f in names_of_features_to_compute 
+                         if is_mask_only(f) == mask_only])
+            for feature_name, feature_value in stored_values.items():
+                feature_names_and_values.update({feature_name : feature_value})
+                records.append((patient_id, nodule_id, annotation_id, 
+                                num_levels, noise_scale, feature_name, 
+                                feature_value))
+        names_of_features_to_compute = names_of_features_to_compute.\
+            difference(set(feature_names_and_values.keys()))
     
-        #Get the requested annotation (nodule mask) and the corresponding signal
-        if annotation_id == -1:
-            #Get the 50% consensus annotation
-            mask, bbox, _ = consensus(nodule, clevel=0.5)        
-        else:
-            annotation = nodule[annotation_id]
-            bbox = annotation.bbox()
-            mask = annotation.boolean_mask() 
-        mask = mask.astype(np.uint8)
-        signal = voxel_model[bbox]
-        
-        #Preprocess the signal
-        signal = preprocess_signal(signal_in = signal, 
-                                   window = window, 
-                                   num_levels = num_levels,
-                                   noise_scale = noise_scale)        
+    if len(names_of_features_to_compute) > 0:
     
         #Store the signal and mask as temporary files
-        nrrd.write(path_to_image, signal)  
+        nrrd.write(path_to_image, signal.to_hu())  
         nrrd.write(path_to_mask, mask)     
     
         #Compute the feature values and update the database
+        names_of_features_to_compute = list(names_of_features_to_compute)
         values_of_features_to_compute = compute_feature_values(
             names_of_features_to_compute, path_to_image, path_to_mask,
-            bin_width = (window[1] - window[0])/num_levels)
+            bin_width = bin_width, backend = backend, 
+            class_seconds = class_seconds)
         for f, name_of_features_to_compute in enumerate(names_of_features_to_compute):
             feature_names_and_values.update({name_of_features_to_compute :
                                              values_of_features_to_compute[f]})
-            db_driver.write_feature_value(patient_id, nodule_id, annotation_id, 
-                                          num_levels, noise_scale, 
-                                          name_of_features_to_compute, 
-                                          values_of_features_to_compute[f])             
+            records.append((patient_id, nodule_id, annotation_id, num_levels, 
+                            noise_scale, name_of_features_to_compute, 
+                            values_of_features_to_compute[f]))
+        for mask_only, digest in digests.items():
+            db_driver.write_roi_results(digest, {
+                f : feature_names_and_values[f] 
+                for f in names_of_features_to_compute 
+                if is_mask_only(f) == mask_only})
+    
+    if write_records and (len(records) > 0):
+        db_driver.write_feature_values(records, window = window)
     
     #Arrange the requested features in the correct order
     feature_values = list()
@@ -294,8 +800,326 @@ def get_feature_values(feature_names, patient_id, nodule_id, annotation_id,
     return feature_values
     
     
+def roi_size(mask):
+    """Size of a ROI, used for estimating the cost of computing its features 
+    (see scheduling.TaskCostModel).
+    
+    Parameters
+    ----------
+    mask : 3D nparray or CompactMask
+        The mask of the ROI.
+    
+    Returns
+    -------
+    num_voxels : int
+        The number of voxels in the mask.
+    bbox_volume : int
+        The number of voxels in the bounding box of the mask.
+    """
+    if isinstance(mask, CompactMask):
+        return mask.num_voxels, mask.bbox_volume
+    num_voxels = int(np.count_nonzero(mask))
+    bbox_volume = 1
+    for axis in range(mask.ndim):
+        other_axes = tuple(a for a in range(mask.ndim) if a != axis)
+        indices = np.flatnonzero(np.any(mask, axis = other_axes))
+        bbox_volume *= (indices[-1] - indices[0] + 1) if len(indices) > 0 \
+            else 0
+    return num_voxels, int(bbox_volume)
+
+def plan_extraction(patient_ids, feature_names, windows, num_levelss, 
+                    noise_scales, db_driver, cost_model, num_workers, 
+                    lookahead = 256):
+    """Estimates the resources needed for computing the features still 
+    missing from the database (dry run: nothing is computed). The ROI sizes
+    are read from the database if cached, otherwise computed from the 
+    annotation contours (without loading the scans) and cached.
+    
+    Parameters
+    ----------
+    patient_ids : list of str
+        The patients (scans) to process.
+    feature_names : list of str
+        The features to compute.
+    windows : list of tuple of float (lower_bound, upper_bound)
+        The window bounds in Hounsfield Units.
+    num_levelss : list of int
+        The numbers of quantisation levels.
+    noise_scales : list of float
+        The noise scales.
+    db_driver : DBDriver
+        The feature database. None if this does not exist yet (all the 
+        features are missing).
+    cost_model : scheduling.FeatureCostModel
+        The cost model.
+    num_workers : int (> 0)
+        The number of worker processes.
+    lookahead : int (> 0)
+        The number of tasks scheduled together (see scheduling.run_tasks()).
+    
+    Returns
+    -------
+    plan : OrderedDict
+        The estimates: number of tasks; CPU time by feature class and total 
+        (seconds); wall time for num_workers workers (seconds); growth of the
+        database file (bytes) and peak memory (bytes).
+    """
+    #Features with no column in the database are missing everywhere
+    stored_features = list()
+    if db_driver is not None:
+        columns = set(db_driver.get_feature_names())
+        stored_features = [f for f in feature_names if f in columns]
+    
+    costs = list()
+    seconds_by_class = OrderedDict()
+    roi_bytes = list()
+    task_bytes = 0
+    num_new_rows = 0
+    num_new_values = 0
+    for patient_id in patient_ids:
+        
+        #Get the ROI sizes (cached if available)
+        sizes = OrderedDict()
+        if db_driver is not None:
+            sizes = db_driver.get_roi_sizes(patient_id)
+        if len(sizes) == 0:
+            sizes = nodule_roi_sizes(patient_id)
+            if db_driver is not None:
+                db_driver.write_roi_sizes(patient_id, sizes)
+        
+        for (nodule_id, annotation_id), (num_voxels, bbox_volume) in \
+            sizes.items():
+            roi_bytes.append(3 * bbox_volume)
+            for window, num_levels, noise_scale in product(
+                windows, num_levelss, noise_scales):
+                missing_features = [f for f in feature_names 
+                                    if f not in stored_features]
+                num_missing_stored = len(stored_features)
+                if len(stored_features) > 0:
+                    missing_stored = db_driver.get_missing_features(
+                        patient_id, nodule_id, annotation_id, num_levels,
+                        noise_scale, stored_features, window = window)
+                    missing_features += missing_stored
+                    num_missing_stored = len(missing_stored)
+                if len(missing_features) == 0:
+                    continue
+                if num_missing_stored == len(stored_features):
+                    num_new_rows += 1
+                num_new_values += len(missing_features)
+                
+                feature_classes = sorted(set(
+                    [f.split('/', 1)[0] for f in missing_features]))
+                estimates = cost_model.estimate_by_class(
+                    num_voxels, bbox_volume, num_levels, feature_classes)
+                for class_name, seconds in estimates.items():
+                    seconds_by_class[class_name] = \
+                        seconds_by_class.get(class_name, 0.0) + seconds
+                costs.append(sum(estimates.values()))
+                task_bytes = max(task_bytes, estimate_task_memory(
+                    num_voxels, bbox_volume, num_levels))
+    
+    #Database growth: 9 bytes for each value (type and payload) plus the key
+    #columns and the record header of each new row (approximate)
+    num_columns = len(set(feature_names).union(stored_features)) + 7
+    db_bytes = 9 * num_new_values + num_new_rows * (40 + num_columns)
+    
+    #Peak memory: the ROIs of the tasks scheduled together (at most lookahead
+    #ROIs, the largest ones as an upper bound) plus one task per worker
+    largest_rois = sorted(roi_bytes, reverse = True)[:lookahead]
+    memory_bytes = sum(largest_rois) + num_workers * task_bytes
+    
+    plan = OrderedDict()
+    plan['num_tasks'] = len(costs)
+    plan['cpu_seconds_by_class'] = seconds_by_class
+    plan['cpu_seconds'] = sum(costs)
+    plan['wall_seconds'] = estimate_makespan(costs, num_workers)
+    plan['db_growth_bytes'] = db_bytes
+    plan['peak_memory_bytes'] = memory_bytes
+    return plan
+
+def extract_task(task, db_driver, path_to_image, path_to_mask, 
+                 backend = 'pyradiomics'):
+    """Computes the features of one extraction task (see 
+    get_feature_values()). Can run in multiple processes concurrently: the 
+    process id is appended to the names of the temporary files. The feature
+    values are returned for storing and not written to the database.
+    
+    Parameters
+    ----------
+    task : tuple
+        The task as (patient_id, nodule_id, annotation_id, num_levels, 
+        noise_scale, window, feature_names, roi), where window is a tuple of
+        float (lower_bound, upper_bound) in Hounsfield Units.
+    db_driver : DBDriver
+        The database where the values are read from (the results shared
+        by ROIs with the same content are also stored here).
+    path_to_image, path_to_mask : str
+        Paths to the temporary files (.nrrd).
+    backend : str
+        The backend used for computing the texture matrices (see 
+        compute_feature_values()).
+    
+    Returns
+    -------
+    feature_values : list of float
+        The values of the features of the task.
+    class_seconds : dict
+        The time spent on each feature class (seconds).
+    records : list of tuple
+        The values to be stored in the database, as records for 
+        DBDriver.write_feature_values() with the window of the task.
+    """
+    patient_id, nodule_id, annotation_id, num_levels, noise_scale, window, \
+        feature_names, roi = task
+    
+    suffix = f'_{os.getpid()}'
+    path_to_image = suffix.join(os.path.splitext(path_to_image))
+    path_to_mask = suffix.join(os.path.splitext(path_to_mask))
+    
+    class_seconds = dict()
+    records = list()
+    feature_values = get_feature_values(
+        feature_names = feature_names, patient_id = patient_id, 
+        nodule_id = nodule_id, annotation_id = annotation_id, 
+        db_driver = db_driver, window = window, num_levels = num_levels, 
+        noise_scale = noise_scale, path_to_image = path_to_image, 
+        path_to_mask = path_to_mask, backend = backend, roi = roi, 
+        class_seconds = class_seconds, records = records)
+    return feature_values, class_seconds, records
+
+def _task_cost_predictors(task):
+    """Predictors of the cost of an extraction task (see 
+    scheduling.FeatureCostModel). The size of the ROI is unknown (taken as 
+    one voxel) if the ROI is not part of the task."""
+    _, _, _, num_levels, _, _, feature_names, roi = task
+    num_voxels, bbox_volume = (1, 1) if roi is None else roi_size(roi[1])
+    feature_classes = tuple(sorted(set(
+        [f.split('/', 1)[0] for f in feature_names])))
+    return num_voxels, bbox_volume, num_levels, feature_classes
+
+def iter_feature_values(tasks, db_driver, path_to_image, path_to_mask, 
+                        backend = 'pyradiomics', 
+                        num_workers = 1, cost_model = None, lookahead = 256,
+                        workers_db_driver = None):
+    """Computes and stores the features of a sequence of extraction tasks 
+    (see extract_task()), yielding the values as soon as each task is 
+    completed. The values are written to db_driver by the calling process. The tasks are consumed lazily and at most lookahead of them
+    are in memory at any time (see scheduling.run_tasks()).
+    
+    Parameters
+    ----------
+    tasks : iterable of tuple
+        The tasks as (patient_id, nodule_id, annotation_id, num_levels, 
+        noise_scale, window, feature_names, roi) - see extract_task(). Tasks
+        of the same ROI can share the roi object (e.g. in a window sweep).
+    db_driver : DBDriver
+        The database where the values are stored.
+    path_to_image, path_to_mask, backend
+        See extract_task().
+    workers_db_driver : DBDriver (optional)
+        The database the tasks read from (see extract_task()), e.g. a 
+        synchronous driver on the same file when db_driver is a 
+        WriteBehindDBDriver. Copied into each worker process if more than 
+        one. Defaults to db_driver.
+    num_workers : int (> 0)
+        The number of worker processes. With 1 the tasks are run in the
+        calling process, in the given order; otherwise they are scheduled by
+        estimated cost and yielded in order of completion.
+    cost_model : scheduling.FeatureCostModel (optional)
+        The cost model used for scheduling the tasks, updated with the 
+        measured times. A new one is used if not given.
+    lookahead : int (> 0)
+        Number of tasks read in advance and scheduled together.
+    
+    Yields
+    ------
+    condition : tuple
+        The experimental condition as (patient_id, nodule_id, annotation_id,
+        num_levels, noise_scale, window).
+    feature_name : str
+        The name of the feature.
+    feature_value : float
+        The value of the feature.
+    seconds : float
+        The time needed for the task the value comes from.
+    """
+    if cost_model is None:
+        cost_model = FeatureCostModel()
+    
+    if workers_db_driver is None:
+        workers_db_driver = db_driver
+    
+    run_task = partial(extract_task, db_driver = workers_db_driver, 
+                       path_to_image = path_to_image, 
+                       path_to_mask = path_to_mask, backend = backend)
+    completed_tasks = run_tasks(
+        ((task, _task_cost_predictors(task)) for task in tasks), run_task, 
+        num_workers, cost_model, lookahead = lookahead, 
+        class_seconds = lambda result: result[1])
+    try:
+        for task, (feature_values, _, records), seconds in completed_tasks:
+            if len(records) > 0:
+                db_driver.write_feature_values(records, window = task[5])
+            condition = tuple(task[:6])
+            for feature_name, feature_value in zip(task[6], feature_values):
+                yield condition, feature_name, feature_value, seconds
+    finally:
+        completed_tasks.close()
+
+class TimedFeatureExtractor(featureextractor.RadiomicsFeatureExtractor):
+    """Feature extractor that records the time spent on each feature class 
+    (attribute class_seconds). The feature classes in replacement_classes
+    are used instead of the pyradiomics ones with the same name."""
+    
+    replacement_classes = dict()
+    
+    def computeShape(self, image, mask, boundingBox, **kwargs):
+        start = time.perf_counter()
+        feature_vector = super().computeShape(image, mask, boundingBox, 
+                                              **kwargs)
+        self.class_seconds['shape'] = self.class_seconds.get('shape', 0.0) +\
+            time.perf_counter() - start
+        return feature_vector
+    
+    def computeFeatures(self, image, mask, imageTypeName, **kwargs):
+        feature_vector = OrderedDict()
+        feature_classes = getFeatureClasses()
+        
+        #Texture matrices shared among the feature classes of this ROI
+        shared_matrices = dict()
+        
+        for class_name, feature_names in self.enabledFeatures.items():
+            #Shape features are computed separately (see pyradiomics)
+            if class_name.startswith('shape'):
+                continue
+            if class_name not in feature_classes:
+                continue
+            
+            start = time.perf_counter()
+            feature_class = self.replacement_classes.get(
+                class_name, feature_classes[class_name])(image, mask, 
+                                                         **kwargs)
+            if isinstance(feature_class, _NumbaTextureMatrices):
+                feature_class.shared_matrices = shared_matrices
+            if feature_names is not None:
+                for feature_name in feature_names:
+                    feature_class.enableFeatureByName(feature_name)
+            for feature_name, feature_value in feature_class.execute().items():
+                feature_vector[f'{imageTypeName}_{class_name}_{feature_name}'] =\
+                    feature_value
+            self.class_seconds[class_name] = \
+                self.class_seconds.get(class_name, 0.0) +\
+                time.perf_counter() - start
+                
+        return feature_vector
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.class_seconds = dict()
+
 def compute_feature_values(feature_names, path_to_image, path_to_mask, 
-                           bin_width = 1):
+                           bin_width = 1, backend = 'pyradiomics', 
+                           class_seconds = None):
     """Compute a set of radiomic features
     
     Parameters
@@ -310,6 +1134,16 @@ def compute_feature_values(feature_names, path_to_image, path_to_mask,
     bin_width : float
         A positive value representing the size of the bins when making a 
         histogram and for discretization of the image gray level. 
+    backend : str
+        The backend used for computing the GLRLM, GLSZM, GLDM and NGTDM 
+        matrices. Can be 'pyradiomics' (C extension shipped with pyradiomics)
+        or 'numba' (JIT-compiled kernels defined in this module). If 'numba'
+        is requested but Numba is not installed the pyradiomics backend is 
+        used instead. The feature formulae are those of pyradiomics in both 
+        cases.
+    class_seconds : dict (optional)
+        If given, the time spent on each feature class (seconds) is added to
+        the corresponding entry.
         
     Returns
     -------
@@ -326,7 +1160,17 @@ def compute_feature_values(feature_names, path_to_image, path_to_mask,
     
     #Instantiate the feature extractor
     settings = {'binWidth' : bin_width}
-    extractor = featureextractor.RadiomicsFeatureExtractor(**settings)
+    if backend == 'numba':
+        if _numba_available:
+            extractor = NumbaFeatureExtractor(**settings)
+        else:
+            warnings.warn('Numba not installed, falling back to the '
+                          'pyradiomics backend')
+            extractor = TimedFeatureExtractor(**settings)
+    elif backend == 'pyradiomics':
+        extractor = TimedFeatureExtractor(**settings)
+    else:
+        raise Exception(f'Backend {backend} not supported')
     
     #Enable the extraction of the feature requested
     extractor.disableAllFeatures() 
@@ -345,119 +1189,431 @@ def compute_feature_values(feature_names, path_to_image, path_to_mask,
     #Retrieve the feature value from the results dictionary
     internal_feature_name = str()
     for feature_name in feature_names:
-        for key, value in feature_lut[feature_name].items():
-            internal_feature_name = key + '_' + value[0]
-            for result_name, result_value in results.items():
-                tail = result_name.split('_', 1)[1]
-                if internal_feature_name == tail:
-                    feature_values.append(result_value.tolist())
-                    break
+        class_ = feature_name.split('/', 1)[0]
+        internal_feature_name = class_ + '_' + feature_lut[feature_name][class_][0]
+        for result_name, result_value in results.items():
+            tail = result_name.split('_', 1)[1]
+            if internal_feature_name == tail:
+                feature_values.append(result_value.tolist())
+                break
+    
+    if class_seconds is not None:
+        for class_name, seconds in extractor.class_seconds.items():
+            class_seconds[class_name] = class_seconds.get(class_name, 0.0) +\
+                seconds
     
     #Deinstantiate the extractor explictly 
     del extractor
     
     return feature_values
 
-def grade_stability(avg_smape):
-    """Qualitative label for the average symmetric mean absolute percentage 
-    error (SMAPE).
+def noise_replicate_statistics(feature_names, roi, window, num_levels, 
+                               noise_scale, num_replicates, path_to_image, 
+                               path_to_mask, backend = 'pyradiomics', 
+                               seed = None):
+    """Statistics of a set of radiomic features over repeated additions of 
+    Gaussian noise to the same ROI. The replicates are not stored: each is 
+    accumulated into the running statistics as soon as it is computed.
     
     Parameters
     ----------
-    avg_smape : float (> 0)
-        The average absolute relative difference.
+    feature_names : list of str
+        The names of the features to be computed. Possible values are the keys
+        in feature_lut dict.
+    roi : tuple (signal, mask) of 3D nparrays
+        The signal (original CT values) and the mask of the nodule, as 
+        returned by load_nodule_rois().
+    window : a list or tuple of float (lower_bound, upper_bound)
+        The window bounds in Hounsfield Units.
+    num_levels : int (> 1)
+        The number of levels used signal image quantisation (resampling).
+    noise_scale : float (> 0.0)
+        Scale of the Gaussian noise (see preprocess_signal()).
+    num_replicates : int (> 1)
+        The number of noise replicates.
+    path_to_image : str
+        Path to the temporary file where the signal is to be stored. Needs to 
+        be an .nrrd file.
+    path_to_mask : str
+        Path to the temporary file where the mask is to be stored. Needs to 
+        be an .nrrd file.
+    backend : str
+        The backend used for computing the texture matrices (see 
+        compute_feature_values()).
+    seed : int (optional)
+        Seed of the random generator used by preprocess_signal() (for 
+        reproducible results).
     
     Returns
     -------
-    qualitative_label : str
-        The qualitative label for the given average SMAPE. Can be: 'poor', 
-        'moderate', 'good' or 'excellent'
+    statistics : RunningStatistics
+        The statistics of the features (same order as feature_names).
     """
     
-    qualitative_label = None
+    if seed is not None:
+        np.random.seed(seed)
     
-    if avg_smape <= 5.0:
-        qualitative_label = 'excellent' 
-    elif avg_smape <= 10.0:
-        qualitative_label = 'good' 
-    elif avg_smape <= 20.0:
-        qualitative_label = 'moderate'
-    else:
-        qualitative_label = 'poor'
+    signal, mask = roi
+    nrrd.write(path_to_mask, mask.astype(np.uint8))
+    
+    statistics = RunningStatistics(len(feature_names))
+    for _ in range(num_replicates):
+        noisy_signal = quantise_signal(signal_in = signal, 
+                                       window = window, 
+                                       num_levels = num_levels,
+                                       noise_scale = noise_scale)
+        nrrd.write(path_to_image, noisy_signal.to_hu())
+        statistics.update(compute_feature_values(
+            feature_names, path_to_image, path_to_mask,
+            bin_width = (window[1] - window[0])/num_levels, 
+            backend = backend))
+    return statistics
     
-    return qualitative_label
+#*******************************************************************************
+#******************** Numba backend for the texture matrices *******************
+#*******************************************************************************
+def _jit(func):
+    """Compiles the given function with Numba if this is available, returns
+    the function unchanged otherwise."""
+    if _numba_available:
+        return numba.njit(cache = True)(func)
+    return func
 
-def smape(a, f):
-    """Symmetric mean absolute percentage error (SMAPE). Based on the formula
-    on page 406 of [1], but with the factor '2' at the denominator removed
-    so as to have results bounded in [0,100].
+def _texture_angles(size, distances = (1,), bidirectional = True):
+    """Offsets defining the neighbourhood of a voxel. The order of generation
+    is the same as in the pyradiomics C extension.
     
     Parameters
     ----------
-    a : iterable of numerics
-        The actual (target) values.
-    f : iterable of numerics
-        The forecasted (predicted) values.
-    NOTE: a and f must have the same length.
+    size : tuple of int
+        The size of the (cropped) image. Offsets that are larger than the size
+        in any dimension are discarded.
+    distances : iterable of int (> 0)
+        The distances (infinity norm) at which the offsets are generated.
+    bidirectional : bool
+        If False only one of each pair of opposite offsets is returned.
         
     Returns
     -------
-    smape_value : float
-        The error value.
-        
-    References
-    ----------
-    Goodwin, P., Lawton, R. On the asymmetry of the symmetric MAPE (1999) 
-    International Journal of Forecasting, 15 (4), pp. 405-408.
+    angles : 2D nparray of int (Na x Nd)
+        The offsets, one per row.
     """
+    max_distance = max(distances)
+    offsets = range(max_distance, -max_distance - 1, -1)
+    angles = list()
+    for angle in product(offsets, repeat = len(size)):
+        if any([abs(o) >= s for o, s in zip(angle, size)]):
+            continue
+        if max([abs(o) for o in angle]) in distances:
+            angles.append(angle)
+    if not bidirectional:
+        angles = angles[:len(angles)//2]
+    return np.array(angles, dtype = np.int64).reshape(-1, len(size))
+
+@_jit
+def _glrlm_kernel(image, mask, angles, Ng, Nr):
+    """Gray level run length matrix (Ng x Nr x Na) of a 3D image"""
+    s0, s1, s2 = image.shape
+    Na = angles.shape[0]
+    P = np.zeros((Ng, Nr, Na))
+    for a in range(Na):
+        d0, d1, d2 = angles[a, 0], angles[a, 1], angles[a, 2]
+        multi_element = False
+        for i0 in range(s0):
+            for i1 in range(s1):
+                for i2 in range(s2):
+                    #Runs start where the previous voxel along the angle falls
+                    #outside the image
+                    p0, p1, p2 = i0 - d0, i1 - d1, i2 - d2
+                    if (0 <= p0 < s0) and (0 <= p1 < s1) and (0 <= p2 < s2):
+                        continue
+                    j0, j1, j2 = i0, i1, i2
+                    gl, rl, elements = -1, 0, 0
+                    while (0 <= j0 < s0) and (0 <= j1 < s1) and (0 <= j2 < s2):
+                        if mask[j0, j1, j2]:
+                            elements += 1
+                            if gl == -1:
+                                gl = image[j0, j1, j2]
+                            elif image[j0, j1, j2] == gl:
+                                rl += 1
+                            else:
+                                P[gl - 1, rl, a] += 1
+                                gl = image[j0, j1, j2]
+                                rl = 0
+                        elif gl > -1:
+                            P[gl - 1, rl, a] += 1
+                            gl, rl = -1, 0
+                        j0, j1, j2 = j0 + d0, j1 + d1, j2 + d2
+                    if gl > -1:
+                        P[gl - 1, rl, a] += 1
+                    if elements > 1:
+                        multi_element = True
+                        
+        #The segmentation is 2D for this angle: discard the angle
+        if not multi_element:
+            P[:, 0, a] = 0
+    return P
+
+@_jit
+def _glszm_kernel(image, mask, angles, Ng):
+    """Gray level size zone matrix (Ng x max zone size) of a 3D image. Zones 
+    are the connected components (under the given neighbourhood) of voxels 
+    having the same gray level."""
+    s0, s1, s2 = image.shape
+    Na = angles.shape[0]
+    to_process = mask.copy()
+    stack = np.empty((mask.sum(), 3), dtype = np.int64)
+    zone_levels = np.empty(mask.sum(), dtype = np.int64)
+    zone_sizes = np.empty(mask.sum(), dtype = np.int64)
+    num_zones = 0
+    max_size = 1
+    for i0 in range(s0):
+        for i1 in range(s1):
+            for i2 in range(s2):
+                if not to_process[i0, i1, i2]:
+                    continue
+                
+                #Grow the zone from the current voxel
+                gl = image[i0, i1, i2]
+                to_process[i0, i1, i2] = False
+                stack[0, 0], stack[0, 1], stack[0, 2] = i0, i1, i2
+                top, size = 1, 0
+                while top > 0:
+                    top -= 1
+                    k0, k1, k2 = stack[top, 0], stack[top, 1], stack[top, 2]
+                    size += 1
+                    for a in range(Na):
+                        j0 = k0 + angles[a, 0]
+                        j1 = k1 + angles[a, 1]
+                        j2 = k2 + angles[a, 2]
+                        if (0 <= j0 < s0) and (0 <= j1 < s1) and\
+                           (0 <= j2 < s2):
+                            if to_process[j0, j1, j2] and\
+                               image[j0, j1, j2] == gl:
+                                to_process[j0, j1, j2] = False
+                                stack[top, 0] = j0
+                                stack[top, 1] = j1
+                                stack[top, 2] = j2
+                                top += 1
+                zone_levels[num_zones] = gl
+                zone_sizes[num_zones] = size
+                num_zones += 1
+                if size > max_size:
+                    max_size = size
+                    
+    P = np.zeros((Ng, max_size))
+    for z in range(num_zones):
+        P[zone_levels[z] - 1, zone_sizes[z] - 1] += 1
+    return P
+
+@_jit
+def _neighbourhood_kernel(image, mask, angles, Ng, alpha):
+    """Neighbouring gray tone difference matrix (Ng x 3) and gray level 
+    dependence matrix (Ng x Na + 1) of a 3D image. Both are computed in one
+    pass over the neighbourhood of each voxel."""
+    s0, s1, s2 = image.shape
+    Na = angles.shape[0]
+    P_ngtdm = np.zeros((Ng, 3))
+    for gl in range(Ng):
+        P_ngtdm[gl, 2] = gl + 1
+    P_gldm = np.zeros((Ng, Na + 1))
+    for i0 in range(s0):
+        for i1 in range(s1):
+            for i2 in range(s2):
+                if not mask[i0, i1, i2]:
+                    continue
+                gl = image[i0, i1, i2]
+                count, total, dep = 0, 0.0, 0
+                for a in range(Na):
+                    j0 = i0 + angles[a, 0]
+                    j1 = i1 + angles[a, 1]
+                    j2 = i2 + angles[a, 2]
+                    if (0 <= j0 < s0) and (0 <= j1 < s1) and (0 <= j2 < s2):
+                        if mask[j0, j1, j2]:
+                            count += 1
+                            total += image[j0, j1, j2]
+                            if abs(gl - image[j0, j1, j2]) <= alpha:
+                                dep += 1
+                diff = 0.0
+                if count > 0:
+                    diff = abs(gl - total/count)
+                P_ngtdm[gl - 1, 0] += 1
+                P_ngtdm[gl - 1, 1] += diff
+                P_gldm[gl - 1, dep] += 1
+    return P_ngtdm, P_gldm
+
+def _delete_empty_gray_levels(P, Ng, gray_levels):
+    """Removes from the texture matrix P (gray levels along axis 1) the rows 
+    corresponding to gray levels not present in the ROI"""
+    empty_gray_levels = np.array(list(set(range(1, Ng + 1)) - 
+                                      set(gray_levels)), dtype = int)
+    return np.delete(P, empty_gray_levels - 1, 1)
+
+class _NumbaTextureMatrices():
+    """Mixin that replaces the C texture matrices of the pyradiomics feature 
+    classes with the Numba kernels. Only segment-based, 3D extraction is 
+    supported; any other configuration is delegated to pyradiomics. Feature 
+    classes computed on the same ROI can share the shared_matrices dict so 
+    that the neighbourhood pass (common to NGTDM and GLDM) is run only once."""
     
-    smape_value = 0.0
+    shared_matrices = None
     
-    if len(a) != len(f):
-        raise Exception('The actual and forecasted values must have the '
-                        'same length')    
+    def _numba_compatible(self):
+        return (not self.voxelBased) and (self.imageArray.ndim == 3) and\
+               (not self.settings.get('force2D', False))
     
-    #Remove zero values to avoid NaN
-    nonzero_a_f = np.intersect1d(a.nonzero(), f.nonzero())
-    if len(nonzero_a_f) > 0:
-        a = a[nonzero_a_f]
-        f = f[nonzero_a_f]
-        smape_value = 1/len(a) *\
-            np.sum(np.abs(f-a) / (np.abs(a) + np.abs(f))*100)
-    else:
-        warnings.warn(f"SMAPE: no non-zero values in the input arrays, " +\
-                      f"returning default value ({smape_value})")
-    return smape_value
+    def _numba_inputs(self):
+        image = np.ascontiguousarray(self.imageArray, dtype = np.int64)
+        mask = np.ascontiguousarray(self.maskArray, dtype = np.bool_)
+        return image, mask
+    
+    def _shared_matrix(self, key, compute):
+        """Returns the matrix stored under key in the shared dict, computes
+        and stores it if not there"""
+        if self.shared_matrices is None:
+            self.shared_matrices = dict()
+        if key not in self.shared_matrices:
+            self.shared_matrices[key] = compute()
+        return self.shared_matrices[key]
+    
+    def _neighbourhood_matrices(self):
+        """NGTDM and GLDM matrices (not yet pruned)"""
+        distances = tuple(self.settings.get('distances', [1]))
+        alpha = int(self.settings.get('gldm_a', 0))
+        
+        def compute():
+            image, mask = self._numba_inputs()
+            angles = _texture_angles(image.shape, distances)
+            return _neighbourhood_kernel(image, mask, angles, 
+                                         self.coefficients['Ng'], alpha)
+        
+        return self._shared_matrix(('neighbourhood', distances, alpha), 
+                                   compute)
 
-def avg_smape(values):
-    """Average symmetric mean absolute percentage error over an array of
-    values. The values ideally represent the results of repeated mesurements
-    on the same subject.
+class NumbaRadiomicsGLRLM(_NumbaTextureMatrices, glrlm.RadiomicsGLRLM):
+    """GLRLM feature class with the matrix computed by _glrlm_kernel()"""
     
-    Parameters
-    ----------
-    values : iterable of numerics.
-       The input values.
-       
-    Returns
-    -------
-    avg_smape : float
-       The average SMAPE.
-    """
+    def _calculateMatrix(self, voxelCoordinates = None):
+        if not self._numba_compatible():
+            return super()._calculateMatrix(voxelCoordinates)
+        
+        Ng = self.coefficients['Ng']
+        Nr = np.max(self.imageArray.shape)
+        
+        def compute():
+            image, mask = self._numba_inputs()
+            angles = _texture_angles(image.shape, bidirectional = False)
+            return _glrlm_kernel(image, mask, angles, Ng, Nr), angles
+        
+        P_glrlm, angles = self._shared_matrix(('glrlm',), compute)
+        P_glrlm = _delete_empty_gray_levels(P_glrlm[None, ...], Ng, 
+                                            self.coefficients['grayLevels'])
+        
+        #Optionally apply a weighting factor (same as pyradiomics)
+        if self.weightingNorm is not None:
+            pixel_spacing = self.inputImage.GetSpacing()[::-1]
+            weights = np.ones(len(angles))
+            for a_idx, a in enumerate(angles):
+                if self.weightingNorm == 'infinity':
+                    weights[a_idx] = max(np.abs(a) * pixel_spacing)
+                elif self.weightingNorm == 'euclidean':
+                    weights[a_idx] = np.sqrt(np.sum((np.abs(a) * 
+                                                     pixel_spacing) ** 2))
+                elif self.weightingNorm == 'manhattan':
+                    weights[a_idx] = np.sum(np.abs(a) * pixel_spacing)
+            P_glrlm = np.sum(P_glrlm * weights[None, None, None, :], 3, 
+                             keepdims = True)
+        
+        #Delete empty angles if no weighting is applied
+        Nr = np.sum(P_glrlm, (1, 2))
+        if P_glrlm.shape[3] > 1:
+            empty_angles = np.where(np.sum(Nr, 0) == 0)
+            if len(empty_angles[0]) > 0:
+                P_glrlm = np.delete(P_glrlm, empty_angles, 3)
+                Nr = np.delete(Nr, empty_angles, 1)
+                
+        Nr[Nr == 0] = np.nan
+        self.coefficients['Nr'] = Nr
+        return P_glrlm
+
+class NumbaRadiomicsGLSZM(_NumbaTextureMatrices, glszm.RadiomicsGLSZM):
+    """GLSZM feature class with the matrix computed by _glszm_kernel()"""
     
-    #Get all the pairwise combinations (order matters) and consider the first
-    #element as the target and the second as the forecast
-    indices = list(range(len(values)))
-    combs = permutations(indices, 2)
-    targets = list()
-    forecasts = list()
-    for comb in combs:
-        targets.append(values[comb[0]])
-        forecasts.append(values[comb[1]])
+    def _calculateMatrix(self, voxelCoordinates = None):
+        if not self._numba_compatible():
+            return super()._calculateMatrix(voxelCoordinates)
+        
+        Ng = self.coefficients['Ng']
         
-    avg_smape = smape(np.asarray(targets), np.asarray(forecasts))
-    return avg_smape
+        def compute():
+            image, mask = self._numba_inputs()
+            angles = _texture_angles(image.shape)
+            return _glszm_kernel(image, mask, angles, Ng)
+        
+        P_glszm = self._shared_matrix(('glszm',), compute)
+        return _delete_empty_gray_levels(P_glszm[None, ...], Ng, 
+                                         self.coefficients['grayLevels'])
+
+class NumbaRadiomicsGLDM(_NumbaTextureMatrices, gldm.RadiomicsGLDM):
+    """GLDM feature class with the matrix computed by 
+    _neighbourhood_kernel()"""
     
- 
+    def _calculateMatrix(self, voxelCoordinates = None):
+        if not self._numba_compatible():
+            return super()._calculateMatrix(voxelCoordinates)
+        
+        _, P_gldm = self._neighbourhood_matrices()
+        P_gldm = _delete_empty_gray_levels(P_gldm[None, ...], 
+                                           self.coefficients['Ng'], 
+                                           self.coefficients['grayLevels'])
+        
+        #Delete the dependence sizes not present in the ROI and compute the 
+        #coefficients (same as pyradiomics)
+        jvector = np.arange(1, P_gldm.shape[2] + 1, dtype = np.float64)
+        pd_ = np.sum(P_gldm, 1)
+        pg = np.sum(P_gldm, 2)
+        empty_sizes = np.where(np.sum(pd_, 0) == 0)
+        P_gldm = np.delete(P_gldm, empty_sizes, 2)
+        jvector = np.delete(jvector, empty_sizes)
+        pd_ = np.delete(pd_, empty_sizes, 1)
+        Nz = np.sum(pd_, 1)
+        Nz[Nz == 0] = 1
+        
+        self.coefficients['Nz'] = Nz
+        self.coefficients['pd'] = pd_
+        self.coefficients['pg'] = pg
+        self.coefficients['ivector'] = self.coefficients['grayLevels'].\
+            astype(float)
+        self.coefficients['jvector'] = jvector
+        return P_gldm
+
+class NumbaRadiomicsNGTDM(_NumbaTextureMatrices, ngtdm.RadiomicsNGTDM):
+    """NGTDM feature class with the matrix computed by 
+    _neighbourhood_kernel()"""
+    
+    def _calculateMatrix(self, voxelCoordinates = None):
+        if not self._numba_compatible():
+            return super()._calculateMatrix(voxelCoordinates)
+        
+        P_ngtdm, _ = self._neighbourhood_matrices()
+        P_ngtdm = P_ngtdm[None, ...]
+        
+        #Delete empty gray levels
+        empty_gray_levels = np.where(np.sum(P_ngtdm[:, :, 0], 0) == 0)
+        return np.delete(P_ngtdm, empty_gray_levels, 1)
+
+#Feature classes replaced by the Numba backend
+numba_feature_classes = {'glrlm' : NumbaRadiomicsGLRLM,
+                         'glszm' : NumbaRadiomicsGLSZM,
+                         'gldm' : NumbaRadiomicsGLDM,
+                         'ngtdm' : NumbaRadiomicsNGTDM}
+
+class NumbaFeatureExtractor(TimedFeatureExtractor):
+    """Feature extractor that computes the GLRLM, GLSZM, GLDM and NGTDM 
+    matrices through the Numba kernels. The other feature classes are 
+    computed by pyradiomics."""
     
-    
\ No newline at end of file
+    replacement_classes = numba_feature_classes
+#*******************************************************************************
+#*******************************************************************************
+#*******************************************************************************
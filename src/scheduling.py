@@ -0,0 +1,438 @@
+"""Scheduling of the feature extraction tasks over multiple worker processes.
+The cost of each task is estimated from the size of the ROI; tasks are
+dispatched largest-first (LPT) and idle workers steal the remaining work of
+the busiest ones."""
+import heapq
+import json
+import time
+
+from bisect import insort
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import count
+from multiprocessing import get_all_start_methods, get_context
+
+import numpy as np
+
+class TaskCostModel():
+    """Log-linear model of the time (seconds) needed for computing the
+    features of one ROI under one experimental condition:
+
+        log(t) = w0 + w1*log(num_voxels) + w2*log(bbox_volume) +
+                 w3*log(num_levels)
+
+    where num_voxels is the number of voxels in the mask and bbox_volume the
+    number of voxels in its bounding box. The weights are fitted on the
+    measured times by least squares, regularised towards the initial weights
+    (which dominate until enough measurements are available)."""
+
+    #Initial weights: cost slightly superlinear in the number of voxels
+    #(texture matrices), about one second for 10^4 voxels
+    default_weights = [-13.5, 1.2, 0.1, 0.3]
+
+    @staticmethod
+    def _predictors(num_voxels, bbox_volume, num_levels):
+        return np.array([1.0, np.log(max(num_voxels, 1)),
+                         np.log(max(bbox_volume, 1)),
+                         np.log(max(num_levels, 2))])
+
+    def estimate(self, num_voxels, bbox_volume, num_levels):
+        """Estimated time of one task (seconds).
+
+        Parameters
+        ----------
+        num_voxels : int
+            Number of voxels in the mask.
+        bbox_volume : int
+            Number of voxels in the bounding box of the mask.
+        num_levels : int
+            Number of quantisation levels.
+
+        Returns
+        -------
+        seconds : float
+            The estimated time.
+        """
+        predictors = self.__class__._predictors(num_voxels, bbox_volume,
+                                                num_levels)
+        return float(np.exp(predictors @ self.weights))
+
+    def update(self, num_voxels, bbox_volume, num_levels, seconds):
+        """Adds one measured time and refits the weights.
+
+        Parameters
+        ----------
+        num_voxels, bbox_volume, num_levels : int
+            See estimate().
+        seconds : float (> 0)
+            The measured time.
+        """
+        predictors = self.__class__._predictors(num_voxels, bbox_volume,
+                                                num_levels)
+        self._xtx += np.outer(predictors, predictors)
+        self._xty += predictors * np.log(max(seconds, 1e-6))
+        self.num_measurements += 1
+
+        #Ridge regression towards the initial weights
+        prior = self._regularisation * np.eye(len(self._initial_weights))
+        self.weights = np.linalg.solve(
+            self._xtx + prior, self._xty + prior @ self._initial_weights)
+
+    def get_state(self):
+        """The measurements and the weights (JSON serialisable)"""
+        return {'initial_weights' : self._initial_weights.tolist(),
+                'regularisation' : self._regularisation,
+                'xtx' : self._xtx.tolist(),
+                'xty' : self._xty.tolist(),
+                'num_measurements' : self.num_measurements,
+                'weights' : self.weights.tolist()}
+
+    @classmethod
+    def from_state(cls, state):
+        """Model with the state returned by get_state()"""
+        model = cls(initial_weights = state['initial_weights'],
+                    regularisation = state['regularisation'])
+        model._xtx = np.array(state['xtx'])
+        model._xty = np.array(state['xty'])
+        model.num_measurements = state['num_measurements']
+        model.weights = np.array(state['weights'])
+        return model
+
+    def __init__(self, initial_weights = None, regularisation = 1.0):
+        """
+        Parameters
+        ----------
+        initial_weights : list of float (4)
+            The weights before any measurement (default_weights if None).
+        regularisation : float (> 0)
+            Weight of the initial weights in the fit, in number of
+            measurements.
+        """
+        if initial_weights is None:
+            initial_weights = self.__class__.default_weights
+        self._initial_weights = np.array(initial_weights, dtype = np.float64)
+        self._regularisation = regularisation
+        self._xtx = np.zeros((4, 4))
+        self._xty = np.zeros(4)
+        self.num_measurements = 0
+        self.weights = self._initial_weights.copy()
+
+class FeatureCostModel():
+    """Cost model of the extraction tasks by feature class: the time of a 
+    task is the sum of the times of the feature classes computed plus an 
+    overhead (preprocessing, temporary files, etc.), each modelled by a 
+    TaskCostModel. Classes not measured yet use the initial weights."""
+
+    #Initial weights of each feature class and of the overhead (see
+    #TaskCostModel)
+    class_weights = [-15.5, 1.2, 0.1, 0.3]
+    overhead_weights = [-7.0, 0.5, 0.0, 0.0]
+
+    def _class_model(self, class_name):
+        if class_name not in self._class_models:
+            self._class_models[class_name] = TaskCostModel(
+                initial_weights = self.__class__.class_weights)
+        return self._class_models[class_name]
+
+    def estimate_by_class(self, num_voxels, bbox_volume, num_levels,
+                          feature_classes):
+        """Estimated time of one task by feature class (seconds).
+
+        Parameters
+        ----------
+        num_voxels, bbox_volume, num_levels : int
+            See TaskCostModel.estimate().
+        feature_classes : iterable of str
+            The feature classes computed (e.g. 'glcm', 'shape').
+
+        Returns
+        -------
+        seconds : dict
+            The estimated time of each feature class and of the overhead 
+            (key 'overhead').
+        """
+        seconds = {'overhead' : self._overhead.estimate(
+            num_voxels, bbox_volume, num_levels)}
+        for class_name in feature_classes:
+            seconds[class_name] = self._class_model(class_name).estimate(
+                num_voxels, bbox_volume, num_levels)
+        return seconds
+
+    def estimate(self, num_voxels, bbox_volume, num_levels, feature_classes):
+        """Estimated time of one task (seconds) - see estimate_by_class()"""
+        return sum(self.estimate_by_class(num_voxels, bbox_volume, num_levels,
+                                          feature_classes).values())
+
+    def update(self, num_voxels, bbox_volume, num_levels, feature_classes,
+               seconds, class_seconds = None):
+        """Adds the measured time of one task and refits the models.
+
+        Parameters
+        ----------
+        num_voxels, bbox_volume, num_levels, feature_classes
+            See estimate_by_class().
+        seconds : float (> 0)
+            The measured time of the whole task.
+        class_seconds : dict (optional)
+            The measured time of each feature class. If not given the time
+            is split in proportion to the current estimates.
+        """
+        if class_seconds is None:
+            estimates = self.estimate_by_class(num_voxels, bbox_volume,
+                                               num_levels, feature_classes)
+            total = sum(estimates.values())
+            class_seconds = {class_name : seconds * estimate / total
+                             for class_name, estimate in estimates.items()
+                             if class_name != 'overhead'}
+        for class_name, class_time in class_seconds.items():
+            self._class_model(class_name).update(num_voxels, bbox_volume,
+                                                 num_levels, class_time)
+        self._overhead.update(num_voxels, bbox_volume, num_levels,
+                              seconds - sum(class_seconds.values()))
+
+    @property
+    def num_measurements(self):
+        return self._overhead.num_measurements
+
+    def save(self, path):
+        """Stores the models into a JSON file"""
+        with open(path, 'w') as file:
+            json.dump({'overhead' : self._overhead.get_state(),
+                       'classes' : {class_name : model.get_state()
+                                    for class_name, model in
+                                    self._class_models.items()}}, file)
+
+    @classmethod
+    def load(cls, path):
+        """Model stored by save()"""
+        with open(path, 'r') as file:
+            state = json.load(file)
+        model = cls()
+        model._overhead = TaskCostModel.from_state(state['overhead'])
+        for class_name, class_state in state['classes'].items():
+            model._class_models[class_name] = \
+                TaskCostModel.from_state(class_state)
+        return model
+
+    def __init__(self):
+        self._overhead = TaskCostModel(
+            initial_weights = self.__class__.overhead_weights)
+        self._class_models = dict()
+
+class WorkStealingScheduler():
+    """Assigns tasks to workers by estimated cost. Each new task goes to the
+    worker with the smallest pending load, into its queue sorted by
+    decreasing cost (longest processing time first); a worker whose queue is
+    empty steals the next task of the worker with the largest pending
+    load."""
+
+    def add(self, task, cost):
+        """Adds one task.
+
+        Parameters
+        ----------
+        task : object
+            The task.
+        cost : float
+            The estimated cost of the task.
+        """
+        worker = int(np.argmin(self._loads))
+        insort(self._queues[worker], (-cost, next(self._counter), task))
+        self._loads[worker] += cost
+
+    def next_task(self, worker):
+        """Next task for the given worker.
+
+        Parameters
+        ----------
+        worker : int
+            The worker index.
+
+        Returns
+        -------
+        task_and_cost : tuple (task, cost)
+            The task and its estimated cost. None if no task is left.
+        """
+        if len(self._queues[worker]) == 0:
+            victims = [w for w, queue in enumerate(self._queues) 
+                       if len(queue) > 0]
+            if len(victims) == 0:
+                return None
+            worker = max(victims, key = lambda w: self._loads[w])
+        minus_cost, _, task = self._queues[worker].pop(0)
+        self._loads[worker] += minus_cost
+        if len(self._queues[worker]) == 0:
+            self._loads[worker] = 0.0
+        return task, -minus_cost
+
+    def __len__(self):
+        return sum([len(queue) for queue in self._queues])
+
+    def __init__(self, num_workers):
+        """
+        Parameters
+        ----------
+        num_workers : int (> 0)
+            The number of workers.
+        """
+        self._queues = [list() for _ in range(num_workers)]
+        self._loads = np.zeros(num_workers)
+        self._counter = count()
+
+#Function run by each worker process (set by _init_worker())
+_worker_function = None
+
+def _init_worker(function):
+    global _worker_function
+    _worker_function = function
+
+def _run_in_worker(task):
+    start = time.perf_counter()
+    result = _worker_function(task)
+    return result, time.perf_counter() - start
+
+def run_tasks(tasks, function, num_workers, cost_model, lookahead = 256,
+              class_seconds = None):
+    """Runs a function on each task in a pool of worker processes, scheduled
+    by WorkStealingScheduler. The measured times update the cost model.
+
+    Parameters
+    ----------
+    tasks : iterable of tuple (task, cost_predictors)
+        The tasks, each with the predictors of its cost (num_voxels,
+        bbox_volume, num_levels, feature_classes - see FeatureCostModel) and
+        consumed lazily: at most lookahead tasks are waiting to be 
+        dispatched.
+    function : callable
+        The function to run on each task. Needs to be picklable (e.g. a
+        module-level function or a functools.partial of one); it is sent to
+        each worker once. The workers are started by a fork server (spawned
+        where this is not available), not forked from the calling process:
+        they import the main module, therefore scripts need an 
+        if __name__ == '__main__' guard.
+    num_workers : int (> 0)
+        The number of worker processes. With 1 the tasks are run in the
+        calling process.
+    cost_model : FeatureCostModel
+        The cost model.
+    lookahead : int (> 0)
+        Number of tasks read in advance from tasks and scheduled together.
+    class_seconds : callable (optional)
+        Returns the measured time of each feature class (dict) from the 
+        value returned by function. If not given the measured time of each
+        task is split in proportion to the estimates.
+
+    Yields
+    ------
+    task, result, seconds : tuple
+        Each task as it is completed, the value returned by function and the
+        time needed.
+    """
+
+    scheduler = WorkStealingScheduler(num_workers)
+    tasks = iter(tasks)
+    exhausted = False
+
+    def fill():
+        nonlocal exhausted
+        while (not exhausted) and (len(scheduler) < lookahead):
+            try:
+                task, cost_predictors = next(tasks)
+            except StopIteration:
+                exhausted = True
+                break
+            scheduler.add((task, cost_predictors),
+                          cost_model.estimate(*cost_predictors))
+
+    def completed(task_and_predictors, result, seconds):
+        task, cost_predictors = task_and_predictors
+        measured = None if class_seconds is None else class_seconds(result)
+        cost_model.update(*cost_predictors, seconds, 
+                          class_seconds = measured)
+        return task, result, seconds
+
+    if num_workers == 1:
+        _init_worker(function)
+        while True:
+            fill()
+            task_and_cost = scheduler.next_task(0)
+            if task_and_cost is None:
+                return
+            result, seconds = _run_in_worker(task_and_cost[0][0])
+            yield completed(task_and_cost[0], result, seconds)
+
+    #Forking the calling process could leave the workers with locks held by
+    #its other threads (e.g. ROI prefetching, write-behind), which do not 
+    #exist in the children
+    if 'forkserver' in get_all_start_methods():
+        mp_context = get_context('forkserver')
+    else:
+        mp_context = get_context('spawn')
+    with ProcessPoolExecutor(max_workers = num_workers, 
+                             mp_context = mp_context,
+                             initializer = _init_worker,
+                             initargs = (function,)) as executor:
+        running = dict()
+        while True:
+            fill()
+
+            #Give a task to each idle worker
+            busy = {worker for worker, _ in running.values()}
+            for worker in range(num_workers):
+                if worker in busy:
+                    continue
+                task_and_cost = scheduler.next_task(worker)
+                if task_and_cost is None:
+                    break
+                future = executor.submit(_run_in_worker,
+                                         task_and_cost[0][0])
+                running[future] = (worker, task_and_cost[0])
+            if len(running) == 0:
+                return
+
+            done, _ = wait(running.keys(), return_when = FIRST_COMPLETED)
+            for future in done:
+                _, task_and_predictors = running.pop(future)
+                result, seconds = future.result()
+                yield completed(task_and_predictors, result, seconds)
+
+def estimate_makespan(costs, num_workers):
+    """Wall time needed for running tasks of the given costs on a number of 
+    workers, simulating largest-first scheduling.
+    
+    Parameters
+    ----------
+    costs : iterable of float
+        The costs (seconds) of the tasks.
+    num_workers : int (> 0)
+        The number of workers.
+    
+    Returns
+    -------
+    makespan : float
+        The estimated wall time (seconds).
+    """
+    loads = [0.0] * num_workers
+    for cost in sorted(costs, reverse = True):
+        heapq.heapreplace(loads, loads[0] + cost)
+    return max(loads)
+
+def estimate_task_memory(num_voxels, bbox_volume, num_levels):
+    """Rough upper estimate of the memory (bytes) needed by a worker for 
+    computing the features of one ROI: copies of the image and mask (NumPy 
+    and SimpleITK) plus the largest texture matrices (GLCM: levels^2 for 13 
+    angles; GLSZM: levels x zone sizes, at most the number of voxels).
+    
+    Parameters
+    ----------
+    num_voxels, bbox_volume, num_levels : int
+        See TaskCostModel.estimate().
+    
+    Returns
+    -------
+    num_bytes : int
+        The estimated memory.
+    """
+    images = 40 * bbox_volume
+    glcm = 8 * 13 * num_levels**2
+    glszm = 8 * num_levels * num_voxels
+    return int(images + glcm + glszm)
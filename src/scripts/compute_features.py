@@ -1,12 +1,14 @@
 """Compute the features"""
 import os
+import sys
 
 import pandas as pd
-import pylidc as pl
 import PySimpleGUI as sg
 
-from functions import get_feature_values
-from utilities import DBDriver
+from functions import iter_feature_values, plan_extraction, ROIPrefetcher, \
+    roi_size
+from scheduling import FeatureCostModel
+from utilities import DBDriver, settings_fingerprint, WriteBehindDBDriver
 
 
 #*******************************************************************************
@@ -19,6 +21,10 @@ signal_cache = cache_folder + '/signal.nrrd'
 mask_cache = cache_folder + '/mask.nrrd'
 feature_db = cache_folder + '/features.db'
 
+#Measured times of the tasks (by feature class), used for estimating the cost
+#of the next ones
+cost_model_file = cache_folder + '/task_costs.json'
+
 #Create the cache folder if it doesn't exist
 if not os.path.isdir(cache_folder):
     os.makedirs(name = cache_folder)
@@ -61,8 +67,10 @@ ngtdm = ['ngtdm/' + x for x in ngtdm]
 features_to_compute = first_order_statistics + glcm + gldm + glrlm + glszm +\
     ngtdm
 
-#CT window
-ct_window = (-583, 137)
+#CT windows (lower and upper bound in HU). Each window is a separate 
+#experimental condition: for a sweep list several windows, the ROIs are 
+#loaded once and re-quantised for each window
+ct_windows = [(-583, 137)]
 
 #Number of levels for signal resampling 
 num_levelss = [32, 64, 128, 256]
@@ -70,109 +78,224 @@ num_levelss = [32, 64, 128, 256]
 #Level of Gaussian noise
 noise_scales = [0.0]
 
-#*******************************************************************************
-#*******************************************************************************
-#*******************************************************************************
+#Backend for the GLRLM, GLSZM, GLDM and NGTDM matrices ('pyradiomics' or 
+#'numba'; the latter requires Numba and falls back to the former otherwise)
+backend = 'pyradiomics'
 
-#Get the list of the selected CT scans
-patient_population = pd.read_csv('cache/scans_metadata.csv')
-selected_scans = patient_population['patient_id'].tolist()
+#Number of scans loaded in advance in the background while the features of 
+#the current one are computed (bounds the memory used for prefetching)
+prefetch_depth = 1
 
-#*******************************************************************************
-#**************************** Progress window **********************************
-#*******************************************************************************
+#Write the feature values to the database in the background (batched 
+#transactions), so that the extraction does not wait for the disk
+write_behind = True
+
+#Number of worker processes. Each task (nodule, annotation, number of levels 
+#and noise scale) is scheduled by its estimated cost (largest first) and idle
+#workers take over the pending tasks of the busiest ones
+num_workers = max(1, os.cpu_count() - 1)
+
+#Number of tasks read in advance and scheduled together (the larger, the 
+#better the load balancing, but the ROIs of these tasks are kept in memory)
+schedule_lookahead = 256
+
+#Export the feature values to a Parquet dataset (partitioned by number of 
+#levels and noise scale) at the end of the run for columnar analyses; None 
+#for no export. Requires pyarrow.
+parquet_dataset = None
+
+#Only print the estimated CPU time, wall time, database growth and peak 
+#memory of the features still to compute (nothing is computed)
+dry_run = False
 
-#sg.theme('Dark Red')
-
-BAR_MAX = 100
-
-# layout the Window
-layout = [[sg.Text('Patient:'), sg.Text(size = (15,1), key='-pid-')],
-          [sg.ProgressBar(BAR_MAX, 
-                          orientation='h', 
-                          size=(20,20), 
-                          key='-patient-progress-')],
-          [sg.Text('Nodule:'), sg.Text(size = (3,1), key='-nid-')],
-          [sg.ProgressBar(BAR_MAX, 
-                          orientation='h', 
-                          size=(20,20), 
-                          key='-nodule-progress-')],  
-          [sg.Text('Annotation:'), sg.Text(size = (3,1), key='-aid-')],
-          [sg.ProgressBar(BAR_MAX, 
-                          orientation='h', 
-                          size=(20,20), 
-                          key='-annotation-progress-')],           
-          [sg.Text('Noise level: '), sg.Text(size = (5,1), key='-noise-')],
-          [sg.Text('Resampling levels: '), sg.Text(size = (5,1), key='-numlev-')],
-          [sg.Cancel()]]
-
-# create the Window
-window = sg.Window('Custom Progress Meter', layout)
 #*******************************************************************************
 #*******************************************************************************
 #*******************************************************************************
 
-#Create the databse driver
-db_driver = DBDriver(feature_names = features_to_compute, 
-                     db_file = feature_db)
-
-#Iterate through the scans
-for num_patient, patient_id in enumerate(selected_scans):
-        
-    scan = pl.query(pl.Scan).filter(pl.Scan.patient_id == patient_id).first()
-        
-    #Get the CT scan as a voxel model
-    voxel_model = scan.to_volume()
-    
-    #Get all the nodules within this scan
-    nodules = scan.cluster_annotations(verbose = False)
-    
-    #Iterate through the nodules
-    num_nodules = len(nodules)
-    for n in range(num_nodules):
-        
-        print(f'Patient {num_patient + 1} of {len(selected_scans)}; '
-              f'nodule {n} of {num_nodules}')
-               
-        #Current nodule
-        nodule = nodules[n]
-        
-        #Iterate through the annotations for the current nodule and get the 
-        #corresponding signals and masks
-        annotations = list(range(len(nodule)))
-        annotations.append(-1)              #Add the 50% consensus annotation
-        for aid, ann in enumerate(annotations):
-                        
-            #Get the  value for the requested number of levels and
-            #noise scale
-            for num_levels in num_levelss:
-                for noise_scale in noise_scales:
-                    _ = get_feature_values(
-                        feature_names = features_to_compute,
-                        patient_id = patient_id, 
-                        nodule_id = n, 
-                        annotation_id = ann, 
-                        db_driver = db_driver, 
-                        window = ct_window, 
-                        num_levels = num_levels, 
-                        noise_scale = noise_scale,
-                        path_to_image = signal_cache,
-                        path_to_mask = mask_cache,
-                        verbose=True
-                    )  
-                    
-                    #Update the progress bar
-                    event, values = window.read(timeout=10)
-                    if event == 'Cancel' or event == sg.WIN_CLOSED:
-                        break
-                        # update bar with loop value +1 so that bar eventually reaches the maximum
-                    window['-patient-progress-'].update(100 * (num_patient + 1)/len(selected_scans))
-                    window['-pid-'].update(f'{patient_id}')
-                    window['-nodule-progress-'].update(100 * (n + 1)/num_nodules) 
-                    window['-nid-'].update(f'{n}')
-                    window['-annotation-progress-'].update(100 * (aid + 1)/len(annotations)) 
-                    window['-aid-'].update(f'{ann}')                    
-                    window['-noise-'].update("{:.1f}%".format(noise_scale)) 
-                    window['-numlev-'].update(f'{num_levels}')
-                    
-window.close()
\ No newline at end of file
+#The worker processes import this script (see scheduling.run_tasks()): run
+#the extraction in the main process only
+if __name__ == '__main__':
+
+    #Fingerprint of the current extraction settings: the values in the database
+    #computed with other settings (e.g. another pyradiomics version) are 
+    #recomputed (see stale_results.py)
+    fingerprint = settings_fingerprint(backend = backend)
+
+    #Get the list of the selected CT scans
+    patient_population = pd.read_csv('cache/scans_metadata.csv')
+    selected_scans = patient_population['patient_id'].tolist()
+
+    #Learn the cost of the tasks from the previous runs if available
+    if os.path.isfile(cost_model_file):
+        cost_model = FeatureCostModel.load(cost_model_file)
+    else:
+        cost_model = FeatureCostModel()
+
+    #***************************************************************************
+    #******************************** Dry run **********************************
+    #***************************************************************************
+    if dry_run:
+        dry_run_db_driver = None
+        if os.path.isfile(feature_db):
+            dry_run_db_driver = DBDriver.generate_from_file(
+                feature_db, fingerprint = fingerprint)
+        plan = plan_extraction(selected_scans, features_to_compute, ct_windows,
+                               num_levelss, noise_scales, dry_run_db_driver, 
+                               cost_model, num_workers, 
+                               lookahead = schedule_lookahead)
+        if cost_model.num_measurements == 0:
+            print('No timings from previous runs: using the default cost model')
+        print(f'Tasks to run: {plan["num_tasks"]}')
+        for class_name, seconds in plan['cpu_seconds_by_class'].items():
+            print(f'    {class_name}: {seconds / 3600:.2f} CPU-hours')
+        print(f'Total: {plan["cpu_seconds"] / 3600:.2f} CPU-hours')
+        print(f'Wall time with {num_workers} workers: '
+              f'{plan["wall_seconds"] / 3600:.2f} hours')
+        print(f'Database growth: {plan["db_growth_bytes"] / 2**20:.1f} MiB')
+        print(f'Peak memory: {plan["peak_memory_bytes"] / 2**20:.1f} MiB')
+        sys.exit()
+    #***************************************************************************
+    #***************************************************************************
+    #***************************************************************************
+
+    #***************************************************************************
+    #**************************** Progress window ******************************
+    #***************************************************************************
+
+    #sg.theme('Dark Red')
+
+    BAR_MAX = 100
+
+    # layout the Window
+    layout = [[sg.Text('Patient:'), sg.Text(size = (15,1), key='-pid-')],
+              [sg.ProgressBar(BAR_MAX, 
+                              orientation='h', 
+                              size=(20,20), 
+                              key='-patient-progress-')],
+              [sg.Text('Nodule:'), sg.Text(size = (3,1), key='-nid-')],
+              [sg.ProgressBar(BAR_MAX, 
+                              orientation='h', 
+                              size=(20,20), 
+                              key='-nodule-progress-')],  
+              [sg.Text('Annotation:'), sg.Text(size = (3,1), key='-aid-')],
+              [sg.ProgressBar(BAR_MAX, 
+                              orientation='h', 
+                              size=(20,20), 
+                              key='-annotation-progress-')],           
+              [sg.Text('Noise level: '), sg.Text(size = (5,1), key='-noise-')],
+              [sg.Text('Resampling levels: '), sg.Text(size = (5,1), key='-numlev-')],
+              [sg.Cancel()]]
+
+    # create the Window
+    window = sg.Window('Custom Progress Meter', layout)
+    #***************************************************************************
+    #***************************************************************************
+    #***************************************************************************
+
+    #Create the databse driver
+    if write_behind:
+        db_driver = WriteBehindDBDriver(feature_names = features_to_compute, 
+                                        db_file = feature_db, 
+                                        fingerprint = fingerprint)
+    else:
+        db_driver = DBDriver(feature_names = features_to_compute, 
+                             db_file = feature_db, fingerprint = fingerprint)
+
+    #Worker processes only read through their own (synchronous) driver: the 
+    #values they compute are sent back and written here through db_driver,
+    #so that the writes are not lost when the workers are terminated
+    if num_workers > 1:
+        workers_db_driver = DBDriver(feature_names = features_to_compute, 
+                                     db_file = feature_db, 
+                                     fingerprint = fingerprint)
+    else:
+        workers_db_driver = db_driver
+
+    #Load the nodule ROIs of the next scans in the background
+    prefetcher = ROIPrefetcher(selected_scans, queue_depth = prefetch_depth)
+
+    #Position of each nodule and annotation for the progress window
+    progress = dict()
+
+    def generate_tasks():
+        """Tasks with features still to compute"""
+
+        #Iterate through the scans
+        for num_patient, (patient_id, rois) in enumerate(prefetcher):
+
+            #Iterate through the nodules
+            roi_sizes = dict()
+            num_nodules = len(rois)
+            for n, nodule_rois in rois.items():
+
+                print(f'Patient {num_patient + 1} of {len(selected_scans)}; '
+                      f'nodule {n} of {num_nodules}')
+
+                #Iterate through the annotations for the current nodule (the 
+                #50% consensus annotation is the last one) and the 
+                #corresponding signals and masks
+                for aid, (ann, roi) in enumerate(nodule_rois.items()):
+                    progress[(patient_id, n, ann)] = (num_patient, num_nodules, 
+                                                      aid, len(nodule_rois))
+                    num_voxels, bbox_volume = roi_size(roi[1])
+                    roi_sizes[(n, ann)] = (num_voxels, bbox_volume)
+
+                    #One task for each window, number of levels and noise 
+                    #scale, with the features not yet in the database (all 
+                    #the tasks share the same raw ROI)
+                    for ct_window in ct_windows:
+                        for num_levels in num_levelss:
+                            for noise_scale in noise_scales:
+                                missing_features = \
+                                    db_driver.get_missing_features(
+                                        patient_id, n, ann, num_levels, 
+                                        noise_scale, features_to_compute, 
+                                        window = ct_window)
+                                if len(missing_features) == 0:
+                                    continue
+                                yield (patient_id, n, ann, num_levels, 
+                                       noise_scale, tuple(ct_window), 
+                                       missing_features, roi)
+
+            #Cache the ROI sizes for the dry runs
+            db_driver.write_roi_sizes(patient_id, roi_sizes)
+
+    #Compute the features (the values are streamed as each task is completed)
+    feature_values = iter_feature_values(
+        generate_tasks(), db_driver = db_driver, 
+        path_to_image = signal_cache, path_to_mask = mask_cache, 
+        backend = backend, num_workers = num_workers, cost_model = cost_model, 
+        lookahead = schedule_lookahead, workers_db_driver = workers_db_driver)
+    last_condition = None
+    for condition, _, _, seconds in feature_values:
+        if condition == last_condition:
+            continue
+        last_condition = condition
+        patient_id, n, ann, num_levels, noise_scale, ct_window = condition
+        print(f'Computed patient_id : {patient_id}, nodule_id : {n}, '
+              f'annotation_id : {ann}, num_levels : {num_levels}, '
+              f'noise_scale : {noise_scale}, window : {ct_window} '
+              f'in {seconds:.1f} s')
+
+        #Update the progress bar
+        event, values = window.read(timeout=10)
+        if event == 'Cancel' or event == sg.WIN_CLOSED:
+            break
+        num_patient, num_nodules, aid, num_annotations = \
+            progress[(patient_id, n, ann)]
+        window['-patient-progress-'].update(100 * (num_patient + 1)/len(selected_scans))
+        window['-pid-'].update(f'{patient_id}')
+        window['-nodule-progress-'].update(100 * (n + 1)/num_nodules) 
+        window['-nid-'].update(f'{n}')
+        window['-annotation-progress-'].update(100 * (aid + 1)/num_annotations) 
+        window['-aid-'].update(f'{ann}')                    
+        window['-noise-'].update("{:.1f}%".format(noise_scale)) 
+        window['-numlev-'].update(f'{num_levels}')
+
+    feature_values.close()
+    cost_model.save(cost_model_file)
+    prefetcher.close()
+    if parquet_dataset is not None:
+        db_driver.export_parquet(parquet_dataset)
+    db_driver.close()
+    window.close()
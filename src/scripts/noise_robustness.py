@@ -0,0 +1,124 @@
+"""Robustness of texture features against Gaussian noise"""
+
+import numpy as np
+import pandas as pd
+
+from functions import feature_lut, is_mask_only, noise_replicate_statistics, \
+    ROIPrefetcher
+from stability import grade_stability
+from utilities import DBDriver, settings_fingerprint
+
+#*******************************************************************************
+#**************************** Parameters ***************************************
+#*******************************************************************************
+#Cache folder where to store the nodule signal and mask (see 
+#compute_features.py) and the feature database
+cache_folder = 'cache'
+signal_cache = cache_folder + '/noise_signal.nrrd'
+mask_cache = cache_folder + '/noise_mask.nrrd'
+feature_db = cache_folder + '/features.db'
+
+#Store the results of the robustness analysis here
+out_file = cache_folder + '/robustness_against_noise.csv'
+
+#Features to analyse (those depending on the mask only are not affected by 
+#the noise)
+features_to_analyse = [f for f in feature_lut.keys() if not is_mask_only(f)]
+
+#CT window
+ct_window = (-583, 137)
+
+#Number of levels for signal resampling 
+num_levelss = [256]
+
+#Levels of Gaussian noise (see preprocess_signal())
+noise_scales = [1.0, 2.5, 5.0]
+
+#Number of noise replicates for each ROI and noise scale
+num_replicates = 100
+
+#Annotation ids for which the analysis is performed (use -1 for 50% 
+#consensus)
+annotation_ids = [-1]
+
+#Backend for the texture matrices (see compute_features.py)
+backend = 'pyradiomics'
+#*******************************************************************************
+#*******************************************************************************
+#*******************************************************************************
+
+#Get the list of the selected CT scans
+patient_population = pd.read_csv(cache_folder + '/scans_metadata.csv')
+selected_scans = patient_population['patient_id'].tolist()
+
+#Open the feature database created by compute_features.py. Only the noise 
+#statistics are written: the columns of the features table are left as they
+#are (features_to_analyse may include features that are never computed)
+db_driver = DBDriver.generate_from_file(feature_db, 
+                                        fingerprint = settings_fingerprint(
+                                            backend = backend))
+
+#Accumulate the statistics of each ROI over the noise replicates and store 
+#the summaries only. Conditions already summarised with the requested number 
+#of replicates are skipped.
+prefetcher = ROIPrefetcher(selected_scans)
+for num_patient, (patient_id, rois) in enumerate(prefetcher):
+    for nodule_id, nodule_rois in rois.items():
+        for annotation_id in annotation_ids:
+            if annotation_id not in nodule_rois.keys():
+                continue
+            for num_levels in num_levelss:
+                for noise_scale in noise_scales:
+                    if db_driver.get_num_noise_replicates(
+                        patient_id, nodule_id, annotation_id, num_levels, 
+                        noise_scale, features_to_analyse, 
+                        window = ct_window) >= num_replicates:
+                        continue
+                    
+                    print(f'Patient {num_patient + 1} of '
+                          f'{len(selected_scans)}; nodule {nodule_id}; '
+                          f'annotation {annotation_id}; num_levels '
+                          f'{num_levels}; noise_scale {noise_scale}')
+                    statistics = noise_replicate_statistics(
+                        features_to_analyse, nodule_rois[annotation_id], 
+                        ct_window, num_levels, noise_scale, num_replicates, 
+                        signal_cache, mask_cache, backend = backend)
+                    db_driver.write_noise_statistics(
+                        patient_id, nodule_id, annotation_id, num_levels, 
+                        noise_scale, features_to_analyse, statistics, 
+                        window = ct_window)
+prefetcher.close()
+
+#Aggregate the summaries over the whole population: average SMAPE between 
+#replicates and average coefficient of variation
+results = list()
+for annotation_id in annotation_ids:
+    for num_levels in num_levelss:
+        for noise_scale in noise_scales:
+            df_summaries = pd.DataFrame(
+                db_driver.get_noise_statistics(annotation_id, num_levels, 
+                                               noise_scale, 
+                                               window = ct_window),
+                columns = ['patient_id', 'nodule_id', 'feature_name', 
+                           'num_replicates', 'mean', 'variance', 
+                           'avg_smape'])
+            df_summaries['cv'] = 100 * np.sqrt(df_summaries['variance']) /\
+                np.abs(df_summaries['mean'])
+            df_summaries = df_summaries[
+                df_summaries['feature_name'].isin(features_to_analyse)]
+            for feature_name, df_feature in df_summaries.groupby(
+                'feature_name', sort = False):
+                avg_smape_population = df_feature['avg_smape'].mean()
+                results.append(
+                    {'feature_class' : feature_name.split('/', 1)[0],
+                     'feature_name' : feature_name.split('/', 1)[1],
+                     'annotation_id' : annotation_id,
+                     'num_levels' : num_levels,
+                     'noise_scale' : noise_scale,
+                     'num_nodules' : len(df_feature),
+                     'avg_smape' : avg_smape_population,
+                     'avg_cv' : df_feature['cv'].mean(),
+                     'stability' : grade_stability(avg_smape_population)})
+                print(f'Feature: {feature_name}; noise_scale: {noise_scale}; '
+                      f'Average SMAPE: {avg_smape_population:.2f}%')
+pd.DataFrame(results).to_csv(out_file, index = False)
@@ -1,10 +1,11 @@
 """Characteristics of the patient series"""
+import csv
 from collections import OrderedDict
 
-import pandas as pd
 import pylidc as pl
+from sqlalchemy.orm import selectinload
 
-from utilities import metadata_from_dicom_folder
+from utilities import metadata_from_dicom_folders
 
 #Store the scans metadata here
 cache_folder = 'cache'
@@ -13,106 +14,80 @@ scans_metadata_csv = cache_folder + '/scans_metadata.csv'
 #Store the nodules metadata here
 nodules_metadata_csv = cache_folder + '/nodules_metadata.csv'
 
-#Retrieve all the CT scans
-scans = pl.query(pl.Scan)
-num_scans = scans.count()
+#Columns of the output files
+scans_columns = ['patient_id', 'age', 'gender', 'pixel_spacing',
+                 'slice_thickness', 'slice_spacing', 'tube_voltage']
+nodules_columns = ['patient_id', 'nodule_id', 'num_annotations',
+                   'annotation_id', 'subtlety', 'internal_structure',
+                   'calcification', 'sphericity', 'margin', 'lobulation',
+                   'spiculation', 'texture', 'malignancy']
 
-df_scans = pd.DataFrame(columns = ['patient_id', 
-                                   'age',
-                                   'gender',
-                                   'pixel_spacing', 
-                                   'slice_thickness',
-                                   'slice_spacing'])
+#Retrieve all the CT scans in one go, with the annotations and the
+#corresponding contours (needed for clustering the annotations into nodules)
+#preloaded
+scans = pl.query(pl.Scan).options(
+    selectinload(pl.Scan.annotations).selectinload(pl.Annotation.contours)
+).all()
+num_scans = len(scans)
 
-df_nodules = None                                   
+#Get additional metadata directly from the DICOM files (headers only, all the
+#folders are scanned concurrently)
+print(f'Reading the DICOM metadata of {num_scans} scans')
+dicom_folders = [scan.get_path_to_dicom_files() for scan in scans]
+additional_scans_metadata = metadata_from_dicom_folders(dicom_folders)
 
-#Keep track of elements to remove for incomplete metadata (lack of gender and/or age)
-to_remove = []
-
-#*****************************************************************
-#************** Get the metadata at the scan level ***************
-#*****************************************************************
-scans_indices = range(num_scans)
-for s in scans_indices:
-           
-    #Get the metadata accessible through the pylidc interface
-    scan_metadata = OrderedDict(
-        {'patient_id' : scans[s].patient_id,
-         'pixel_spacing' : scans[s].pixel_spacing,
-         'slice_thickness' : scans[s].slice_thickness,
-         'slice_spacing' : scans[s].slice_spacing}
-    )   
-    print(f'Reading metadata of scan {scans[s].patient_id}')
-    
-    #Get additional metadata directly from the DICOM files
-    dicom_folder = scans[s].get_path_to_dicom_files()
-    additional_scan_metadata = metadata_from_dicom_folder(dicom_folder)
-    
-    #Skip scans with incomplete metadata about gender/age
-    if None not in additional_scan_metadata.values():
-        scan_metadata.update(additional_scan_metadata)
-        if df_scans is None:
-            df_scans = pd.DataFrame(columns = list(scan_metadata.keys()))
-        df_scans = df_scans.append(scan_metadata, ignore_index = True)
-    else:
-        to_remove.append(s)
-        
-df_scans.to_csv(scans_metadata_csv, index = False)    
-valid_indices = [x for x in scans_indices if x not in to_remove]
-#*****************************************************************
 #*****************************************************************
+#********* Get the metadata at the scan and nodule level *********
 #*****************************************************************
+#Rows are written to the output files as soon as they are available
+with open(scans_metadata_csv, 'w', newline = '') as scans_file,\
+     open(nodules_metadata_csv, 'w', newline = '') as nodules_file:
 
-#*****************************************************************
-#************ Get the metadata at the nodule level ***************
-#*****************************************************************  
-#Get the list of the selected CT scans
-patient_population = pd.read_csv('cache/scans_metadata.csv')
-selected_scans = patient_population['patient_id'].tolist()
+    scans_writer = csv.DictWriter(scans_file, fieldnames = scans_columns)
+    nodules_writer = csv.DictWriter(nodules_file, fieldnames = nodules_columns)
+    scans_writer.writeheader()
+    nodules_writer.writeheader()
+
+    for scan, additional_scan_metadata in zip(scans,
+                                              additional_scans_metadata):
 
-#Iterate through the scans
-for patient_id in selected_scans:
-    
-    scan = pl.query(pl.Scan).filter(pl.Scan.patient_id == patient_id).first()
+        #Skip scans with incomplete metadata about gender/age
+        if None in additional_scan_metadata.values():
+            continue
 
-    #Get all the nodules within this scan
-    nodules = scan.cluster_annotations(verbose = False)
-    
-    #Iterate through the nodules
-    num_nodules = len(nodules)
-    for n in range(num_nodules):
-               
-        #Current nodule
-        nodule = nodules[n]
-        
-        #Iterate through the annotations for the current nodule and get the 
-        #corresponding signals and masks
-        annotations = list(range(len(nodule)))
-        annotation_record = OrderedDict({'patient_id' : patient_id,
-                                         'nodule_id' : n,
-                                         'num_annotations' : len(annotations)})
-        for idx_ann, ann in enumerate(annotations): 
-            
-            print(f'Reading metadata of scan {scan.patient_id}, '
-                  f'nodule {n}, annotation_id {idx_ann}')
-            
-            annotation_record.update(OrderedDict(
-                {'annotation_id' : idx_ann,
-                 'subtlety' : nodule[ann].subtlety,
-                 'internal_structure' : nodule[ann].internalStructure,
-                 'calcification' : nodule[ann].calcification,
-                 'sphericity' : nodule[ann].sphericity,
-                 'margin' : nodule[ann].margin,
-                 'lobulation' : nodule[ann].lobulation,
-                 'spiculation' : nodule[ann].spiculation,
-                 'texture' : nodule[ann].texture,
-                 'malignancy' : nodule[ann].malignancy}
-            ))
-            if df_nodules is None:
-                column_names = list(annotation_record.keys())
-                df_nodules = pd.DataFrame(columns = column_names)
-            else:
-                df_nodules = df_nodules.append(annotation_record, 
-                                               ignore_index = True)
+        print(f'Reading metadata of scan {scan.patient_id}')
 
-df_nodules.to_csv(nodules_metadata_csv, index = False) 
\ No newline at end of file
+        #Get the metadata accessible through the pylidc interface
+        scan_metadata = OrderedDict(
+            {'patient_id' : scan.patient_id,
+             'pixel_spacing' : scan.pixel_spacing,
+             'slice_thickness' : scan.slice_thickness,
+             'slice_spacing' : scan.slice_spacing}
+        )
+        scan_metadata.update(additional_scan_metadata)
+        scans_writer.writerow(scan_metadata)
+
+        #Get all the nodules within this scan
+        nodules = scan.cluster_annotations(verbose = False)
+
+        #Iterate through the nodules and the corresponding annotations
+        for n, nodule in enumerate(nodules):
+            for idx_ann, annotation in enumerate(nodule):
+                nodules_writer.writerow(OrderedDict(
+                    {'patient_id' : scan.patient_id,
+                     'nodule_id' : n,
+                     'num_annotations' : len(nodule),
+                     'annotation_id' : idx_ann,
+                     'subtlety' : annotation.subtlety,
+                     'internal_structure' : annotation.internalStructure,
+                     'calcification' : annotation.calcification,
+                     'sphericity' : annotation.sphericity,
+                     'margin' : annotation.margin,
+                     'lobulation' : annotation.lobulation,
+                     'spiculation' : annotation.spiculation,
+                     'texture' : annotation.texture,
+                     'malignancy' : annotation.malignancy}
+                ))
+#*****************************************************************
+#*****************************************************************
+#*****************************************************************
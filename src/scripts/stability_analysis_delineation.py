@@ -2,8 +2,10 @@
 import numpy as np
 import pandas as pd
 
-from functions import grade_stability, avg_smape
-from utilities import DBDriver
+from stability import arrange_ratings, bootstrap_stability, \
+    cached_avg_smape, grade_stability, icc, stability_grades
+from utilities import DBDriver, ParquetFeatureStore, settings_fingerprint, \
+    StatisticsCache
 
 #Number of requested observers (different lesion delineations) for each nodule
 num_requested_annotations = 4
@@ -14,13 +16,47 @@ noise_scale = 0.0
 #Number of discretization levels at which the analysis is performed
 num_levels = 256
 
-#Get the feature database
+#CT window (lower and upper bound in HU) at which the analysis is performed
+ct_window = (-583, 137)
+
+#Intraclass correlation coefficients computed (see stability.icc())
+icc_types = ['ICC(2,1)', 'ICC(3,1)']
+
+#Number of bootstrap resamples of the nodules used for estimating the
+#confidence interval of the average SMAPE and the probability of each
+#stability grade
+num_bootstrap_resamples = 10000
+
+#Get the feature database. Query results are kept in memory (at most
+#read_cache_size entries), so that the ids and values read again during the 
+#analysis (or when re-running parts of it interactively) are not re-queried
 db_file = 'cache/features.db'
-db_driver = DBDriver.generate_from_file(db_file)
+read_cache_size = 4096
+
+#Read the feature values from the Parquet dataset exported by 
+#compute_features.py instead (only the columns needed are read; requires 
+#pyarrow). None to read from the database.
+parquet_dataset = None
+
+#Backend the features were computed with (same as in compute_features.py)
+backend = 'pyradiomics'
+
+#Only the values computed with the current extraction settings are analysed
+#(see stale_results.py for those still to be recomputed)
+if parquet_dataset is None:
+    db_driver = DBDriver.generate_from_file(
+        db_file, cache_size = read_cache_size, 
+        fingerprint = settings_fingerprint(backend = backend))
+else:
+    db_driver = ParquetFeatureStore(parquet_dataset)
 
 #Store the results of the stability analysis here
 out_file = 'cache/stability_against_delineation.csv'
 
+#Cache of the SMAPE values by feature and nodule (only the values that are 
+#new or whose feature values have changed are computed at each run)
+statistics_cache = 'cache/stability_statistics.db'
+
 #Get the list of patients IDs
 patient_ids = db_driver.get_patients_ids()
 
@@ -43,26 +79,31 @@ for patient_id in patient_ids:
 #Get the list of the features available
 available_features = db_driver.get_feature_names()
 
-#Iterate through the available features and compute the icc for each of them
-for feature_name in available_features:
-    
-    smape_all_nodules = list()
-       
-    for selected_nodule_id, selected_nodule in enumerate(selected_nodules):
-        patient_id = selected_nodule['patient_id']
-        nodule_id = selected_nodule['nodule_id']
-        
-        feature_values_by_delineation = db_driver.get_feature_values_by_annotation(
-            patient_id, nodule_id, feature_name, num_levels, noise_scale)
-        
-        #Compute the average relative variation by nodule and append it to 
-        #the list
-        smape_this_nodule = avg_smape(feature_values_by_delineation)
-        smape_all_nodules.append(smape_this_nodule)        
+#Arrange the feature values into a (features x nodules x annotations) array
+values, coords = db_driver.get_feature_matrix(
+    feature_names = available_features, 
+    filters = {'num_levels' : num_levels, 'noise_scale' : noise_scale,
+               'window_lower' : ct_window[0], 'window_upper' : ct_window[1]})
+subjects = [(selected_nodule['patient_id'], selected_nodule['nodule_id']) 
+            for selected_nodule in selected_nodules]
+ratings = arrange_ratings(
+    values, coords, subjects = subjects, rater_column = 'annotation_id', 
+    raters = list(range(num_requested_annotations)))
+
+#Compute the average relative variation by feature and nodule (only those 
+#not in the cache or whose feature values have changed)
+smape_values = cached_avg_smape(
+    ratings, subjects, available_features, 
+    cache = StatisticsCache(statistics_cache), 
+    analysis = f'delineation/num_levels={num_levels}/'
+               f'noise_scale={noise_scale}/window={ct_window}')
 
+#Iterate through the available features and aggregate the SMAPE for each of 
+#them
+for f, feature_name in enumerate(available_features):
     
     #Compute the average relative variation for the whole population
-    avg_smape_population = np.mean(smape_all_nodules)
+    avg_smape_population = np.mean(smape_values[f])
     
     print(f'Feature: {feature_name}; '
           f'Average SMAPE: {avg_smape_population:.2f}%')
@@ -75,6 +116,25 @@ for feature_name in available_features:
     
     df_delineation_stability = df_delineation_stability.append(results_row, 
                                                    ignore_index = True)
+
+#Confidence intervals of the average SMAPE and probability of each stability
+#grade
+lower_bounds, upper_bounds, grade_probabilities = bootstrap_stability(
+    smape_values, num_resamples = num_bootstrap_resamples, seed = 0)
+df_delineation_stability['avg_smape_ci_lower'] = lower_bounds
+df_delineation_stability['avg_smape_ci_upper'] = upper_bounds
+for g, grade in enumerate(stability_grades.keys()):
+    df_delineation_stability[f'p_{grade}'] = grade_probabilities[:, g]
+
+#Compute the intraclass correlation coefficients of all the features at once 
+for icc_type in icc_types:
+    icc_values, lower_bounds, upper_bounds = icc(ratings, icc_type)
+    column = icc_type.lower().replace('(', '_').replace(',', '_').\
+        replace(')', '')
+    df_delineation_stability[column] = icc_values
+    df_delineation_stability[column + '_ci_lower'] = lower_bounds
+    df_delineation_stability[column + '_ci_upper'] = upper_bounds
+    
 df_delineation_stability.to_csv(out_file, index = False)
             
     
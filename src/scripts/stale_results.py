@@ -0,0 +1,50 @@
+"""Report the results in the feature database that are stale under the
+current extraction settings (see utilities.settings_fingerprint())"""
+import pandas as pd
+
+from utilities import DBDriver, settings_fingerprint
+
+#*******************************************************************************
+#**************************** Parameters ***************************************
+#*******************************************************************************
+#The feature database
+cache_folder = 'cache'
+feature_db = cache_folder + '/features.db'
+
+#Store the list of the stale experimental conditions here
+out_file = cache_folder + '/stale_conditions.csv'
+
+#Tag the results with no fingerprint recorded (computed before the settings
+#were tracked) with the current one instead of reporting them as stale. Set
+#this only if these results are known to come from the current settings.
+tag_untagged = False
+
+#Backend used for computing the features (same as in compute_features.py)
+backend = 'pyradiomics'
+#*******************************************************************************
+#*******************************************************************************
+#*******************************************************************************
+
+fingerprint = settings_fingerprint(backend = backend)
+db_driver = DBDriver.generate_from_file(feature_db, fingerprint = fingerprint)
+print(f'Current settings fingerprint: {fingerprint}')
+
+if tag_untagged:
+    num_rows = db_driver.tag_untagged_results()
+    print(f'Tagged {num_rows} rows with the current settings fingerprint')
+
+#Number of stale rows by table and stored fingerprint
+for table, counts in db_driver.count_stale_results().items():
+    print(f'{table}: {sum(counts.values())} stale rows')
+    for stored_fingerprint, num_rows in counts.items():
+        if stored_fingerprint is None:
+            stored_fingerprint = 'unknown'
+        print(f'    {stored_fingerprint}: {num_rows}')
+
+#Stale experimental conditions (recomputed by the next run of
+#compute_features.py)
+df_stale = pd.DataFrame(
+    db_driver.get_stale_conditions(),
+    columns = list(DBDriver._key_columns.keys()) + ['settings_fingerprint'])
+df_stale.to_csv(out_file, index = False)
+print(f'{len(df_stale)} stale experimental conditions written to {out_file}')
@@ -0,0 +1,462 @@
+"""Statistical analysis of the feature values (stability against 
+delineation, resampling and noise). Only depends on NumPy (and SciPy for the
+ICC confidence intervals), so that the analysis scripts do not need the 
+imaging packages."""
+import hashlib
+import warnings
+
+from collections import OrderedDict
+from itertools import permutations
+
+import numpy as np
+
+#Qualitative stability labels and corresponding upper bounds of the average 
+#SMAPE (see grade_stability())
+stability_grades = OrderedDict({'excellent' : 5.0,
+                                'good' : 10.0,
+                                'moderate' : 20.0,
+                                'poor' : np.inf})
+
+def grade_stability(avg_smape):
+    """Qualitative label for the average symmetric mean absolute percentage 
+    error (SMAPE).
+    
+    Parameters
+    ----------
+    avg_smape : float (> 0)
+        The average absolute relative difference.
+    
+    Returns
+    -------
+    qualitative_label : str
+        The qualitative label for the given average SMAPE. Can be: 'poor', 
+        'moderate', 'good' or 'excellent' (see stability_grades)
+    """
+    
+    qualitative_label = None
+    
+    for label, upper_bound in stability_grades.items():
+        if avg_smape <= upper_bound:
+            qualitative_label = label
+            break
+    
+    return qualitative_label
+
+def smape(a, f):
+    """Symmetric mean absolute percentage error (SMAPE). Based on the formula
+    on page 406 of [1], but with the factor '2' at the denominator removed
+    so as to have results bounded in [0,100].
+    
+    Parameters
+    ----------
+    a : iterable of numerics
+        The actual (target) values.
+    f : iterable of numerics
+        The forecasted (predicted) values.
+    NOTE: a and f must have the same length.
+        
+    Returns
+    -------
+    smape_value : float
+        The error value.
+        
+    References
+    ----------
+    Goodwin, P., Lawton, R. On the asymmetry of the symmetric MAPE (1999) 
+    International Journal of Forecasting, 15 (4), pp. 405-408.
+    """
+    
+    smape_value = 0.0
+    
+    if len(a) != len(f):
+        raise Exception('The actual and forecasted values must have the '
+                        'same length')    
+    
+    #Remove zero values to avoid NaN
+    nonzero_a_f = np.intersect1d(a.nonzero(), f.nonzero())
+    if len(nonzero_a_f) > 0:
+        a = a[nonzero_a_f]
+        f = f[nonzero_a_f]
+        smape_value = 1/len(a) *\
+            np.sum(np.abs(f-a) / (np.abs(a) + np.abs(f))*100)
+    else:
+        warnings.warn(f"SMAPE: no non-zero values in the input arrays, " +\
+                      f"returning default value ({smape_value})")
+    return smape_value
+
+def avg_smape(values):
+    """Average symmetric mean absolute percentage error over an array of
+    values. The values ideally represent the results of repeated mesurements
+    on the same subject.
+    
+    Parameters
+    ----------
+    values : iterable of numerics.
+       The input values.
+       
+    Returns
+    -------
+    avg_smape : float
+       The average SMAPE.
+    """
+    
+    #Get all the pairwise combinations (order matters) and consider the first
+    #element as the target and the second as the forecast
+    indices = list(range(len(values)))
+    combs = permutations(indices, 2)
+    targets = list()
+    forecasts = list()
+    for comb in combs:
+        targets.append(values[comb[0]])
+        forecasts.append(values[comb[1]])
+        
+    avg_smape = smape(np.asarray(targets), np.asarray(forecasts))
+    return avg_smape
+
+def arrange_ratings(values, coords, subjects, rater_column, raters):
+    """Arranges the feature values returned by DBDriver.get_feature_matrix()
+    into a (features x subjects x raters) array. Subjects are the nodules 
+    (patient_id, nodule_id) and raters the values of one of the other key
+    columns (e.g. annotation_id for inter-observer or num_levels for 
+    inter-level agreement).
+    
+    Parameters
+    ----------
+    values : nparray of float (rows x features)
+        The feature values.
+    coords : dict of nparray
+        The key columns of each row of values.
+    subjects : list of tuple (patient_id, nodule_id)
+        The subjects to include.
+    rater_column : str
+        The key column that identifies the rater.
+    raters : list
+        The values of rater_column to include.
+    
+    Returns
+    -------
+    ratings : nparray of float (features x subjects x raters)
+        The feature values. NaN where the database contains no value for 
+        a combination of subject and rater. Rows of values not matching any
+        subject or rater are ignored.
+    """
+    
+    subject_index = {subject : s for s, subject in enumerate(subjects)}
+    rater_index = {rater : r for r, rater in enumerate(raters)}
+    
+    ratings = np.full((values.shape[1], len(subjects), len(raters)), np.nan)
+    for row, (patient_id, nodule_id, rater) in enumerate(
+        zip(coords['patient_id'], coords['nodule_id'], coords[rater_column])):
+        s = subject_index.get((patient_id, nodule_id))
+        r = rater_index.get(rater)
+        if (s is not None) and (r is not None):
+            ratings[:, s, r] = values[row]
+    return ratings
+
+def icc(ratings, icc_type = 'ICC(2,1)', confidence = 0.95):
+    """Intraclass correlation coefficient (ICC) of each feature, computed 
+    from the two-way ANOVA mean squares of all the features at once. Uses the
+    definitions and confidence intervals of Shrout and Fleiss [1] (also 
+    in McGraw and Wong [2]).
+    
+    Parameters
+    ----------
+    ratings : nparray of float (features x subjects x raters)
+        The values of each feature for each subject (e.g. nodule) and rater 
+        (e.g. annotation or number of quantisation levels).
+    icc_type : str
+        The ICC form. Can be:
+            'ICC(2,1)' -> two-way random effects, absolute agreement, single
+                          rater;
+            'ICC(3,1)' -> two-way mixed effects, consistency, single rater.
+    confidence : float (in (0,1))
+        The confidence level of the intervals.
+    
+    Returns
+    -------
+    icc_values : nparray of float (features)
+        The ICC of each feature. NaN for features with missing values 
+        (NaN in ratings) or with no variance at all.
+    lower_bounds, upper_bounds : nparray of float (features)
+        The bounds of the confidence intervals.
+        
+    References
+    ----------
+    [1] Shrout, P.E., Fleiss, J.L. Intraclass correlations: uses in 
+        assessing rater reliability (1979) Psychological Bulletin, 86 (2), 
+        pp. 420-428.
+    [2] McGraw, K.O., Wong, S.P. Forming inferences about some intraclass 
+        correlation coefficients (1996) Psychological Methods, 1 (1), 
+        pp. 30-46.
+    """
+    
+    #Imported here to keep the import of this module fast
+    from scipy.stats import f as f_distribution
+    
+    ratings = np.asarray(ratings, dtype = np.float64)
+    if ratings.ndim != 3:
+        raise Exception('The ratings must be a (features x subjects x raters) '
+                        'array')
+    _, n, k = ratings.shape
+    if (n < 2) or (k < 2):
+        raise Exception('At least two subjects and two raters are required')
+    
+    #Two-way ANOVA: sums of squares between subjects (rows), between raters 
+    #(columns) and residual 
+    grand_mean = np.mean(ratings, axis = (1, 2), keepdims = True)
+    subject_means = np.mean(ratings, axis = 2, keepdims = True)
+    rater_means = np.mean(ratings, axis = 1, keepdims = True)
+    ss_total = np.sum((ratings - grand_mean)**2, axis = (1, 2))
+    ss_subjects = k * np.sum((subject_means - grand_mean)**2, axis = (1, 2))
+    ss_raters = n * np.sum((rater_means - grand_mean)**2, axis = (1, 2))
+    ss_error = ss_total - ss_subjects - ss_raters
+    
+    #Mean squares
+    df_subjects = n - 1
+    df_raters = k - 1
+    df_error = (n - 1) * (k - 1)
+    ms_subjects = ss_subjects / df_subjects
+    ms_raters = ss_raters / df_raters
+    ms_error = ss_error / df_error
+    
+    alpha = 1.0 - confidence
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        if icc_type == 'ICC(2,1)':
+            icc_values = (ms_subjects - ms_error) /\
+                (ms_subjects + (k - 1) * ms_error + 
+                 k * (ms_raters - ms_error) / n)
+            
+            #Approximate degrees of freedom (Satterthwaite)
+            f_raters = ms_raters / ms_error
+            c = n * (1 + (k - 1) * icc_values) - k * icc_values
+            v = df_error * (k * icc_values * f_raters + c)**2 /\
+                (df_subjects * (k * icc_values * f_raters)**2 + c**2)
+            f_upper = f_distribution.ppf(1 - alpha/2, df_subjects, v)
+            f_lower = f_distribution.ppf(1 - alpha/2, v, df_subjects)
+            lower_bounds = n * (ms_subjects - f_upper * ms_error) /\
+                (f_upper * (k * ms_raters + (k * n - k - n) * ms_error) +
+                 n * ms_subjects)
+            upper_bounds = n * (f_lower * ms_subjects - ms_error) /\
+                (k * ms_raters + (k * n - k - n) * ms_error + 
+                 n * f_lower * ms_subjects)
+        elif icc_type == 'ICC(3,1)':
+            icc_values = (ms_subjects - ms_error) /\
+                (ms_subjects + (k - 1) * ms_error)
+            f_subjects = ms_subjects / ms_error
+            f_lower = f_subjects /\
+                f_distribution.ppf(1 - alpha/2, df_subjects, df_error)
+            f_upper = f_subjects *\
+                f_distribution.ppf(1 - alpha/2, df_error, df_subjects)
+            lower_bounds = (f_lower - 1) / (f_lower + k - 1)
+            upper_bounds = (f_upper - 1) / (f_upper + k - 1)
+        else:
+            raise Exception(f'ICC type {icc_type} not supported')
+    
+    return icc_values, lower_bounds, upper_bounds
+
+def fingerprint(values):
+    """Digest of an array of values, used to detect when statistics computed
+    from these need to be updated.
+    
+    Parameters
+    ----------
+    values : iterable of float
+        The values (NaN for missing ones).
+    
+    Returns
+    -------
+    digest : str
+        The hexadecimal digest.
+    """
+    values = np.ascontiguousarray(values, dtype = np.float64)
+    return hashlib.blake2b(values.tobytes(), digest_size = 16).hexdigest()
+
+def cached_avg_smape(ratings, subjects, feature_names, cache, analysis):
+    """Average SMAPE (see avg_smape()) of each feature on each subject. Only 
+    the values not in the cache or whose input values have changed since 
+    they were stored are computed; these are then stored in the cache.
+    
+    Parameters
+    ----------
+    ratings : nparray of float (features x subjects x raters)
+        The feature values, as returned by arrange_ratings().
+    subjects : list of tuple (patient_id, nodule_id)
+        The subjects (second dimension of ratings).
+    feature_names : list of str
+        The feature names (first dimension of ratings).
+    cache : StatisticsCache
+        The cache where the values are stored.
+    analysis : str
+        Identifier of the analysis and of its settings in the cache.
+    
+    Returns
+    -------
+    smape_values : nparray of float (features x subjects)
+        The average SMAPE of each feature on each subject.
+    """
+    
+    cached = cache.read(analysis)
+    smape_values = np.empty(ratings.shape[:2])
+    to_store = list()
+    for f, feature_name in enumerate(feature_names):
+        for s, (patient_id, nodule_id) in enumerate(subjects):
+            values = ratings[f, s]
+            digest = fingerprint(values)
+            key = (feature_name, patient_id, nodule_id)
+            if (key in cached) and (cached[key][0] == digest):
+                value = cached[key][1]
+                smape_values[f, s] = np.nan if value is None else value
+            else:
+                smape_values[f, s] = avg_smape(values)
+                to_store.append(key + (digest, smape_values[f, s]))
+    
+    if len(to_store) > 0:
+        cache.write(analysis, to_store)
+    return smape_values
+
+def bootstrap_stability(smape_values, num_resamples = 10000, 
+                        confidence = 0.95, chunk_size = 1000, seed = None):
+    """Bootstrap estimate of the uncertainty of the population average SMAPE
+    of each feature and of the corresponding stability grade. The nodules 
+    are resampled with replacement; the averages of each chunk of resamples
+    are computed for all the features at once as a product between the 
+    SMAPE values and the (resamples x nodules) matrix of the number of times
+    each nodule is drawn.
+    
+    Parameters
+    ----------
+    smape_values : nparray of float (features x nodules)
+        The average SMAPE of each feature on each nodule (see 
+        cached_avg_smape()).
+    num_resamples : int (> 0)
+        The number of bootstrap resamples.
+    confidence : float (in (0,1))
+        The confidence level of the intervals (percentile method).
+    chunk_size : int (> 0)
+        The number of resamples generated at once. Bounds the memory used 
+        (chunk_size x nodules counts).
+    seed : int
+        Seed of the random generator (for reproducible results).
+    
+    Returns
+    -------
+    lower_bounds, upper_bounds : nparray of float (features)
+        The bounds of the confidence intervals of the population average 
+        SMAPE.
+    grade_probabilities : nparray of float (features x grades)
+        The fraction of resamples in which the average SMAPE falls into each
+        of the stability_grades (same order). NaN for features with 
+        missing values.
+    """
+    
+    smape_values = np.asarray(smape_values, dtype = np.float64)
+    num_features, num_nodules = smape_values.shape
+    rng = np.random.default_rng(seed)
+    
+    #Average SMAPE of each feature on each resample
+    averages = np.empty((num_features, num_resamples))
+    for start in range(0, num_resamples, chunk_size):
+        stop = min(start + chunk_size, num_resamples)
+        counts = rng.multinomial(num_nodules, 
+                                 np.full(num_nodules, 1.0/num_nodules), 
+                                 size = stop - start)
+        averages[:, start:stop] = smape_values @ counts.T / num_nodules
+    
+    #Percentile confidence intervals
+    alpha = 1.0 - confidence
+    lower_bounds, upper_bounds = np.percentile(
+        averages, [100 * alpha/2, 100 * (1 - alpha/2)], axis = 1)
+    
+    #Fraction of resamples by stability grade
+    upper_bounds_by_grade = list(stability_grades.values())[:-1]
+    grades = np.digitize(averages, upper_bounds_by_grade, right = True)
+    grade_probabilities = np.stack(
+        [np.mean(grades == g, axis = 1) for g in range(len(stability_grades))],
+        axis = 1)
+    grade_probabilities[np.isnan(averages).any(axis = 1)] = np.nan
+    
+    return lower_bounds, upper_bounds, grade_probabilities
+
+class RunningStatistics():
+    """Statistics of a set of features over repeated measurements (e.g. noise
+    replicates) accumulated one measurement at a time: mean and variance 
+    (Welford's algorithm) and average SMAPE over all the pairs of 
+    measurements (see avg_smape()). Each new measurement is compared with 
+    the previous ones, which are kept in memory for this purpose only.
+    
+    Attributes
+    ----------
+    count : int
+        The number of measurements accumulated.
+    mean : nparray of float (features)
+        The mean of each feature.
+    variance : nparray of float (features)
+        The sample variance of each feature (NaN if count < 2).
+    avg_smape : nparray of float (features)
+        The average SMAPE of each feature over all the pairs of measurements
+        (pairs where any of the two values is zero are excluded; 0.0 if no
+        pair is left).
+    """
+    
+    def update(self, values):
+        """Adds one measurement.
+        
+        Parameters
+        ----------
+        values : iterable of float (features)
+            The feature values.
+        """
+        values = np.asarray(values, dtype = np.float64)
+        
+        #Welford's update of the mean and of the sum of squared deviations
+        self.count += 1
+        delta = values - self._mean
+        self._mean += delta / self.count
+        self._m2 += delta * (values - self._mean)
+        
+        #SMAPE between the current measurement and each of the previous ones
+        if self.count > 1:
+            previous = self._previous[:self.count - 1]
+            both_nonzero = (previous != 0) & (values != 0)
+            with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                terms = np.abs(previous - values) /\
+                    (np.abs(previous) + np.abs(values)) * 100
+            self._smape_sum += np.sum(np.where(both_nonzero, terms, 0.0), 
+                                      axis = 0)
+            self._smape_count += np.sum(both_nonzero, axis = 0)
+        
+        #Store the measurement (the buffer grows geometrically)
+        if self.count > self._previous.shape[0]:
+            self._previous = np.concatenate(
+                [self._previous, np.empty_like(self._previous)])
+        self._previous[self.count - 1] = values
+    
+    @property
+    def mean(self):
+        return self._mean.copy()
+    
+    @property
+    def variance(self):
+        if self.count < 2:
+            return np.full(self._m2.shape, np.nan)
+        return self._m2 / (self.count - 1)
+    
+    @property
+    def avg_smape(self):
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            return np.where(self._smape_count > 0, 
+                            self._smape_sum / self._smape_count, 0.0)
+    
+    def __init__(self, num_features):
+        """
+        Parameters
+        ----------
+        num_features : int
+            The number of features.
+        """
+        self.count = 0
+        self._mean = np.zeros(num_features)
+        self._m2 = np.zeros(num_features)
+        self._smape_sum = np.zeros(num_features)
+        self._smape_count = np.zeros(num_features, dtype = np.int64)
+        self._previous = np.empty((16, num_features))
@@ -0,0 +1,305 @@
+"""Bulk queries and batched writes on the feature database"""
+import os
+import sqlite3
+import tempfile
+
+import numpy as np
+import pytest
+
+from stability import RunningStatistics
+from utilities import DBDriver, ParquetFeatureStore, settings_fingerprint, \
+    WriteBehindDBDriver
+
+feature_names = ['firstorder/Entropy', 'firstorder/IQR', 'glcm/Contrast']
+
+def _populate(db_driver):
+    for p, patient_id in enumerate(['AA-00', 'AB-00']):
+        for annotation_id in [-1, 0, 1]:
+            for num_levels in [32, 64]:
+                for f, feature_name in enumerate(feature_names):
+                    if (patient_id, f) == ('AB-00', 2):
+                        continue
+                    db_driver.write_feature_value(
+                        patient_id, 0, annotation_id, num_levels, 0.0,
+                        feature_name,
+                        100 * p + 10 * annotation_id + num_levels + f)
+
+def test_get_feature_matrix():
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        db_driver = DBDriver(feature_names = feature_names,
+                             db_file = os.path.join(tmp_folder, 'features.db'))
+        _populate(db_driver)
+
+        values, coords = db_driver.get_feature_matrix()
+        assert values.shape == (12, 3)
+        assert list(coords.keys()) == ['patient_id', 'nodule_id',
+                                       'annotation_id', 'num_levels',
+                                       'noise_scale', 'window_lower',
+                                       'window_upper']
+
+        values, coords = db_driver.get_feature_matrix(
+            feature_names = ['glcm/Contrast', 'firstorder/Entropy'],
+            filters = {'annotation_id' : -1, 'num_levels' : [np.int64(64)]})
+        assert values.shape == (2, 2)
+        assert list(coords['patient_id']) == ['AA-00', 'AB-00']
+        assert np.array_equal(values[0], [-10 + 64 + 2, -10 + 64])
+        assert np.isnan(values[1, 0])
+        assert values[1, 1] == db_driver.read_feature_value(
+            'AB-00', 0, -1, 64, 0.0, 'firstorder/Entropy')
+
+def test_window():
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        db_file = os.path.join(tmp_folder, 'features.db')
+
+        #Table created before the window was part of the condition
+        connection = sqlite3.connect(db_file)
+        connection.execute("CREATE TABLE features (patient_id text, "
+                           "nodule_id integer, annotation_id integer, "
+                           "num_levels integer, noise_scale real, "
+                           "firstorder_Entropy real)")
+        connection.execute("INSERT INTO features VALUES "
+                           "('AA-00', 0, -1, 32, 0.0, 1.0)")
+        connection.commit()
+        connection.close()
+
+        db_driver = DBDriver(feature_names = feature_names[:1],
+                             db_file = db_file)
+        assert db_driver.read_feature_value(
+            'AA-00', 0, -1, 32, 0.0, 'firstorder/Entropy',
+            window = DBDriver.default_window) == 1.0
+        assert db_driver.read_feature_value(
+            'AA-00', 0, -1, 32, 0.0, 'firstorder/Entropy',
+            window = (-1000, 400)) is None
+        db_driver.write_feature_value('AA-00', 0, -1, 32, 0.0,
+                                      'firstorder/Entropy', 2.0,
+                                      window = (-1000, 400))
+        assert db_driver.read_feature_value(
+            'AA-00', 0, -1, 32, 0.0, 'firstorder/Entropy') == 1.0
+        assert db_driver.get_missing_features(
+            'AA-00', 0, -1, 32, 0.0, ['firstorder/Entropy'],
+            window = (-1000, 400)) == []
+
+        values, coords = db_driver.get_feature_matrix(
+            filters = {'window_lower' : -1000.0})
+        assert values.shape == (1, 1) and values[0, 0] == 2.0
+        assert list(db_driver.get_feature_matrix()[1]['window_upper']) == \
+            [400.0, 137.0]
+
+def test_write_behind():
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        db_file = os.path.join(tmp_folder, 'features.db')
+        db_driver = WriteBehindDBDriver(feature_names = feature_names,
+                                        db_file = db_file, batch_size = 5,
+                                        flush_interval = 60.0)
+        _populate(db_driver)
+
+        #Pending values are visible before being committed
+        assert db_driver.read_feature_value(
+            'AB-00', 0, 1, 64, 0.0, 'firstorder/IQR') == 100 + 10 + 64 + 1
+        assert db_driver.resolve_feature_value(
+            'AA-00', 0, -1, 'glcm/Contrast') in [-10 + 32 + 2, -10 + 64 + 2]
+
+        #Aggregate reads commit the pending values first
+        values, _ = db_driver.get_feature_matrix()
+        assert values.shape == (12, 3)
+        db_driver.write_feature_value('AA-00', 0, 0, 32, 0.0,
+                                      'firstorder/IQR', -1.0)
+        db_driver.close()
+
+        db_driver = DBDriver.generate_from_file(db_file)
+        assert db_driver.read_feature_value(
+            'AA-00', 0, 0, 32, 0.0, 'firstorder/IQR') == -1.0
+        assert db_driver.read_feature_value(
+            'AB-00', 0, 1, 64, 0.0, 'firstorder/IQR') == 100 + 10 + 64 + 1
+
+def test_add_missing_columns():
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        db_file = os.path.join(tmp_folder, 'features.db')
+        db_driver = DBDriver(feature_names = feature_names[:2],
+                             db_file = db_file)
+        db_driver.write_feature_value('AA-00', 0, -1, 32, 0.0,
+                                      'firstorder/IQR', 1.0)
+        db_driver.close()
+
+        #Requesting a new feature adds the column and keeps the values
+        db_driver = DBDriver(feature_names = feature_names, db_file = db_file)
+        assert db_driver.read_feature_value(
+            'AA-00', 0, -1, 32, 0.0, 'firstorder/IQR') == 1.0
+        assert db_driver.read_feature_value(
+            'AA-00', 0, -1, 32, 0.0, 'glcm/Contrast') is None
+        db_driver.write_feature_value('AA-00', 0, -1, 32, 0.0,
+                                      'glcm/Contrast', 2.0)
+        assert DBDriver.generate_from_file(db_file).get_feature_names() == \
+            feature_names
+
+def test_commit_busy():
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        db_file = os.path.join(tmp_folder, 'features.db')
+        db_driver = DBDriver(feature_names = feature_names, db_file = db_file,
+                             journal_mode = 'DELETE', busy_timeout = 0.05,
+                             max_retries = 1)
+
+        #An open reader makes COMMIT busy (rollback journal)
+        reader = sqlite3.connect(db_file, isolation_level = None)
+        reader.execute("BEGIN")
+        reader.execute("SELECT * FROM features").fetchall()
+        with pytest.raises(sqlite3.OperationalError):
+            db_driver.write_feature_value('AA-00', 0, -1, 32, 0.0,
+                                          'firstorder/IQR', 1.0)
+        assert not db_driver._connection.in_transaction
+        reader.execute("ROLLBACK")
+        reader.close()
+
+        db_driver.write_feature_value('AA-00', 0, -1, 32, 0.0,
+                                      'firstorder/IQR', 1.0)
+        assert db_driver.read_feature_value(
+            'AA-00', 0, -1, 32, 0.0, 'firstorder/IQR') == 1.0
+
+def test_open_while_writing():
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        db_file = os.path.join(tmp_folder, 'features.db')
+        DBDriver(feature_names = feature_names, db_file = db_file)
+
+        #Opening an up-to-date database does not wait for the writers
+        writer = sqlite3.connect(db_file, isolation_level = None)
+        writer.execute("BEGIN IMMEDIATE")
+        db_driver = DBDriver.generate_from_file(db_file, busy_timeout = 0.0,
+                                                max_retries = 0)
+        assert db_driver.get_feature_names() == feature_names
+        writer.execute("ROLLBACK")
+        writer.close()
+
+def test_noise_statistics():
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        db_driver = DBDriver(feature_names = feature_names,
+                             db_file = os.path.join(tmp_folder, 'features.db'))
+        statistics = RunningStatistics(len(feature_names))
+        for values in [[1.0, 2.0, 3.0], [2.0, 2.0, 5.0]]:
+            statistics.update(values)
+        assert db_driver.get_num_noise_replicates(
+            'AA-00', 0, -1, 64, 2.5, feature_names) == 0
+        db_driver.write_noise_statistics('AA-00', 0, -1, 64, 2.5,
+                                         feature_names, statistics)
+        assert db_driver.get_num_noise_replicates(
+            'AA-00', 0, -1, 64, 2.5, feature_names) == 2
+        rows = db_driver.get_noise_statistics(-1, 64, 2.5)
+        assert [row[2] for row in rows] == feature_names
+        assert np.allclose(rows[0][3:], (2, 1.5, 0.5, 100 / 3))
+
+def test_read_cache():
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        db_driver = DBDriver(feature_names = feature_names,
+                             db_file = os.path.join(tmp_folder, 'features.db'),
+                             cache_size = 8)
+        _populate(db_driver)
+        for _ in range(3):
+            assert db_driver.get_nodule_ids_by_patient('AA-00') == [0]
+            assert db_driver.read_feature_value(
+                'AA-00', 0, 1, 32, 0.0, 'glcm/Contrast') == 10 + 32 + 2
+            assert db_driver.read_feature_value(
+                'AA-00', 0, 2, 32, 0.0, 'glcm/Contrast') is None
+        assert db_driver.cache_info()['hits'] == 6
+        assert db_driver.cache_info()['misses'] == 3
+
+        #Writes invalidate the affected entries only
+        db_driver.write_feature_value('AA-00', 0, 2, 32, 0.0,
+                                      'glcm/Contrast', 5.0)
+        db_driver.write_feature_value('AA-00', 1, 0, 32, 0.0,
+                                      'glcm/Contrast', 6.0)
+        assert db_driver.read_feature_value(
+            'AA-00', 0, 1, 32, 0.0, 'glcm/Contrast') == 10 + 32 + 2
+        assert db_driver.read_feature_value(
+            'AA-00', 0, 2, 32, 0.0, 'glcm/Contrast') == 5.0
+        assert db_driver.get_nodule_ids_by_patient('AA-00') == [0, 1]
+        assert db_driver.cache_info()['hits'] == 7
+
+        #Least recently used entries are evicted first
+        for annotation_id in range(10):
+            db_driver.get_feature_matrix(
+                filters = {'annotation_id' : annotation_id})
+        assert db_driver.cache_info()['size'] == 8
+        values, _ = db_driver.get_feature_matrix(
+            filters = {'annotation_id' : [np.int64(2)]})
+        values[:] = 0.0
+        values, _ = db_driver.get_feature_matrix(
+            filters = {'annotation_id' : 2})
+        assert values[0, 2] == 5.0
+        assert db_driver.cache_info()['hits'] == 9
+
+def test_parquet_export():
+    pytest.importorskip('pyarrow')
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        db_driver = DBDriver(feature_names = feature_names,
+                             db_file = os.path.join(tmp_folder, 'features.db'))
+        _populate(db_driver)
+        db_driver.write_feature_value('AA-00', 0, 0, 32, 2.5,
+                                      'glcm/Contrast', 3.0)
+        db_driver.export_parquet(os.path.join(tmp_folder, 'features'))
+        assert os.path.isfile(os.path.join(
+            tmp_folder, 'features', 'num_levels=32', 'noise_scale=2.5',
+            'features.parquet'))
+
+        store = ParquetFeatureStore(os.path.join(tmp_folder, 'features'))
+        assert store.get_feature_names() == feature_names
+        assert store.get_patients_ids() == ['AA-00', 'AB-00']
+        assert store.get_nodule_ids_by_patient('AB-00') == [0]
+        assert store.get_annotation_ids_by_nodule('AA-00', 0) == [0, 1]
+        for filters in [None, {'noise_scale' : 2.5},
+                        {'annotation_id' : -1, 'num_levels' : [64]}]:
+            for names in [None, ['glcm/Contrast']]:
+                expected = db_driver.get_feature_matrix(names, filters)
+                values, coords = store.get_feature_matrix(names, filters)
+                assert np.array_equal(values, expected[0], equal_nan = True)
+                for column, array in expected[1].items():
+                    assert np.array_equal(coords[column], array)
+                    assert coords[column].dtype == array.dtype
+
+def test_settings_fingerprint():
+    assert len(settings_fingerprint()) == 16
+    assert settings_fingerprint() == settings_fingerprint({})
+    assert settings_fingerprint({'bin_width' : 25}) != settings_fingerprint()
+    assert settings_fingerprint(backend = 'numba') != settings_fingerprint()
+
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        db_file = os.path.join(tmp_folder, 'features.db')
+        db_driver = DBDriver(feature_names = feature_names, db_file = db_file)
+        db_driver.write_feature_value('AA-00', 0, 5, 32, 0.0,
+                                      'firstorder/IQR', 1.0)
+        old_driver = DBDriver(feature_names = feature_names, db_file = db_file,
+                              fingerprint = 'old')
+        _populate(old_driver)
+        old_driver.write_roi_results('digest', {'firstorder/IQR' : 3.0})
+
+        #Values computed with other (or unknown) settings read as missing
+        new_driver = DBDriver(feature_names = feature_names, db_file = db_file,
+                              fingerprint = 'new', cache_size = 16)
+        assert new_driver.read_feature_value(
+            'AA-00', 0, 1, 32, 0.0, 'firstorder/IQR') is None
+        assert new_driver.get_missing_features(
+            'AA-00', 0, 1, 32, 0.0, feature_names) == feature_names
+        assert new_driver.read_roi_results('digest', feature_names) == {}
+        assert len(new_driver.get_stale_conditions()) == 13
+        assert new_driver.count_stale_results()['features'] == \
+            {None : 1, 'old' : 12}
+        assert new_driver.get_patients_ids() == []
+
+        #Writing under the new settings resets the stale values of the row
+        new_driver.write_feature_value('AA-00', 0, 1, 32, 0.0,
+                                       'firstorder/IQR', 2.0)
+        assert new_driver.get_missing_features(
+            'AA-00', 0, 1, 32, 0.0, feature_names) == \
+            ['firstorder/Entropy', 'glcm/Contrast']
+        assert old_driver.read_feature_value(
+            'AA-00', 0, 1, 32, 0.0, 'glcm/Contrast') is None
+        assert new_driver.get_patients_ids() == ['AA-00']
+        assert new_driver.get_nodule_ids_by_patient('AB-00') == []
+        assert new_driver.get_annotation_ids_by_nodule('AA-00', 0) == [1]
+        assert db_driver.read_feature_value(
+            'AA-00', 0, 1, 32, 0.0, 'firstorder/IQR') == 2.0
+
+        assert new_driver.tag_untagged_results() == 1
+        assert new_driver.read_feature_value(
+            'AA-00', 0, 5, 32, 0.0, 'firstorder/IQR') == 1.0
+        values, _ = new_driver.get_feature_matrix()
+        assert values.shape == (2, 3)
+        assert len(new_driver.get_stale_conditions()) == 11
@@ -0,0 +1,45 @@
+"""Intraclass correlation coefficients"""
+import numpy as np
+
+from stability import arrange_ratings, icc
+
+#Example data of Shrout and Fleiss (1979): 6 subjects rated by 4 judges
+ratings = np.array([[9, 2, 5, 8],
+                    [6, 1, 3, 2],
+                    [8, 4, 6, 8],
+                    [7, 1, 2, 6],
+                    [10, 5, 6, 9],
+                    [6, 2, 4, 7]], dtype = np.float64)
+
+def test_icc_reference_values():
+    #Reference values from the paper (ICCs) and R psych::ICC() (intervals)
+    icc_values, lower_bounds, upper_bounds = icc(ratings[np.newaxis],
+                                                 'ICC(2,1)')
+    assert np.allclose([icc_values[0], lower_bounds[0], upper_bounds[0]],
+                       [0.29, 0.019, 0.76], atol = 5e-3)
+    icc_values, lower_bounds, upper_bounds = icc(ratings[np.newaxis],
+                                                 'ICC(3,1)')
+    assert np.allclose([icc_values[0], lower_bounds[0], upper_bounds[0]],
+                       [0.71, 0.34, 0.95], atol = 5e-3)
+
+def test_icc_all_features_at_once():
+    stack = np.stack([ratings, 3 * ratings + 1,
+                      np.sqrt(ratings) + ratings[::-1]])
+    for icc_type in ['ICC(2,1)', 'ICC(3,1)']:
+        icc_values, _, _ = icc(stack, icc_type)
+        for f in range(stack.shape[0]):
+            assert np.isclose(icc_values[f], icc(stack[[f]], icc_type)[0][0])
+
+def test_arrange_ratings():
+    values = np.array([[1.0, 10.0], [2.0, 20.0], [3.0, 30.0], [4.0, 40.0]])
+    coords = {'patient_id' : np.array(['AA', 'AA', 'AB', 'AC'],
+                                      dtype = object),
+              'nodule_id' : np.array([0, 0, 1, 0]),
+              'num_levels' : np.array([32, 64, 32, 32])}
+    arranged = arrange_ratings(values, coords,
+                               subjects = [('AB', 1), ('AA', 0)],
+                               rater_column = 'num_levels', raters = [32, 64])
+    assert arranged.shape == (2, 2, 2)
+    assert np.array_equal(arranged[0], [[3.0, np.nan], [1.0, 2.0]],
+                          equal_nan = True)
+    assert np.array_equal(arranged[1, 1], [10.0, 20.0])
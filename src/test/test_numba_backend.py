@@ -0,0 +1,51 @@
+"""Compare the texture features computed through the Numba and pyradiomics
+backends on synthetic phantoms"""
+import os
+import tempfile
+
+import numpy as np
+import nrrd
+
+from functions import compute_feature_values, feature_lut
+
+#Features computed from the texture matrices replaced by the Numba backend
+feature_names = [f for f in feature_lut.keys()
+                 if f.split('/', 1)[0] in ['glrlm', 'glszm', 'gldm', 'ngtdm']]
+
+def _phantoms():
+    """Synthetic signals and masks: a quantised random cube, a sphere with
+    smooth gradient and a thin (single-slice) lesion"""
+    rng = np.random.default_rng(0)
+    phantoms = list()
+
+    signal = np.round(rng.uniform(-500, 100, size = (20, 20, 12)) / 50) * 50
+    mask = np.zeros(signal.shape, dtype = np.uint8)
+    mask[1:-1, 1:-1, 1:-1] = 1
+    phantoms.append((signal, mask))
+
+    x, y, z = np.mgrid[-12:13, -12:13, -8:9]
+    signal = 10.0 * np.round(x + 0.5 * y - z) + rng.normal(0, 5, x.shape)
+    mask = (x**2 + y**2 + (1.5*z)**2 <= 100).astype(np.uint8)
+    phantoms.append((signal, mask))
+
+    signal = rng.integers(-100, 100, size = (15, 15, 3)).astype(float)
+    mask = np.zeros(signal.shape, dtype = np.uint8)
+    mask[3:12, 4:10, 1] = 1
+    phantoms.append((signal, mask))
+    return phantoms
+
+def test_numba_backend_matches_pyradiomics():
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        path_to_image = os.path.join(tmp_folder, 'signal.nrrd')
+        path_to_mask = os.path.join(tmp_folder, 'mask.nrrd')
+        for signal, mask in _phantoms():
+            nrrd.write(path_to_image, signal)
+            nrrd.write(path_to_mask, mask)
+            reference = compute_feature_values(
+                feature_names, path_to_image, path_to_mask, bin_width = 25,
+                backend = 'pyradiomics')
+            values = compute_feature_values(
+                feature_names, path_to_image, path_to_mask, bin_width = 25,
+                backend = 'numba')
+            assert np.allclose(values, reference, rtol = 1e-6,
+                               equal_nan = True)
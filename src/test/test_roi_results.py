@@ -0,0 +1,146 @@
+"""Reuse of the feature values computed on ROIs with the same content"""
+import os
+import pickle
+import tempfile
+
+import numpy as np
+
+import functions
+from functions import CompactMask, get_feature_values, preprocess_signal, \
+    quantise_signal, roi_digest, roi_size
+from utilities import DBDriver
+
+feature_names = ['firstorder/Entropy', 'glcm/Contrast', 'shape/MaxAxialDiameter']
+
+def test_roi_digest():
+    rng = np.random.default_rng(0)
+    signal = rng.normal(size = (6, 6, 4))
+    mask = np.zeros(signal.shape, dtype = np.uint8)
+    mask[1:5, 1:5, 1:3] = 1
+    assert roi_digest(mask) == roi_digest(mask.astype(bool))
+    assert roi_digest(mask, signal) != roi_digest(mask)
+    assert roi_digest(mask, signal, {'bin_width' : 25}) != \
+        roi_digest(mask, signal, {'bin_width' : 50})
+    assert roi_digest(mask.reshape(6, 4, 6)) != roi_digest(mask)
+
+def test_roi_digest_ignores_margins():
+    rng = np.random.default_rng(0)
+    signal = rng.integers(0, 32, size = (20, 20, 12)).astype(np.uint8)
+    x, y, z = np.mgrid[-10:10, -10:10, -6:6]
+    mask = (x**2 + y**2 + (2*z)**2 <= 36)
+
+    #The same ROI on two bounding boxes with different margins
+    crops = [(slice(2, 18), slice(3, 17), slice(1, 11)),
+             (slice(0, 20), slice(1, 20), slice(2, 12))]
+    digests = [(roi_digest(mask[c]), roi_digest(mask[c], signal[c]))
+               for c in crops]
+    assert digests[0] == digests[1]
+    assert roi_digest(CompactMask(mask[crops[0]])) == digests[0][0]
+
+    #Values inside the mask do count
+    changed = signal.copy()
+    changed[10, 10, 6] += 1
+    assert roi_digest(mask[crops[1]], changed[crops[1]]) != digests[1][1]
+
+def test_compact_mask():
+    x, y, z = np.mgrid[-20:21, -20:21, -10:11]
+    mask = (x**2 + (y - 5)**2 + (2*z)**2 <= 64)
+    compact = pickle.loads(pickle.dumps(CompactMask(mask)))
+    assert np.array_equal(np.asarray(compact), mask)
+    assert np.array_equal(compact.astype(np.uint8), mask.astype(np.uint8))
+    assert roi_size(compact) == roi_size(mask)
+    assert roi_digest(compact) == roi_digest(mask)
+    assert compact.nbytes * 8 <= mask.nbytes
+
+    empty = CompactMask(np.zeros((4, 4, 4), dtype = bool))
+    assert roi_size(empty) == (0, 0)
+    assert not np.asarray(empty).any()
+
+def test_quantise_signal():
+    rng = np.random.default_rng(0)
+    signal = rng.integers(-1200, 400, size = (10, 10, 6)).astype(np.int16)
+    for num_levels, dtype in [(32, np.uint8), (256, np.uint8),
+                              (1024, np.uint16)]:
+        quantised = quantise_signal(signal, (-583, 137), num_levels)
+        assert quantised.levels.dtype == dtype
+        assert quantised.levels.max() == num_levels - 1
+        normalised = np.clip((signal + 583) / 720, 0.0, 1.0)
+        expected = 720 * (np.round(normalised * (num_levels - 1)) /
+                          (num_levels - 1)) - 583
+        assert np.array_equal(quantised.to_hu(), expected)
+        assert np.array_equal(
+            preprocess_signal(signal, (-583, 137), num_levels), expected)
+
+def test_identical_rois_are_computed_once(monkeypatch):
+    rng = np.random.default_rng(0)
+    signal = rng.uniform(-500, 100, size = (12, 12, 8))
+    mask = np.zeros(signal.shape, dtype = np.uint8)
+    mask[2:10, 3:9, 2:6] = 1
+
+    computed = list()
+    compute_feature_values = functions.compute_feature_values
+    def counting_compute_feature_values(feature_names, *args, **kwargs):
+        computed.append(sorted(feature_names))
+        return compute_feature_values(feature_names, *args, **kwargs)
+    monkeypatch.setattr(functions, 'compute_feature_values',
+                        counting_compute_feature_values)
+
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        db_driver = DBDriver(feature_names = feature_names,
+                             db_file = os.path.join(tmp_folder, 'features.db'))
+        kwargs = {'db_driver' : db_driver, 'window' : (-583, 137),
+                  'num_levels' : 32, 'noise_scale' : 0.0,
+                  'path_to_image' : os.path.join(tmp_folder, 'signal.nrrd'),
+                  'path_to_mask' : os.path.join(tmp_folder, 'mask.nrrd'),
+                  'roi' : (signal, CompactMask(mask))}
+        reference = get_feature_values(feature_names, 'AA-00', 0, 0, **kwargs)
+        values = get_feature_values(feature_names, 'AA-00', 0, -1, **kwargs)
+        assert values == reference
+        assert len(computed) == 1
+
+        #Noisy signals: only the mask-only features are reused
+        kwargs['noise_scale'] = 2.5
+        get_feature_values(feature_names, 'AA-00', 0, 1, **kwargs)
+        assert computed[-1] == ['firstorder/Entropy', 'glcm/Contrast']
+        assert db_driver.read_feature_value(
+            'AA-00', 0, 1, 32, 2.5, 'shape/MaxAxialDiameter') == reference[2]
+
+def test_mask_only_features_are_fanned_out(monkeypatch):
+    rng = np.random.default_rng(1)
+    signal = rng.uniform(-500, 100, size = (12, 12, 8))
+    mask = np.zeros(signal.shape, dtype = np.uint8)
+    mask[2:10, 3:9, 2:6] = 1
+
+    computed = list()
+    compute_feature_values = functions.compute_feature_values
+    def counting_compute_feature_values(feature_names, *args, **kwargs):
+        computed.append(sorted(feature_names))
+        return compute_feature_values(feature_names, *args, **kwargs)
+    monkeypatch.setattr(functions, 'compute_feature_values',
+                        counting_compute_feature_values)
+
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        db_driver = DBDriver(feature_names = feature_names,
+                             db_file = os.path.join(tmp_folder, 'features.db'))
+        kwargs = {'db_driver' : db_driver, 'window' : (-583, 137),
+                  'path_to_image' : os.path.join(tmp_folder, 'signal.nrrd'),
+                  'path_to_mask' : os.path.join(tmp_folder, 'mask.nrrd'),
+                  'roi' : (signal, CompactMask(mask))}
+        reference = get_feature_values(feature_names, 'AA-00', 0, 0,
+                                       num_levels = 32, noise_scale = 0.0,
+                                       **kwargs)
+
+        #Without the content-addressed results the shape feature can only
+        #come from the row of the other condition
+        db_driver._execute_transaction(
+            lambda cur: cur.execute("DELETE FROM roi_results"))
+        for num_levels, noise_scale in [(64, 0.0), (32, 2.5)]:
+            values = get_feature_values(feature_names, 'AA-00', 0, 0,
+                                        num_levels = num_levels,
+                                        noise_scale = noise_scale, **kwargs)
+            assert computed[-1] == ['firstorder/Entropy', 'glcm/Contrast']
+            assert values[2] == reference[2]
+            assert db_driver.read_feature_value(
+                'AA-00', 0, 0, num_levels, noise_scale,
+                'shape/MaxAxialDiameter') == reference[2]
+        assert len(computed) == 3
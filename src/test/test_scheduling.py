@@ -0,0 +1,155 @@
+"""Cost-based scheduling of the extraction tasks"""
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from scheduling import estimate_makespan, FeatureCostModel, run_tasks, \
+                       WorkStealingScheduler
+
+def test_work_stealing_scheduler():
+    scheduler = WorkStealingScheduler(num_workers = 2)
+    for task, cost in enumerate([1.0, 8.0, 2.0, 5.0, 3.0]):
+        scheduler.add(task, cost)
+    assert len(scheduler) == 5
+
+    #Tasks go to the least loaded worker: [5, 3, 2, 1] and [8]. Each worker
+    #takes its largest task first
+    assert scheduler.next_task(0)[1] == 5.0
+    assert scheduler.next_task(1)[1] == 8.0
+
+    #Once its queue is empty a worker steals from the busiest one
+    assert scheduler.next_task(1)[1] == 3.0
+    assert scheduler.next_task(0)[1] == 2.0
+    assert scheduler.next_task(1)[1] == 1.0
+    assert scheduler.next_task(0) is None
+    assert len(scheduler) == 0
+
+def test_cost_model_learns():
+    model = FeatureCostModel()
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        num_voxels = int(rng.integers(100, 100000))
+        model.update(num_voxels, 2 * num_voxels, 64, ['glcm', 'glszm'],
+                     0.05 + 3e-4 * num_voxels,
+                     class_seconds = {'glcm' : 1e-4 * num_voxels,
+                                      'glszm' : 2e-4 * num_voxels})
+    estimates = model.estimate_by_class(5000, 10000, 64, ['glcm', 'glszm'])
+    assert np.isclose(estimates['glcm'], 0.5, rtol = 0.1)
+    assert np.isclose(estimates['glszm'], 1.0, rtol = 0.1)
+    assert np.isclose(estimates['overhead'], 0.05, rtol = 0.1)
+
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        path = os.path.join(tmp_folder, 'costs.json')
+        model.save(path)
+        loaded = FeatureCostModel.load(path)
+        assert loaded.estimate(5000, 10000, 64, ['glcm']) == \
+            model.estimate(5000, 10000, 64, ['glcm'])
+        assert loaded.num_measurements == 200
+
+def test_estimate_makespan():
+    assert estimate_makespan([8.0, 5.0, 3.0, 2.0, 1.0], 2) == 10.0
+    assert estimate_makespan([], 4) == 0.0
+
+def _square(task):
+    time.sleep(0.01)
+    return task ** 2
+
+def test_run_tasks():
+    tasks = [(t, (100 * (t + 1), 200 * (t + 1), 32, ('glcm',)))
+             for t in range(12)]
+    for num_workers in [1, 3]:
+        cost_model = FeatureCostModel()
+        results = {task : result for task, result, _ in run_tasks(
+            iter(tasks), _square, num_workers, cost_model, lookahead = 5)}
+        assert results == {t : t ** 2 for t in range(12)}
+        assert cost_model.num_measurements == 12
+
+def test_plan_extraction():
+    from functions import plan_extraction
+    from utilities import DBDriver, WriteBehindDBDriver
+
+    feature_names = ['firstorder/Entropy', 'glcm/Contrast']
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        db_driver = DBDriver(feature_names = feature_names,
+                             db_file = os.path.join(tmp_folder, 'features.db'))
+        db_driver.write_roi_sizes('AA-00', {(0, -1) : (1000, 2000),
+                                            (0, 0) : (800, 1500)})
+        assert list(db_driver.get_roi_sizes('AA-00').items()) == \
+            [((0, -1), (1000, 2000)), ((0, 0), (800, 1500))]
+        db_driver.write_feature_value('AA-00', 0, -1, 32, 0.0,
+                                      'firstorder/Entropy', 1.0)
+        db_driver.write_feature_value('AA-00', 0, -1, 32, 0.0,
+                                      'glcm/Contrast', 1.0)
+        db_driver.write_feature_value('AA-00', 0, 0, 32, 0.0,
+                                      'glcm/Contrast', 1.0)
+
+        cost_model = FeatureCostModel()
+        plan = plan_extraction(['AA-00'], feature_names, [(-583, 137)],
+                               [32, 64], [0.0], db_driver, cost_model,
+                               num_workers = 2)
+        assert plan['num_tasks'] == 3
+        assert list(plan['cpu_seconds_by_class'].keys()) == \
+            ['overhead', 'firstorder', 'glcm']
+        assert np.isclose(plan['cpu_seconds'],
+                          sum(plan['cpu_seconds_by_class'].values()))
+        assert plan['cpu_seconds'] / 2 <= plan['wall_seconds'] <= \
+            plan['cpu_seconds']
+        assert plan['db_growth_bytes'] > 0
+        assert plan['peak_memory_bytes'] > 3 * (2000 + 1500)
+
+def test_iter_feature_values():
+    from functions import CompactMask, iter_feature_values
+    from utilities import DBDriver, WriteBehindDBDriver
+
+    feature_names = ['firstorder/Entropy', 'glcm/Contrast']
+    rng = np.random.default_rng(0)
+    tasks = list()
+    for nodule_id, size in enumerate([6, 10, 8]):
+        signal = rng.uniform(-500, 100, size = (size, size, size))
+        mask = np.zeros(signal.shape, dtype = bool)
+        mask[1:-1, 1:-1, 1:-1] = True
+        roi = (signal, CompactMask(mask))
+        for window in [(-583, 137), (-1000, 400)][:nodule_id + 1]:
+            tasks.append(('AA-00', nodule_id, 0, 32, 0.0, window,
+                          feature_names, roi))
+
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        db_file = os.path.join(tmp_folder, 'features.db')
+        kwargs = {'path_to_image' : os.path.join(tmp_folder, 'signal.nrrd'),
+                  'path_to_mask' : os.path.join(tmp_folder, 'mask.nrrd')}
+        streams = list()
+        for num_workers in [1, 2]:
+            db_driver = DBDriver(feature_names = feature_names,
+                                 db_file = db_file + str(num_workers))
+            streams.append(list(iter_feature_values(
+                iter(tasks), db_driver, num_workers = num_workers,
+                lookahead = 2, **kwargs)))
+            assert len(streams[-1]) == len(tasks) * len(feature_names)
+            for condition, feature_name, feature_value, _ in streams[-1]:
+                assert db_driver.read_feature_value(
+                    *condition[:5], feature_name,
+                    window = condition[5]) == feature_value
+
+        #The workers only read: the values are written by the calling process
+        #through its (write-behind) driver
+        db_driver = WriteBehindDBDriver(feature_names = feature_names,
+                                        db_file = db_file, batch_size = 1000,
+                                        flush_interval = 60.0)
+        workers_db_driver = DBDriver(feature_names = feature_names,
+                                     db_file = db_file)
+        stream = list(iter_feature_values(
+            iter(tasks), db_driver, num_workers = 2, lookahead = 2,
+            workers_db_driver = workers_db_driver, **kwargs))
+        condition, feature_name, feature_value, _ = stream[0]
+        assert workers_db_driver.read_feature_value(
+            *condition[:5], feature_name, window = condition[5]) is None
+        db_driver.close()
+        for condition, feature_name, feature_value, _ in stream:
+            assert workers_db_driver.read_feature_value(
+                *condition[:5], feature_name,
+                window = condition[5]) == feature_value
+        assert sorted([record[:3] for record in streams[0]]) == \
+            sorted([record[:3] for record in streams[1]])
+        assert streams[0][0][2] != streams[0][2][2]
@@ -0,0 +1,72 @@
+"""Cached per-nodule statistics and bootstrap estimates for the stability 
+analysis"""
+import os
+import tempfile
+from unittest import mock
+
+import numpy as np
+
+import stability
+from stability import avg_smape, bootstrap_stability, cached_avg_smape, \
+    RunningStatistics
+from utilities import StatisticsCache
+
+feature_names = ['firstorder/Entropy', 'glcm/Contrast']
+subjects = [('AA-00', 0), ('AA-00', 1), ('AB-00', 0)]
+
+def test_cached_avg_smape():
+    rng = np.random.default_rng(0)
+    ratings = rng.uniform(1, 2, size = (2, 3, 4))
+    ratings[1, 2, 3] = np.nan
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        cache = StatisticsCache(os.path.join(tmp_folder, 'statistics.db'))
+        smape_values = cached_avg_smape(ratings, subjects, feature_names,
+                                        cache, 'test')
+        for f in range(2):
+            for s in range(3):
+                assert np.array_equal(smape_values[f, s],
+                                      avg_smape(ratings[f, s]),
+                                      equal_nan = True)
+
+        #Only the entries whose values have changed are recomputed
+        ratings[0, 1, 0] = 3.0
+        with mock.patch.object(stability, 'avg_smape',
+                               wraps = avg_smape) as spy:
+            updated = cached_avg_smape(ratings, subjects, feature_names,
+                                       cache, 'test')
+            assert spy.call_count == 1
+        assert updated[0, 1] == avg_smape(ratings[0, 1])
+        assert np.array_equal(np.delete(updated.ravel(), 1),
+                              np.delete(smape_values.ravel(), 1),
+                              equal_nan = True)
+
+def test_bootstrap_stability():
+    rng = np.random.default_rng(0)
+    smape_values = np.stack([rng.uniform(0, 4, 200), rng.uniform(8, 12, 200),
+                             np.full(200, 30.0)])
+    lower_bounds, upper_bounds, grade_probabilities = bootstrap_stability(
+        smape_values, num_resamples = 2000, chunk_size = 300, seed = 0)
+    means = smape_values.mean(axis = 1)
+    assert np.all(lower_bounds <= means) and np.all(means <= upper_bounds)
+    assert np.allclose(grade_probabilities.sum(axis = 1), 1.0)
+    assert grade_probabilities[0, 0] == 1.0
+    assert 0.0 < grade_probabilities[1, 1] < 1.0
+    assert grade_probabilities[2, 3] == 1.0
+
+    #Same results regardless of the chunking
+    assert np.allclose(bootstrap_stability(smape_values, num_resamples = 2000,
+                                           chunk_size = 2000, seed = 0)[0],
+                       lower_bounds)
+
+def test_running_statistics():
+    rng = np.random.default_rng(0)
+    replicates = rng.normal(5.0, 1.0, size = (40, 3))
+    replicates[7, 2] = 0.0
+    statistics = RunningStatistics(3)
+    for values in replicates:
+        statistics.update(values)
+    assert statistics.count == 40
+    assert np.allclose(statistics.mean, replicates.mean(axis = 0))
+    assert np.allclose(statistics.variance, replicates.var(axis = 0, ddof = 1))
+    assert np.allclose(statistics.avg_smape,
+                       [avg_smape(replicates[:, f]) for f in range(3)])
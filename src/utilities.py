@@ -1,12 +1,30 @@
+import atexit
+import hashlib
+import queue
+import signal
+import threading
+import time
+
 from collections import OrderedDict
-from os import listdir
-from os.path import isfile, join, splitext
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from importlib import metadata
+from os import getpid, makedirs, scandir
+from os.path import isdir, isfile, join, splitext
 
+import numpy as np
 import sqlite3
-from dicom_parser import Image
+
+#DICOM tags read by metadata_from_dicom_folder() and corresponding keys in the
+#metadata returned
+dicom_metadata_tags = OrderedDict({'age' : 'PatientAge',
+                                   'gender' : 'PatientSex',
+                                   'tube_voltage' : 'KVP'})
 
 def metadata_from_dicom_folder(dicom_folder):
-    """Basic metadata from DICOM folder
+    """Basic metadata from DICOM folder. Only the header tags listed in 
+    dicom_metadata_tags are read from the first .dcm file found in the 
+    folder; parsing stops before the pixel data.
     
     Parameters
     ----------
@@ -19,38 +37,153 @@ def metadata_from_dicom_folder(dicom_folder):
         The metadata (keys describe the meaning).
     """
     
-    #Retrieve the list of files in the folder
-    dicom_files = [f for f in listdir(dicom_folder) if isfile(join(dicom_folder, f))]
-    full_paths = []
-    for dicom_file in dicom_files:
-        full_paths.append(join(dicom_folder, dicom_file))
-    
-    #Read the metadata from the first dicom file in the list
-    image = None
-    for full_path in full_paths:
-        _, ext = splitext(full_path)
-        if ext in ['.dcm']:
-            image = Image(full_path)
-            break
-    metadata = OrderedDict(
-        {'age' : image.header.get('PatientAge'),
-         'gender' : image.header.get('PatientSex'),
-         'tube_voltage' : image.header.get('KVP')}
-    )
+    #Find the first dicom file in the folder without listing all of them
+    full_path = None
+    with scandir(dicom_folder) as entries:
+        for entry in entries:
+            if entry.is_file() and splitext(entry.name)[1] in ['.dcm']:
+                full_path = entry.path
+                break
+    if full_path is None:
+        raise Exception(f'No DICOM file found in {dicom_folder}')
+    
+    #Imported here so that the database classes do not require the DICOM 
+    #packages
+    from dicom_parser import Header
+    from pydicom import dcmread
+    
+    #Read the requested tags only and parse them through dicom_parser
+    dataset = dcmread(full_path, stop_before_pixels = True, 
+                      specific_tags = list(dicom_metadata_tags.values()))
+    header = Header(dataset)
+    metadata = OrderedDict()
+    for key, tag in dicom_metadata_tags.items():
+        metadata[key] = header.get(tag)
+    
+    return metadata
+
+def metadata_from_dicom_folders(dicom_folders, max_workers = 16):
+    """Basic metadata from multiple DICOM folders. The folders are scanned 
+    concurrently in a thread pool (the task is I/O bound).
+    
+    Parameters
+    ----------
+    dicom_folders : iterable of str
+        The folders where the DICOM files are stored.
+    max_workers : int (> 0)
+        The maximum number of concurrent threads.
+        
+    Returns
+    -------
+    metadata : list of OrderedDict
+        The metadata of each folder (see metadata_from_dicom_folder()), in the
+        same order as dicom_folders.
+    """
     
+    with ThreadPoolExecutor(max_workers = max_workers) as executor:
+        metadata = list(executor.map(metadata_from_dicom_folder, 
+                                     dicom_folders))
     return metadata
 
+def _to_python(value):
+    """Converts NumPy scalars to the corresponding Python type (accepted by 
+    sqlite3 as query parameters)"""
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+#Version of the preprocessing code in functions.py (ROI extraction, noise, 
+#windowing, quantisation and bin width). Increase it whenever a change alters the 
+#feature values: the values stored with the previous version are then stale
+#and recomputed (see settings_fingerprint())
+preprocessing_version = 1
+
+def settings_fingerprint(settings = None, backend = 'pyradiomics'):
+    """Compact fingerprint of the settings that affect the feature values 
+    but are not part of the experimental condition: the pyradiomics version,
+    the version of the preprocessing code (see preprocessing_version) and 
+    any additional settings. The values stored in the database are tagged 
+    with it (see DBDriver), so that only those computed with other settings
+    are recomputed. Light to compute: pyradiomics is not imported.
+    
+    Parameters
+    ----------
+    settings : dict (optional)
+        Additional settings (e.g. extractor parameters), each with a value
+        that has a stable repr().
+    backend : str
+        The backend used for computing the texture matrices (see 
+        functions.compute_feature_values()). Backends other than 
+        'pyradiomics' match the stock values only within numerical 
+        tolerance, therefore they are part of the settings.
+    
+    Returns
+    -------
+    fingerprint : str
+        The hexadecimal fingerprint (16 characters).
+    """
+    settings = dict(settings or {})
+    if backend != 'pyradiomics':
+        settings['backend'] = backend
+    digest = hashlib.blake2b(digest_size = 8)
+    digest.update(repr((metadata.version('pyradiomics'), 
+                        preprocessing_version, 
+                        sorted(settings.items()))).encode())
+    return digest.hexdigest()
+
+#Connections inherited from a parent process through fork(). They must not be
+#used nor closed by the child process (closing them could interfere with the 
+#parent's locks), therefore they are kept referenced here.
+_inherited_connections = list()
+
 class DBDriver():
-    """Database interface for storing and retrieving the feature values"""
+    """Database interface for storing and retrieving the feature values. 
+    
+    The driver can be shared by multiple threads and processes: each thread 
+    (of each process) lazily opens its own connection to the database file. 
+    By default the database uses write-ahead logging (WAL), so that readers do
+    not block the writer and vice versa; a writer waiting for another one 
+    waits up to busy_timeout seconds and then retries up to max_retries 
+    times.
+    
+    Optionally the results of read_feature_value(), get_feature_matrix() 
+    and of the queries on the ids are kept in an in-process LRU cache (see 
+    cache_size). Writes through the driver invalidate the affected entries;
+    writes by other drivers or processes are not seen until the entries are
+    evicted or clear_cache() is called.
+    
+    Each row of the features, noise_statistics and roi_results tables is 
+    tagged with the fingerprint of the settings the values were computed 
+    with (see settings_fingerprint()). A driver given a 
+    fingerprint only sees the rows with the same fingerprint: rows computed
+    with other settings (or with no fingerprint recorded) read as missing, 
+    therefore only these are recomputed (see get_stale_conditions())."""
+    
+    #Columns identifying one experimental condition and corresponding 
+    #data types of the coordinate arrays returned by get_feature_matrix()
+    _key_columns = OrderedDict({'patient_id' : object,
+                                'nodule_id' : np.int64,
+                                'annotation_id' : np.int64,
+                                'num_levels' : np.int64,
+                                'noise_scale' : np.float64,
+                                'window_lower' : np.float64,
+                                'window_upper' : np.float64})
+    
+    #CT window (lower_bound, upper_bound) in Hounsfield Units used when none
+    #is given, and of the values stored before the window was part of the 
+    #experimental condition
+    default_window = (-583.0, 137.0)
     
     @classmethod
-    def generate_from_file(cls, db_file):
+    def generate_from_file(cls, db_file, **kwargs):
         """Opens a connection to an existing db_file if this exists.
         
         Parameters
         ----------
         db_file : str
             Path to the database file (.db).
+        **kwargs
+            Connection settings (see __init__()).
         """  
         
         if not isfile(db_file):
@@ -65,8 +198,8 @@ class DBDriver():
         cur.execute(command_str) 
         rows = cur.fetchall()    
         feature_names = list()
-        to_exclude = {'patient_id', 'nodule_id', 'annotation_id',
-                      'noise_scale', 'num_levels'}
+        to_exclude = set(cls._key_columns.keys()).union(
+            ['settings_fingerprint'])
         for row in rows:
             if row[1] not in to_exclude:
                 feature_names.append(DBDriver._unmangle_feature_name(row[1]))
@@ -75,7 +208,7 @@ class DBDriver():
         connection.close()
         
         #Instantiate and return the DBDriver
-        return DBDriver(feature_names, db_file)
+        return cls(feature_names, db_file, **kwargs)
     
     
     @staticmethod
@@ -88,29 +221,187 @@ class DBDriver():
     
     @staticmethod
     def _experimental_condition(patient_id, nodule_id, annotation_id, 
-                                num_levels, noise_scale):
+                                num_levels, noise_scale, window_lower, 
+                                window_upper):
         """Generate string for SQL query that dientifies one combination
-        of patient_id, nodule_id, annotation_id, num_levels and noise_scale"""
+        of patient_id, nodule_id, annotation_id, num_levels, noise_scale and
+        window"""
         condition = f"patient_id='{patient_id}' AND "+\
                     f"nodule_id={nodule_id} AND "+\
                     f"annotation_id={annotation_id} AND "+\
                     f"num_levels={num_levels} AND "+\
-                    f"noise_scale={noise_scale}"    
+                    f"noise_scale={noise_scale} AND "+\
+                    f"window_lower={window_lower} AND "+\
+                    f"window_upper={window_upper}"
         return condition
     
-    def _execute_query(self, command_str):
-        cur = self._connection.cursor()
-        cur.execute(command_str)        
-        return cur.fetchall()        
+    @classmethod
+    def _condition_key(cls, patient_id, nodule_id, annotation_id, num_levels,
+                       noise_scale, window = None):
+        """The experimental condition as a tuple of Python scalars (values of
+        the key columns), with the default window if none is given"""
+        if window is None:
+            window = cls.default_window
+        return (_to_python(patient_id), _to_python(nodule_id), 
+                _to_python(annotation_id), _to_python(num_levels), 
+                _to_python(noise_scale), float(window[0]), float(window[1]))
+    
+    def _fingerprint_condition(self):
+        """SQL condition (to be appended to a WHERE clause) matching the rows
+        computed with the settings of this driver. Empty if the driver has 
+        no fingerprint (any row matches)."""
+        if self._fingerprint is None:
+            return ""
+        return f" AND settings_fingerprint = '{self._fingerprint}'"
+    
+    def _connect(self):
+        """Opens a new connection to the database file"""
+        connection = sqlite3.connect(self._db_file, 
+                                     timeout = self._busy_timeout,
+                                     isolation_level = None)
+        if self._journal_mode is not None:
+            self._with_retry(lambda: connection.execute(
+                f"PRAGMA journal_mode={self._journal_mode}"))
+        if self._synchronous is not None:
+            connection.execute(f"PRAGMA synchronous={self._synchronous}")
+        return connection
+    
+    @property
+    def _connection(self):
+        """The connection owned by the calling thread and process. Created on
+        first use; re-created in a child process after fork()."""
+        owner_and_connection = getattr(self._local, 'connection', None)
+        if (owner_and_connection is None) or\
+           (owner_and_connection[0] != getpid()):
+            if owner_and_connection is not None:
+                _inherited_connections.append(owner_and_connection[1])
+            self._local.connection = (getpid(), self._connect())
+        return self._local.connection[1]
+    
+    def _with_retry(self, operation):
+        """Executes operation (callable without arguments), retrying with 
+        exponential backoff when the database is locked by another 
+        connection"""
+        for attempt in range(self._max_retries + 1):
+            try:
+                return operation()
+            except sqlite3.OperationalError as error:
+                locked = ('locked' in str(error)) or ('busy' in str(error))
+                if (not locked) or (attempt == self._max_retries):
+                    raise
+                time.sleep(min(0.1 * 2 ** attempt, 5.0))
+    
+    def _execute_query(self, command_str, parameters = ()):
+        def operation():
+            cur = self._connection.cursor()
+            cur.execute(command_str, parameters)        
+            return cur.fetchall()
+        return self._with_retry(operation)
+    
+    def _execute_transaction(self, commands):
+        """Executes the given commands in one write transaction. commands is
+        a callable that receives a cursor."""
+        def operation():
+            connection = self._connection
+            cur = connection.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            try:
+                commands(cur)
+                cur.execute("COMMIT")
+            except BaseException:
+                #Also if COMMIT failed (e.g. busy with journal modes other 
+                #than WAL): the transaction must not stay open, the retry 
+                #starts a new one
+                if connection.in_transaction:
+                    connection.execute("ROLLBACK")
+                raise
+        self._with_retry(operation)
+    
+    def _cached(self, key, query):
+        """Result of query (callable without arguments) from the cache if 
+        available under key, otherwise executes the query and stores the
+        result"""
+        if self._cache_size == 0:
+            return query()
+        with self._cache_lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self._cache_hits += 1
+                return self._cache[key]
+            self._cache_misses += 1
+            generation = self._cache_generation
+        result = query()
+        with self._cache_lock:
+            #Do not store results that may be stale because of a write 
+            #completed while the query was executing
+            if generation == self._cache_generation:
+                self._cache[key] = result
+                while len(self._cache) > self._cache_size:
+                    self._cache.popitem(last = False)
+        return result
+    
+    def _invalidate(self, conditions, inserted):
+        """Removes from the cache the entries affected by writing the given
+        values. conditions maps each experimental condition to the mangled
+        names of the features written; inserted are the conditions for 
+        which a new row was created or a stale row was tagged with the 
+        current settings fingerprint."""
+        with self._cache_lock:
+            self._cache_generation += 1
+            if len(self._cache) == 0:
+                return
+            keys = list()
+            for condition, feature_columns in conditions.items():
+                keys.extend([('value', condition, f) for f in feature_columns])
+            for condition in inserted:
+                keys.extend([('patient_ids',), ('nodule_ids', condition[0]),
+                             ('annotation_ids', condition[0], condition[1])])
+            keys.extend([key for key in self._cache.keys() 
+                         if key[0] == 'matrix'])
+            for key in keys:
+                self._cache.pop(key, None)
+    
+    def cache_info(self):
+        """Statistics of the read cache.
+        
+        Returns
+        -------
+        info : dict
+            The number of hits and misses so far, the number of entries in
+            the cache and the maximum number of entries (keys 'hits', 
+            'misses', 'size' and 'max_size').
+        """
+        with self._cache_lock:
+            return {'hits' : self._cache_hits, 'misses' : self._cache_misses,
+                    'size' : len(self._cache), 'max_size' : self._cache_size}
+    
+    def clear_cache(self):
+        """Empties the read cache (e.g. to see the values written by other 
+        processes)"""
+        with self._cache_lock:
+            self._cache_generation += 1
+            self._cache.clear()
+    
+    def close(self):
+        """Closes the connection of the calling thread (a new one is opened 
+        if the driver is used again)"""
+        owner_and_connection = getattr(self._local, 'connection', None)
+        if owner_and_connection is not None:
+            if owner_and_connection[0] == getpid():
+                owner_and_connection[1].close()
+            self._local.connection = None
     
     def _get_row(self, patient_id, nodule_id, annotation_id, num_levels,
-                 noise_scale):
+                 noise_scale, window = None):
         """Returns the row matching the given patient_id, nodule_id, 
-        annotation_id, num_levels and noise_scale"""
+        annotation_id, num_levels, noise_scale and window"""
         
         condition = self.__class__._experimental_condition(
-            patient_id, nodule_id, annotation_id, num_levels, noise_scale)
-        command_str = f"SELECT * FROM features WHERE {condition}"
+            *self.__class__._condition_key(patient_id, nodule_id, 
+                                           annotation_id, num_levels, 
+                                           noise_scale, window))
+        command_str = f"SELECT * FROM features WHERE {condition}"+\
+                      self._fingerprint_condition()
         rows = self._execute_query(command_str)
         
         if len(rows) > 1:
@@ -124,12 +415,12 @@ class DBDriver():
     def _create_new(self):
         """Generates an empty table"""
         
-        self._connection = sqlite3.connect(self._db_file)
-        
         #Define the table fields
-        command_str = "CREATE TABLE features (patient_id text, "+\
+        command_str = "CREATE TABLE IF NOT EXISTS features (patient_id text, "+\
                       "nodule_id integer, annotation_id integer, "+\
-                      "num_levels integer, noise_scale real"
+                      "num_levels integer, noise_scale real, "+\
+                      "window_lower real, window_upper real, "+\
+                      "settings_fingerprint text"
         feature_cols = ""
         for feature_name in self._feature_names:
             feature_name_modif = self.__class__._mangle_feature_name(
@@ -138,12 +429,133 @@ class DBDriver():
         command_str = command_str + feature_cols + ')'
             
         #Create the table and commit the changes
-        cur = self._connection.cursor()
-        cur.execute(command_str)
-        self._connection.commit()  
+        self._execute_transaction(lambda cur: cur.execute(command_str))
+    
+    def _add_missing_columns(self):
+        """Adds to an existing table the columns of the requested features 
+        that are not there yet (values NULL, i.e. still to be computed), the
+        window columns and the settings fingerprint column if missing. All 
+        the columns are added in one transaction, opened only if any column
+        is missing (opening a driver on an up-to-date table does not wait 
+        for the writers)."""
+        
+        required_columns = ['window_lower', 'window_upper', 
+                            'settings_fingerprint'] +\
+            [self.__class__._mangle_feature_name(f) 
+             for f in self._feature_names]
+        existing_columns = self._table_columns('features')
+        if all([c in existing_columns for c in required_columns]):
+            return
+        
+        def commands(cur):
+            cur.execute("SELECT name FROM PRAGMA_TABLE_INFO('features')")
+            existing_columns = {row[0] for row in cur.fetchall()}
+            
+            #Tables created before the window was part of the experimental
+            #condition: the values were computed on the default window
+            for column, bound in zip(['window_lower', 'window_upper'], 
+                                     self.__class__.default_window):
+                if column not in existing_columns:
+                    cur.execute(f"ALTER TABLE features ADD COLUMN "+\
+                                f"{column} real DEFAULT {bound}")
+            
+            #Tables created before the settings were recorded: NULL, i.e. 
+            #the settings are unknown (see tag_untagged_results())
+            if 'settings_fingerprint' not in existing_columns:
+                cur.execute("ALTER TABLE features ADD COLUMN "+\
+                            "settings_fingerprint text")
+            
+            for feature_name in self._feature_names:
+                feature_name_modif = self.__class__._mangle_feature_name(
+                    feature_name)
+                if feature_name_modif not in existing_columns:
+                    cur.execute(f"ALTER TABLE features ADD COLUMN "+\
+                                f"{feature_name_modif} real")
+                    existing_columns.add(feature_name_modif)
+        
+        self._execute_transaction(commands)
+    
+    def _table_columns(self, table):
+        """Names of the columns of a table (empty if the table does not 
+        exist), read without opening a write transaction"""
+        rows = self._execute_query(
+            f"SELECT name FROM PRAGMA_TABLE_INFO('{table}')")
+        return {row[0] for row in rows}
+    
+    def _create_auxiliary_tables(self):
+        """Generates the tables of the noise robustness summaries, of the 
+        ROI sizes and of the content-addressed results if these do not 
+        exist, or migrates them if created by previous versions. Nothing is
+        written if the tables are up to date."""
+        
+        up_to_date = \
+            {'window_lower', 'settings_fingerprint'}.issubset(
+                self._table_columns('noise_statistics')) and \
+            (len(self._table_columns('roi_sizes')) > 0) and \
+            ('settings_fingerprint' in self._table_columns('roi_results'))
+        if up_to_date:
+            return
+        
+        command_str = "CREATE TABLE IF NOT EXISTS noise_statistics ("+\
+                      "patient_id text, nodule_id integer, "+\
+                      "annotation_id integer, num_levels integer, "+\
+                      "noise_scale real, window_lower real, "+\
+                      "window_upper real, feature_name text, "+\
+                      "num_replicates integer, mean real, variance real, "+\
+                      "avg_smape real, settings_fingerprint text, "+\
+                      "PRIMARY KEY (patient_id, nodule_id, annotation_id, "+\
+                      "num_levels, noise_scale, window_lower, window_upper, "+\
+                      "feature_name))"
+        def commands(cur):
+            
+            #Tables created before the window was part of the key are 
+            #rebuilt (the primary key cannot be altered)
+            cur.execute("SELECT name FROM PRAGMA_TABLE_INFO("+\
+                        "'noise_statistics')")
+            existing_columns = {row[0] for row in cur.fetchall()}
+            if (len(existing_columns) > 0) and \
+               ('window_lower' not in existing_columns):
+                cur.execute("ALTER TABLE noise_statistics RENAME TO "+\
+                            "noise_statistics_old")
+                cur.execute(command_str)
+                window_lower, window_upper = self.__class__.default_window
+                cur.execute(f"INSERT INTO noise_statistics SELECT "+\
+                            f"patient_id, nodule_id, annotation_id, "+\
+                            f"num_levels, noise_scale, {window_lower}, "+\
+                            f"{window_upper}, feature_name, num_replicates, "+\
+                            f"mean, variance, avg_smape, NULL "+\
+                            f"FROM noise_statistics_old")
+                cur.execute("DROP TABLE noise_statistics_old")
+            else:
+                cur.execute(command_str)
+                if (len(existing_columns) > 0) and \
+                   ('settings_fingerprint' not in existing_columns):
+                    cur.execute("ALTER TABLE noise_statistics ADD COLUMN "+\
+                                "settings_fingerprint text")
+        self._execute_transaction(commands)
+        command_str = "CREATE TABLE IF NOT EXISTS roi_sizes ("+\
+                      "patient_id text, nodule_id integer, "+\
+                      "annotation_id integer, num_voxels integer, "+\
+                      "bbox_volume integer, PRIMARY KEY (patient_id, "+\
+                      "nodule_id, annotation_id))"
+        self._execute_transaction(lambda cur: cur.execute(command_str))
+        command_str = "CREATE TABLE IF NOT EXISTS roi_results ("+\
+                      "roi_digest text, feature_name text, "+\
+                      "feature_value real, settings_fingerprint text, "+\
+                      "PRIMARY KEY (roi_digest, feature_name))"
+        def commands(cur):
+            cur.execute("SELECT name FROM PRAGMA_TABLE_INFO('roi_results')")
+            existing_columns = {row[0] for row in cur.fetchall()}
+            cur.execute(command_str)
+            if (len(existing_columns) > 0) and \
+               ('settings_fingerprint' not in existing_columns):
+                cur.execute("ALTER TABLE roi_results ADD COLUMN "+\
+                            "settings_fingerprint text")
+        self._execute_transaction(commands)
     
     def read_feature_value(self, patient_id, nodule_id, annotation_id, 
-                            num_levels, noise_scale, feature_name):
+                            num_levels, noise_scale, feature_name, 
+                            window = None):
         """Reads one feature value from the database.
         
         Parameters
@@ -160,20 +572,27 @@ class DBDriver():
             The noise scale.
         feature_name : str
             The name of the feature to retrieve.
+        window : tuple of float (lower_bound, upper_bound)
+            The CT window in Hounsfield Units. None for the default window 
+            (see default_window).
         
         Returns
         -------
         feature_value : float
             The feature value. None is returned if the feature is not in the
-            database.
+            database or was computed with other settings.
         """ 
         
         feature_value = None
         feature_name = self.__class__._mangle_feature_name(feature_name)
+        condition = self.__class__._condition_key(
+            patient_id, nodule_id, annotation_id, num_levels, noise_scale, 
+            window)
         command_str = f"SELECT {feature_name} FROM features WHERE "+\
-            self.__class__._experimental_condition(
-                patient_id, nodule_id, annotation_id, num_levels, noise_scale)
-        rows = self._execute_query(command_str)
+            self.__class__._experimental_condition(*condition)+\
+            self._fingerprint_condition()
+        rows = self._cached(('value', condition, feature_name), 
+                            lambda: self._execute_query(command_str))
         
         #Make sure that only one value is returned and raise an exception
         #otherwise
@@ -191,9 +610,108 @@ class DBDriver():
         
         return feature_value
     
+    def get_missing_features(self, patient_id, nodule_id, annotation_id, 
+                             num_levels, noise_scale, feature_names, 
+                             window = None):
+        """Features whose value for the given experimental condition is not 
+        in the database. The row is read with one query.
+        
+        Parameters
+        ----------
+        patient_id : str 
+            The patient id.
+        nodule_id : int 
+            The nodule id
+        annotation_id : int
+            The annotation id.
+        num_levels : int [> 0] 
+            The number of quantisation levels
+        noise_scale : float 
+            The noise scale.
+        feature_names : list of str
+            The names of the features to check.
+        window : tuple of float (lower_bound, upper_bound)
+            The CT window (see read_feature_value()).
+        
+        Returns
+        -------
+        missing_features : list of str
+            The features in feature_names with no value (same order). All 
+            the features are missing if the values of this condition were
+            computed with other settings.
+        """
+        
+        condition = self.__class__._experimental_condition(
+            *self.__class__._condition_key(patient_id, nodule_id, 
+                                           annotation_id, num_levels, 
+                                           noise_scale, window))
+        columns = ', '.join([self.__class__._mangle_feature_name(f) 
+                             for f in feature_names])
+        rows = self._execute_query(
+            f"SELECT {columns} FROM features WHERE {condition}"+\
+            self._fingerprint_condition())
+        if len(rows) == 0:
+            return list(feature_names)
+        return [f for f, value in zip(feature_names, rows[0]) 
+                if value is None]
+    
+    def resolve_feature_value(self, patient_id, nodule_id, annotation_id, 
+                              feature_name, num_levels = None, 
+                              noise_scale = None, window = None):
+        """Reads one feature value from the database matching only the 
+        given conditions. Use this for features that are invariant to the 
+        number of quantisation levels, to the noise scale and/or to the CT
+        window.
+        
+        Parameters
+        ----------
+        patient_id : str 
+            The patient id.
+        nodule_id : int 
+            The nodule id
+        annotation_id : int
+            The annotation id.
+        feature_name : str
+            The name of the feature to retrieve.
+        num_levels : int [> 0] 
+            The number of quantisation levels. None matches any value.
+        noise_scale : float 
+            The noise scale. None matches any value.
+        window : tuple of float (lower_bound, upper_bound)
+            The CT window. None matches any value.
+        
+        Returns
+        -------
+        feature_value : float
+            The feature value from any of the matching rows. None is returned
+            if the feature is not in the database for any of these.
+        """ 
+        
+        feature_name = self.__class__._mangle_feature_name(feature_name)
+        command_str = f"SELECT {feature_name} FROM features "+\
+                      f"WHERE patient_id = '{patient_id}' "+\
+                      f"AND nodule_id = {nodule_id} "+\
+                      f"AND annotation_id = {annotation_id} "
+        if num_levels is not None:
+            command_str = command_str + f"AND num_levels = {num_levels} "
+        if noise_scale is not None:
+            command_str = command_str + f"AND noise_scale = {noise_scale} "
+        if window is not None:
+            command_str = command_str +\
+                f"AND window_lower = {float(window[0])} "+\
+                f"AND window_upper = {float(window[1])} "
+        command_str = command_str + f"AND {feature_name} IS NOT NULL"+\
+            self._fingerprint_condition() + " LIMIT 1"
+        rows = self._execute_query(command_str)
+        
+        feature_value = None
+        if len(rows) > 0:
+            feature_value = rows[0][0]
+        return feature_value
+    
     def get_feature_values_by_annotation(self, patient_id, nodule_id,
                                          feature_name, num_levels = 256,
-                                         noise_scale = 0.0):
+                                         noise_scale = 0.0, window = None):
         """For a given patient, nodule and feature name returns the feature
         values for each of the annotations available in the database. The
         50% consenus annotation is excluded.
@@ -210,6 +728,8 @@ class DBDriver():
             The number of quantisation levels
         noise_scale : float 
             The noise scale.
+        window : tuple of float (lower_bound, upper_bound)
+            The CT window (see read_feature_value()).
         
         Returns
         -------
@@ -217,20 +737,25 @@ class DBDriver():
             The feature values. These are as many as the number of delineations
             for the given nodule.
         """
+        if window is None:
+            window = self.default_window
         command_str = f"SELECT {self._mangle_feature_name(feature_name)} FROM features "+\
                       f"WHERE patient_id = '{patient_id}' "+\
                       f"AND nodule_id = {nodule_id} "+\
                       f"AND num_levels = {num_levels} "+\
                       f"AND noise_scale = {noise_scale} "+\
-                      f"AND annotation_id != -1 "+\
-                      f"ORDER BY annotation_id"
+                      f"AND window_lower = {float(window[0])} "+\
+                      f"AND window_upper = {float(window[1])} "+\
+                      f"AND annotation_id != -1"+\
+                      self._fingerprint_condition()+\
+                      f" ORDER BY annotation_id"
         rows = self._execute_query(command_str)
         feature_values = [row[0] for row in rows]
         return feature_values
     
     def get_feature_value_on_consensus_annotation(
         self, patient_id, nodule_id, feature_name, num_levels = 256, 
-        noise_scale = 0.0):
+        noise_scale = 0.0, window = None):
         """For a given patient, nodule and feature name returns the feature
         value for the 50% consenus annotation.
         
@@ -246,18 +771,25 @@ class DBDriver():
             The number of quantisation levels
         noise_scale : float 
             The noise scale.
+        window : tuple of float (lower_bound, upper_bound)
+            The CT window (see read_feature_value()).
         
         Returns
         -------
         feature_value : float
             The feature value.
         """
+        if window is None:
+            window = self.default_window
         command_str = f"SELECT {self._mangle_feature_name(feature_name)} FROM features "+\
                       f"WHERE patient_id = '{patient_id}' "+\
                       f"AND nodule_id = {nodule_id} "+\
                       f"AND num_levels = {num_levels} "+\
                       f"AND noise_scale = {noise_scale} "+\
-                      f"AND annotation_id == -1"
+                      f"AND window_lower = {float(window[0])} "+\
+                      f"AND window_upper = {float(window[1])} "+\
+                      f"AND annotation_id == -1"+\
+                      self._fingerprint_condition()
         rows = self._execute_query(command_str)
         
         #If there's more than one row there's something wrong
@@ -268,6 +800,97 @@ class DBDriver():
         return feature_value
     
     
+    def get_feature_matrix(self, feature_names = None, filters = None):
+        """Feature values for all the experimental conditions matching the 
+        given filters, arranged as a matrix (design matrix). The values are
+        read with a single SELECT on the requested feature columns only.
+        
+        Parameters
+        ----------
+        feature_names : list of str (optional)
+            The names of the features to retrieve. If None all the features
+            available are returned.
+        filters : dict (optional)
+            Restricts the experimental conditions returned. Keys are the 
+            names of the columns that identify one condition (patient_id, 
+            nodule_id, annotation_id, num_levels, noise_scale, window_lower
+            and window_upper), values either one value or a list of accepted
+            values. For instance {'annotation_id' : -1, 'num_levels' : [32, 
+            64]}. All the windows are returned unless filtered. Only the 
+            rows computed with the settings of this driver are returned.
+        
+        Returns
+        -------
+        values : 2D nparray of float (num_conditions x num_features)
+            The feature values. Missing values are NaN.
+        coords : OrderedDict of 1D nparray
+            The experimental condition of each row of values. Keys are 
+            patient_id, nodule_id, annotation_id, num_levels, noise_scale, 
+            window_lower and window_upper.
+        """
+        
+        if feature_names is None:
+            feature_names = self.get_feature_names()
+        if filters is None:
+            filters = dict()
+        
+        key = list()
+        for column, accepted in filters.items():
+            if not isinstance(accepted, (list, tuple, set, np.ndarray)):
+                accepted = [accepted]
+            key.append((column, tuple(_to_python(x) for x in accepted)))
+        key = ('matrix', tuple(feature_names), tuple(sorted(key)))
+        values, coords = self._cached(key, lambda: self._read_feature_matrix(
+            feature_names, filters))
+        return values.copy(), OrderedDict([(column, array.copy()) 
+                                           for column, array in coords.items()])
+    
+    def _read_feature_matrix(self, feature_names, filters):
+        """See get_feature_matrix()"""
+        
+        #Build the WHERE clause
+        conditions = list()
+        parameters = list()
+        for column, accepted in filters.items():
+            if column not in self._key_columns:
+                raise Exception(f'Cannot filter by {column}')
+            if not isinstance(accepted, (list, tuple, set, np.ndarray)):
+                accepted = [accepted]
+            accepted = [x.item() if isinstance(x, np.generic) else x 
+                        for x in accepted]
+            placeholders = ', '.join(['?'] * len(accepted))
+            conditions.append(f"{column} IN ({placeholders})")
+            parameters.extend(accepted)
+        if self._fingerprint is not None:
+            conditions.append("settings_fingerprint = ?")
+            parameters.append(self._fingerprint)
+        where = ""
+        if len(conditions) > 0:
+            where = " WHERE " + " AND ".join(conditions)
+        
+        #Read the rows with one statement (a consistent snapshot even while
+        #other connections are writing)
+        key_columns = list(self._key_columns.keys())
+        feature_columns = [self._mangle_feature_name(f) for f in feature_names]
+        command_str = f"SELECT {', '.join(key_columns + feature_columns)} "+\
+                      f"FROM features{where} "+\
+                      f"ORDER BY {', '.join(key_columns)}"
+        rows = self._execute_query(command_str, parameters)
+        
+        #Fill the output arrays
+        num_rows = len(rows)
+        values = np.empty((num_rows, len(feature_names)), dtype = np.float64)
+        coords = OrderedDict()
+        for column, dtype in self._key_columns.items():
+            coords[column] = np.empty(num_rows, dtype = dtype)
+        num_keys = len(key_columns)
+        for r, row in enumerate(rows):
+            for c, column in enumerate(key_columns):
+                coords[column][r] = row[c]
+            values[r, :] = [np.nan if x is None else x for x in row[num_keys:]]
+        
+        return values, coords
+    
     def get_patients_ids(self):
         """Returns the unique list of patients' ids
         
@@ -277,8 +900,10 @@ class DBDriver():
             The unique list of patients' ids
         """
         
-        command_str = f"SELECT DISTINCT patient_id FROM features"
-        rows = self._execute_query(command_str)    
+        command_str = f"SELECT DISTINCT patient_id FROM features WHERE 1"+\
+                      self._fingerprint_condition()
+        rows = self._cached(('patient_ids',), 
+                            lambda: self._execute_query(command_str))
         patients_ids = [row[0] for row in rows]
         return patients_ids
     
@@ -297,8 +922,10 @@ class DBDriver():
         """
         
         command_str = f"SELECT DISTINCT nodule_id FROM features "+\
-                      f"WHERE patient_id='{patient_id}'"
-        rows = self._execute_query(command_str)    
+                      f"WHERE patient_id='{patient_id}'"+\
+                      self._fingerprint_condition()
+        rows = self._cached(('nodule_ids', patient_id), 
+                            lambda: self._execute_query(command_str))
         nodules_ids = [row[0] for row in rows]
         return nodules_ids
     
@@ -322,14 +949,224 @@ class DBDriver():
         command_str = f"SELECT DISTINCT annotation_id FROM features "+\
                       f"WHERE patient_id='{patient_id}' "+\
                       f"AND nodule_id='{nodule_id}' "+\
-                      f"AND annotation_id != -1 "
-        rows = self._execute_query(command_str)    
+                      f"AND annotation_id != -1"+\
+                      self._fingerprint_condition()
+        rows = self._cached(('annotation_ids', patient_id, 
+                             _to_python(nodule_id)), 
+                            lambda: self._execute_query(command_str))
         annotation_ids = [row[0] for row in rows]
         return annotation_ids    
         
+    def get_num_noise_replicates(self, patient_id, nodule_id, annotation_id,
+                                 num_levels, noise_scale, feature_names, 
+                                 window = None):
+        """Number of noise replicates summarised in the database for the 
+        given experimental condition.
+        
+        Parameters
+        ----------
+        patient_id : str 
+            The patient id.
+        nodule_id : int 
+            The nodule id.
+        annotation_id : int
+            The annotation id.
+        num_levels : int [> 0] 
+            The number of quantisation levels.
+        noise_scale : float 
+            The noise scale.
+        feature_names : list of str
+            The names of the features.
+        window : tuple of float (lower_bound, upper_bound)
+            The CT window (see read_feature_value()).
+        
+        Returns
+        -------
+        num_replicates : int
+            The number of replicates. Zero if any of the features is missing.
+        """
+        
+        condition = self.__class__._experimental_condition(
+            *self.__class__._condition_key(patient_id, nodule_id, 
+                                           annotation_id, num_levels, 
+                                           noise_scale, window))
+        command_str = f"SELECT feature_name, num_replicates "+\
+                      f"FROM noise_statistics WHERE {condition}"+\
+                      self._fingerprint_condition()
+        num_replicates_by_feature = dict(self._execute_query(command_str))
+        num_replicates = [num_replicates_by_feature.get(f, 0) 
+                          for f in feature_names]
+        return min(num_replicates, default = 0)
+    
+    def get_noise_statistics(self, annotation_id, num_levels, noise_scale,
+                             window = None):
+        """Returns the noise robustness summaries of all the nodules for the 
+        given annotation, number of levels, noise scale and window.
+        
+        Parameters
+        ----------
+        annotation_id : int
+            The annotation id.
+        num_levels : int [> 0] 
+            The number of quantisation levels.
+        noise_scale : float 
+            The noise scale.
+        window : tuple of float (lower_bound, upper_bound)
+            The CT window (see read_feature_value()).
+        
+        Returns
+        -------
+        rows : list of tuple
+            Each a tuple (patient_id, nodule_id, feature_name, num_replicates,
+            mean, variance, avg_smape).
+        """
+        
+        if window is None:
+            window = self.default_window
+        command_str = f"SELECT patient_id, nodule_id, feature_name, "+\
+                      f"num_replicates, mean, variance, avg_smape "+\
+                      f"FROM noise_statistics "+\
+                      f"WHERE annotation_id = {annotation_id} "+\
+                      f"AND num_levels = {num_levels} "+\
+                      f"AND noise_scale = {noise_scale} "+\
+                      f"AND window_lower = {float(window[0])} "+\
+                      f"AND window_upper = {float(window[1])}"+\
+                      self._fingerprint_condition()+\
+                      f" ORDER BY patient_id, nodule_id, feature_name"
+        return self._execute_query(command_str)
+    
+    def write_noise_statistics(self, patient_id, nodule_id, annotation_id, 
+                               num_levels, noise_scale, feature_names, 
+                               statistics, window = None):
+        """Stores (inserts or replaces) the noise robustness summaries of one
+        experimental condition in one transaction.
+        
+        Parameters
+        ----------
+        patient_id : str 
+            The patient id.
+        nodule_id : int 
+            The nodule id.
+        annotation_id : int
+            The annotation id.
+        num_levels : int [> 0] 
+            The number of quantisation levels.
+        noise_scale : float 
+            The noise scale.
+        feature_names : list of str
+            The names of the features.
+        statistics : RunningStatistics
+            The statistics of the features over the noise replicates (same 
+            order as feature_names).
+        window : tuple of float (lower_bound, upper_bound)
+            The CT window (see read_feature_value()).
+        """
+        
+        condition = self.__class__._condition_key(
+            patient_id, nodule_id, annotation_id, num_levels, noise_scale, 
+            window)
+        records = [condition + 
+                   (feature_name, statistics.count, _to_python(mean), 
+                    _to_python(variance), _to_python(avg_smape), 
+                    self._fingerprint)
+                   for feature_name, mean, variance, avg_smape in zip(
+                       feature_names, statistics.mean, statistics.variance,
+                       statistics.avg_smape)]
+        self._execute_transaction(lambda cur: cur.executemany(
+            "INSERT OR REPLACE INTO noise_statistics VALUES "+\
+            "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", records))
+    
+    def get_roi_sizes(self, patient_id):
+        """Returns the cached ROI sizes of a scan (see write_roi_sizes()).
+        
+        Parameters
+        ----------
+        patient_id : str 
+            The patient id.
+        
+        Returns
+        -------
+        sizes : OrderedDict
+            sizes[(nodule_id, annotation_id)] is a tuple (num_voxels, 
+            bbox_volume). Empty if the sizes are not in the database.
+        """
+        
+        command_str = f"SELECT nodule_id, annotation_id, num_voxels, "+\
+                      f"bbox_volume FROM roi_sizes "+\
+                      f"WHERE patient_id = '{patient_id}' "+\
+                      f"ORDER BY nodule_id, annotation_id"
+        rows = self._execute_query(command_str)
+        return OrderedDict([((row[0], row[1]), (row[2], row[3])) 
+                            for row in rows])
+    
+    def write_roi_sizes(self, patient_id, sizes):
+        """Stores (inserts or replaces) the ROI sizes of a scan.
+        
+        Parameters
+        ----------
+        patient_id : str 
+            The patient id.
+        sizes : dict
+            sizes[(nodule_id, annotation_id)] is a tuple (num_voxels, 
+            bbox_volume).
+        """
+        records = [(patient_id, _to_python(nodule_id), 
+                    _to_python(annotation_id), _to_python(num_voxels), 
+                    _to_python(bbox_volume)) 
+                   for (nodule_id, annotation_id), (num_voxels, bbox_volume)
+                   in sizes.items()]
+        self._execute_transaction(lambda cur: cur.executemany(
+            "INSERT OR REPLACE INTO roi_sizes VALUES (?, ?, ?, ?, ?)", 
+            records))
+    
+    def read_roi_results(self, roi_digest, feature_names):
+        """Reads the feature values stored for a ROI content (see 
+        write_roi_results()).
+        
+        Parameters
+        ----------
+        roi_digest : str
+            The digest of the ROI content (see functions.roi_digest()).
+        feature_names : list of str
+            The names of the features to read.
+        
+        Returns
+        -------
+        feature_values : dict
+            The values found (feature_name : feature_value); features with
+            no value stored are not included.
+        """
+        
+        command_str = f"SELECT feature_name, feature_value FROM roi_results "+\
+                      f"WHERE roi_digest = '{roi_digest}'"+\
+                      self._fingerprint_condition()
+        rows = self._execute_query(command_str)
+        feature_names = set(feature_names)
+        return {row[0] : row[1] for row in rows 
+                if (row[0] in feature_names) and (row[1] is not None)}
+    
+    def write_roi_results(self, roi_digest, feature_values):
+        """Stores (inserts or replaces) the feature values computed on a ROI
+        content, so that they can be reused for any ROI with the same 
+        content regardless of the patient, nodule and annotation.
+        
+        Parameters
+        ----------
+        roi_digest : str
+            The digest of the ROI content (see functions.roi_digest()).
+        feature_values : dict
+            The values to store (feature_name : feature_value).
+        """
+        records = [(roi_digest, feature_name, _to_python(feature_value), 
+                    self._fingerprint) 
+                   for feature_name, feature_value in feature_values.items()]
+        self._execute_transaction(lambda cur: cur.executemany(
+            "INSERT OR REPLACE INTO roi_results VALUES (?, ?, ?, ?)", 
+            records))
+    
     def write_feature_value(self, patient_id, nodule_id, annotation_id, 
                             num_levels, noise_scale, feature_name, 
-                            feature_value):
+                            feature_value, window = None):
         """Writes one feature value into the database
         
         Parameters
@@ -346,60 +1183,734 @@ class DBDriver():
             The noise scale.
         feature_name : str
             The name of the feature to retrieve.
+        feature_value : float
+            The value of the feature.
+        window : tuple of float (lower_bound, upper_bound)
+            The CT window (see read_feature_value()).
         """
         
-        #Add a new row if necessary or update a field value if the row already 
-        #exists
-        row = self._get_row(patient_id, nodule_id, annotation_id, num_levels, 
-                            noise_scale)
-        feature_name = self.__class__._mangle_feature_name(feature_name)
-        command_str = None        
-        
-        if row:
-            #Update field in the corresponding row
-            condition = self.__class__._experimental_condition(
-                patient_id, nodule_id, annotation_id, num_levels, noise_scale)
-            command_str = f"UPDATE features SET {feature_name}={feature_value} "+\
-                          f"WHERE {condition}"
-        else:    
-            #Create a new row
-            fields = "INSERT INTO features (patient_id, nodule_id, "+\
-                     "annotation_id, num_levels, noise_scale, "+\
-                    f"{feature_name}) "   
-            values = f"VALUES ('{patient_id}', {nodule_id}, "+\
-                     f"{annotation_id}, {num_levels}, {noise_scale}, "+\
-                     f"{feature_value})"
-            command_str = fields + values
-        
-        cur = self._connection.cursor()
-        cur.execute(command_str)
-        self._connection.commit() 
+        self.write_feature_values([(patient_id, nodule_id, annotation_id, 
+                                    num_levels, noise_scale, feature_name, 
+                                    feature_value)], window = window)
+    
+    def write_feature_values(self, records, window = None):
+        """Writes multiple feature values into the database in one 
+        transaction. Values of the same experimental condition are written 
+        with one statement.
+        
+        Parameters
+        ----------
+        records : iterable of tuple
+            The values to write, each a tuple (patient_id, nodule_id, 
+            annotation_id, num_levels, noise_scale, feature_name, 
+            feature_value) - see write_feature_value().
+        window : tuple of float (lower_bound, upper_bound)
+            The CT window of all the values (see read_feature_value()).
+        """
+        self._write_values([(self.__class__._condition_key(*record[:5], 
+                                                           window), 
+                             record[5], record[6]) for record in records])
+    
+    def _write_values(self, values):
+        """Writes values given as (condition, feature_name, feature_value), 
+        where condition is the tuple of the key columns (see 
+        _condition_key()) - see write_feature_values()"""
+        
+        #Group the values by experimental condition
+        values_by_condition = OrderedDict()
+        for condition, feature_name, feature_value in values:
+            feature_name = self.__class__._mangle_feature_name(feature_name)
+            values_by_condition.setdefault(condition, OrderedDict())
+            values_by_condition[condition][feature_name] = \
+                _to_python(feature_value)
+        
+        #Add a new row if necessary or update the fields if the row already 
+        #exists. Check and write within the same transaction so that 
+        #concurrent writers cannot create duplicate rows.
+        key_columns = list(self._key_columns.keys()) + ['settings_fingerprint']
+        inserted = list()
+        def commands(cur):
+            inserted.clear()
+            all_feature_columns = None
+            for condition, values in values_by_condition.items():
+                where = self.__class__._experimental_condition(*condition)
+                feature_columns = list(values.keys())
+                cur.execute(f"SELECT settings_fingerprint FROM features "+\
+                            f"WHERE {where}")
+                rows = cur.fetchall()
+                if len(rows) > 0:
+                    #Update fields in the corresponding row
+                    assignments = [f"{c}=?" for c in feature_columns]
+                    parameters = list(values.values())
+                    
+                    #The other values of a row computed with other settings
+                    #are stale: reset them (to be recomputed) and tag the row
+                    #with the current settings
+                    if (self._fingerprint is not None) and \
+                       (rows[0][0] != self._fingerprint):
+                        if all_feature_columns is None:
+                            cur.execute("SELECT name FROM "+\
+                                        "PRAGMA_TABLE_INFO('features')")
+                            all_feature_columns = [
+                                row[0] for row in cur.fetchall() 
+                                if row[0] not in key_columns]
+                        assignments += [f"{c}=NULL" for c in 
+                                        all_feature_columns 
+                                        if c not in values]
+                        assignments.append("settings_fingerprint=?")
+                        parameters.append(self._fingerprint)
+                        
+                        #The row becomes visible to this driver (see the 
+                        #queries on the ids)
+                        inserted.append(condition)
+                    cur.execute(f"UPDATE features SET "+\
+                                f"{', '.join(assignments)} WHERE {where}", 
+                                parameters)
+                else:
+                    #Create a new row
+                    columns = ', '.join(key_columns + feature_columns)
+                    placeholders = ', '.join(
+                        ['?'] * (len(key_columns) + len(feature_columns)))
+                    cur.execute(f"INSERT INTO features ({columns}) "+\
+                                f"VALUES ({placeholders})", 
+                                list(condition) + [self._fingerprint] +\
+                                list(values.values()))
+                    inserted.append(condition)
+        
+        self._execute_transaction(commands)
+        self._invalidate(values_by_condition, inserted)
            
-    def __init__(self, feature_names, db_file):
+    def get_stale_conditions(self):
+        """Experimental conditions whose values were not computed with the 
+        settings of this driver: those with a different fingerprint and those
+        with no fingerprint recorded (computed before the settings were 
+        tracked). These are recomputed by the next extraction run.
+        
+        Returns
+        -------
+        stale_conditions : list of tuple
+            Each a tuple (patient_id, nodule_id, annotation_id, num_levels, 
+            noise_scale, window_lower, window_upper, settings_fingerprint),
+            where settings_fingerprint is the one stored (None if unknown).
+        """
+        
+        if self._fingerprint is None:
+            raise Exception('The driver has no settings fingerprint')
+        key_columns = ', '.join(self._key_columns.keys())
+        command_str = f"SELECT {key_columns}, settings_fingerprint "+\
+                      f"FROM features WHERE settings_fingerprint IS NULL "+\
+                      f"OR settings_fingerprint != '{self._fingerprint}' "+\
+                      f"ORDER BY {key_columns}"
+        return self._execute_query(command_str)
+    
+    def count_stale_results(self):
+        """Number of stale rows (see get_stale_conditions()) in each of the 
+        tables of results.
+        
+        Returns
+        -------
+        counts : OrderedDict
+            counts[table] is an OrderedDict that maps each fingerprint other 
+            than the one of this driver (None if unknown) to the number of
+            rows, for table in features, noise_statistics and roi_results.
+        """
+        
+        if self._fingerprint is None:
+            raise Exception('The driver has no settings fingerprint')
+        counts = OrderedDict()
+        for table in ['features', 'noise_statistics', 'roi_results']:
+            command_str = f"SELECT settings_fingerprint, COUNT(*) "+\
+                          f"FROM {table} WHERE settings_fingerprint IS NULL "+\
+                          f"OR settings_fingerprint != '{self._fingerprint}' "+\
+                          f"GROUP BY settings_fingerprint "+\
+                          f"ORDER BY settings_fingerprint"
+            counts[table] = OrderedDict(self._execute_query(command_str))
+        return counts
+    
+    def tag_untagged_results(self):
+        """Tags the rows with no settings fingerprint (computed before the 
+        settings were tracked) with the fingerprint of this driver. Use this
+        only if these values are known to have been computed with the 
+        current settings, to avoid recomputing them.
+        
+        Returns
+        -------
+        num_rows : int
+            The number of rows tagged (all the tables).
+        """
+        
+        if self._fingerprint is None:
+            raise Exception('The driver has no settings fingerprint')
+        num_rows = list()
+        def commands(cur):
+            num_rows.clear()
+            for table in ['features', 'noise_statistics', 'roi_results']:
+                cur.execute(f"UPDATE {table} SET settings_fingerprint = ? "+\
+                            f"WHERE settings_fingerprint IS NULL", 
+                            (self._fingerprint,))
+                num_rows.append(cur.rowcount)
+        self._execute_transaction(commands)
+        self.clear_cache()
+        return sum(num_rows)
+    
+    def export_parquet(self, folder, feature_names = None):
+        """Exports the feature values to a Parquet dataset partitioned by 
+        number of levels and noise scale (hive layout: 
+        folder/num_levels=<value>/noise_scale=<value>/features.parquet), 
+        which can be read one column at a time (see ParquetFeatureStore). 
+        The files of the partitions in the database are replaced; requires 
+        pyarrow. Only the rows computed with the settings of this driver are
+        exported.
+        
+        Parameters
+        ----------
+        folder : str
+            The root folder of the dataset (created if it does not exist).
+        feature_names : list of str (optional)
+            The features to export. If None all the features available are
+            exported.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        
+        if feature_names is None:
+            feature_names = self.get_feature_names()
+        
+        partitions = self._execute_query(
+            "SELECT DISTINCT num_levels, noise_scale FROM features "+\
+            "WHERE 1"+ self._fingerprint_condition() +\
+            " ORDER BY num_levels, noise_scale")
+        for num_levels, noise_scale in partitions:
+            values, coords = self._read_feature_matrix(
+                feature_names, {'num_levels' : num_levels, 
+                                'noise_scale' : noise_scale})
+            columns = OrderedDict()
+            for column in ParquetFeatureStore._row_columns:
+                columns[column] = pa.array(coords[column])
+            for f, feature_name in enumerate(feature_names):
+                columns[feature_name] = pa.array(values[:, f])
+            partition_folder = join(
+                folder, f'num_levels={num_levels}', 
+                f'noise_scale={float(noise_scale)!r}')
+            makedirs(partition_folder, exist_ok = True)
+            pq.write_table(pa.table(columns), 
+                           join(partition_folder, 'features.parquet'))
+    
+    def __getstate__(self):
+        #Connections cannot be pickled: the unpickled driver opens its own
+        state = self.__dict__.copy()
+        del state['_local']
+        
+        #The cache is not copied (nor its lock, which cannot be pickled)
+        for attribute in ['_cache', '_cache_lock']:
+            del state[attribute]
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        
+    def __init__(self, feature_names, db_file, journal_mode = 'WAL', 
+                 synchronous = None, busy_timeout = 30.0, max_retries = 5,
+                 cache_size = 0, fingerprint = None):
         """Opens a connection to the db_file if this exists, otherwise creates
-        a new file.
+        a new file. The columns of the features not yet in an existing file 
+        are added.
         
         Parameters
         ----------
         feature_names : list of str
             The names of the features to compute. 
-        num_levels : list of int
-            The number of levels for signal quantisation.
-        noise_scales : list of float
-            The noise intensity.
         db_file : str
             Path to the database file (.db).
+        journal_mode : str
+            SQLite journal mode (e.g. 'WAL' or 'DELETE'). None leaves the 
+            mode of the database file unchanged.
+        synchronous : str
+            SQLite synchronous setting (e.g. 'NORMAL', which is safe with WAL 
+            and avoids one fsync per transaction, or 'FULL'). None uses the
+            SQLite default.
+        busy_timeout : float (>= 0)
+            Seconds a connection waits for a lock held by another one before
+            raising 'database is locked'.
+        max_retries : int (>= 0)
+            Number of times an operation that failed because the database was
+            locked is retried (with exponential backoff).
+        cache_size : int (>= 0)
+            Maximum number of query results kept in the read cache (0 = no 
+            cache). Each entry is one feature value, one list of ids or one 
+            feature matrix.
+        fingerprint : str (optional)
+            The fingerprint of the current extraction settings (see 
+            settings_fingerprint()). The values written are tagged
+            with it and only the values with the same fingerprint are read.
+            If None the fingerprints are neither checked nor recorded.
         """
         
         self._feature_names = feature_names
         self._db_file = db_file
-        self._connection = None
+        self._journal_mode = journal_mode
+        self._synchronous = synchronous
+        self._busy_timeout = busy_timeout
+        self._max_retries = max_retries
+        self._fingerprint = fingerprint
+        self._local = threading.local()
+        self._cache_size = cache_size
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._cache_generation = 0
+        self._cache_hits = 0
+        self._cache_misses = 0
         
-        if isfile(db_file):
-            self._connection = sqlite3.connect(self._db_file)
-        else:
+        if not isfile(db_file):
             self._create_new()
+        self._add_missing_columns()
+        self._create_auxiliary_tables()
+    
+
+def _exit_on_sigterm():
+    """Turns SIGTERM into SystemExit (so that the atexit handlers run) unless 
+    the signal is already handled or this is not the main thread"""
+    if threading.current_thread() is not threading.main_thread():
+        return
+    if signal.getsignal(signal.SIGTERM) is signal.SIG_DFL:
+        def handler(signum, frame):
+            raise SystemExit(128 + signum)
+        signal.signal(signal.SIGTERM, handler)
+
+def _flushing(method):
+    """Wraps a DBDriver read method so that the pending writes are committed
+    before the query is executed"""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self.flush()
+        return method(self, *args, **kwargs)
+    return wrapper
+
+#Markers put in the queue of WriteBehindDBDriver
+_flush_marker = object()
+_stop_marker = object()
+
+class WriteBehindDBDriver(DBDriver):
+    """DBDriver that writes the feature values in the background. 
+    
+    Values passed to write_feature_value() and write_feature_values() are 
+    put in a bounded queue and return immediately; a writer thread collects 
+    them into batches which are committed in one transaction when batch_size
+    values are pending or flush_interval seconds after the first one. Values 
+    not yet committed are visible to read_feature_value() and 
+    resolve_feature_value(); the other read methods commit them first. 
+    Pending values are committed by flush(), close(), at interpreter exit and
+    on SIGTERM."""
+    
+    def _start_writer(self):
+        """Creates the queue and starts the writer thread of the calling 
+        process"""
+        self._queue = queue.Queue(maxsize = self._max_pending)
+        self._pending = dict()
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._error = None
+        self._closed = False
+        self._writer_pid = getpid()
+        self._writer = threading.Thread(target = self._write_behind, 
+                                        daemon = True)
+        self._writer.start()
+        atexit.register(self.close)
+    
+    def _ensure_writer(self):
+        """Starts a new writer in a child process after fork() (the writer 
+        thread of the parent is not inherited)"""
+        if self._writer_pid != getpid():
+            self._start_writer()
+        if self._closed:
+            raise Exception('Write-behind driver already closed')
+    
+    def _raise_writer_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise Exception('Failed to write the feature values to the '
+                            'database') from error
+    
+    def _write_behind(self):
+        """Body of the writer thread"""
+        batch = list()
+        num_items = 0
+        deadline = None
+        while True:
+            timeout = None
+            if deadline is not None:
+                timeout = max(deadline - time.monotonic(), 0.0)
+            try:
+                item = self._queue.get(timeout = timeout)
+                num_items += 1
+            except queue.Empty:
+                item = None
+            
+            if isinstance(item, tuple):
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self._flush_interval
+                if len(batch) < self._batch_size:
+                    continue
             
+            #Commit the batch (full, timed out or flush requested) and release
+            #whoever is waiting on the queue
+            if len(batch) > 0:
+                self._commit(batch)
+            batch = list()
+            deadline = None
+            for _ in range(num_items):
+                self._queue.task_done()
+            num_items = 0
+            
+            if item is _stop_marker:
+                DBDriver.close(self)
+                return
+    
+    def _commit(self, batch):
+        """Writes a batch of (seq, key, value) and removes the corresponding 
+        values from the pending ones - unless overwritten in the meantime"""
+        try:
+            DBDriver._write_values(self, [item[2] for item in batch])
+        except BaseException as error:
+            self._error = error
+        with self._lock:
+            for seq, key, _ in batch:
+                if self._pending.get(key, (None,))[0] == seq:
+                    del self._pending[key]
+    
+    @classmethod
+    def _pending_key(cls, patient_id, nodule_id, annotation_id, num_levels, 
+                     noise_scale, feature_name, window = None):
+        return cls._condition_key(patient_id, nodule_id, annotation_id, 
+                                  num_levels, noise_scale, window) + \
+            (cls._mangle_feature_name(feature_name),)
+    
+    def write_feature_values(self, records, window = None):
+        """Queues multiple feature values for writing. Blocks only if 
+        max_pending values are already waiting in the queue.
+        
+        Parameters
+        ----------
+        records : iterable of tuple
+            The values to write, each a tuple (patient_id, nodule_id, 
+            annotation_id, num_levels, noise_scale, feature_name, 
+            feature_value) - see DBDriver.write_feature_value().
+        window : tuple of float (lower_bound, upper_bound)
+            The CT window of all the values (see 
+            DBDriver.read_feature_value()).
+        """
+        self._ensure_writer()
+        self._raise_writer_error()
+        for record in records:
+            key = self.__class__._pending_key(*record[:6], window)
+            with self._lock:
+                self._seq += 1
+                seq = self._seq
+                self._pending[key] = (seq, record[6])
+            self._queue.put((seq, key, (key[:-1], record[5], record[6])))
+    
+    def read_feature_value(self, patient_id, nodule_id, annotation_id, 
+                           num_levels, noise_scale, feature_name, 
+                           window = None):
+        key = self.__class__._pending_key(patient_id, nodule_id, 
+                                          annotation_id, num_levels, 
+                                          noise_scale, feature_name, window)
+        with self._lock:
+            if key in self._pending:
+                return self._pending[key][1]
+        return super().read_feature_value(patient_id, nodule_id, 
+                                          annotation_id, num_levels, 
+                                          noise_scale, feature_name, 
+                                          window = window)
+    read_feature_value.__doc__ = DBDriver.read_feature_value.__doc__
+    
+    def get_missing_features(self, patient_id, nodule_id, annotation_id, 
+                             num_levels, noise_scale, feature_names, 
+                             window = None):
+        missing_features = super().get_missing_features(
+            patient_id, nodule_id, annotation_id, num_levels, noise_scale, 
+            feature_names, window = window)
+        with self._lock:
+            return [f for f in missing_features if self.__class__._pending_key(
+                patient_id, nodule_id, annotation_id, num_levels, noise_scale,
+                f, window) not in self._pending]
+    get_missing_features.__doc__ = DBDriver.get_missing_features.__doc__
+    
+    def resolve_feature_value(self, patient_id, nodule_id, annotation_id, 
+                              feature_name, num_levels = None, 
+                              noise_scale = None, window = None):
+        
+        #None matches any value
+        window_lower, window_upper = (None, None) if window is None else \
+            (float(window[0]), float(window[1]))
+        key = (_to_python(patient_id), _to_python(nodule_id), 
+               _to_python(annotation_id), _to_python(num_levels), 
+               _to_python(noise_scale), window_lower, window_upper, 
+               self.__class__._mangle_feature_name(feature_name))
+        with self._lock:
+            for pending_key, (_, value) in self._pending.items():
+                if value is None:
+                    continue
+                if all([(k is None) or (k == p) 
+                        for k, p in zip(key, pending_key)]):
+                    return value
+        return super().resolve_feature_value(
+            patient_id, nodule_id, annotation_id, feature_name, 
+            num_levels = num_levels, noise_scale = noise_scale, 
+            window = window)
+    resolve_feature_value.__doc__ = DBDriver.resolve_feature_value.__doc__
+    
+    get_feature_values_by_annotation = _flushing(
+        DBDriver.get_feature_values_by_annotation)
+    get_feature_value_on_consensus_annotation = _flushing(
+        DBDriver.get_feature_value_on_consensus_annotation)
+    get_feature_matrix = _flushing(DBDriver.get_feature_matrix)
+    get_patients_ids = _flushing(DBDriver.get_patients_ids)
+    get_nodule_ids_by_patient = _flushing(DBDriver.get_nodule_ids_by_patient)
+    get_annotation_ids_by_nodule = _flushing(
+        DBDriver.get_annotation_ids_by_nodule)
+    export_parquet = _flushing(DBDriver.export_parquet)
+    get_stale_conditions = _flushing(DBDriver.get_stale_conditions)
+    count_stale_results = _flushing(DBDriver.count_stale_results)
+    tag_untagged_results = _flushing(DBDriver.tag_untagged_results)
+    
+    def flush(self):
+        """Waits until all the values queued so far are committed"""
+        if (self._writer_pid == getpid()) and (not self._closed):
+            self._queue.put(_flush_marker)
+            self._queue.join()
+        self._raise_writer_error()
+    
+    def close(self):
+        """Commits the pending values, stops the writer thread and closes the 
+        connection of the calling thread"""
+        if (self._writer_pid == getpid()) and (not self._closed):
+            self._closed = True
+            atexit.unregister(self.close)
+            self._queue.put(_stop_marker)
+            self._writer.join()
+        super().close()
+        self._raise_writer_error()
+    
+    def __getstate__(self):
+        #The queue, lock and writer thread cannot be pickled: commit the 
+        #pending values, the unpickled driver starts its own writer
+        self.flush()
+        state = super().__getstate__()
+        for attribute in ['_queue', '_pending', '_lock', '_writer']:
+            del state[attribute]
+        return state
+    
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self._start_writer()
+    
+    def __init__(self, feature_names, db_file, batch_size = 256, 
+                 flush_interval = 1.0, max_pending = 4096, **kwargs):
+        """Opens a connection to the db_file if this exists, otherwise creates
+        a new file, and starts the writer thread.
+        
+        Parameters
+        ----------
+        feature_names : list of str
+            The names of the features to compute. 
+        db_file : str
+            Path to the database file (.db).
+        batch_size : int (> 0)
+            Maximum number of values committed in one transaction.
+        flush_interval : float (>= 0)
+            Maximum time (seconds) a value waits in the queue before being
+            committed.
+        max_pending : int (>= 0)
+            Maximum number of values waiting in the queue (0 = unbounded). 
+            Further writes block until the writer catches up.
+        **kwargs
+            Connection settings (see DBDriver.__init__()).
+        """
+        super().__init__(feature_names, db_file, **kwargs)
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._max_pending = max_pending
+        self._start_writer()
+        _exit_on_sigterm()
+
+class StatisticsCache():
+    """Persistent cache of statistics computed on the feature values (e.g. 
+    the SMAPE of one feature on one nodule). Each value is stored with the 
+    fingerprint of the feature values it was computed from, so that it can be
+    reused as long as these do not change."""
+    
+    def _connect(self):
+        connection = sqlite3.connect(self._db_file, timeout = 30.0)
+        connection.execute("PRAGMA journal_mode=WAL")
+        return connection
+    
+    def read(self, analysis):
+        """Returns the values stored for the given analysis.
+        
+        Parameters
+        ----------
+        analysis : str
+            Identifier of the analysis and of its settings.
+        
+        Returns
+        -------
+        entries : dict
+            The stored values, as {(feature_name, patient_id, nodule_id) : 
+            (fingerprint, value)}.
+        """
+        connection = self._connect()
+        try:
+            rows = connection.execute(
+                "SELECT feature_name, patient_id, nodule_id, fingerprint, "+\
+                "value FROM statistics WHERE analysis = ?", 
+                (analysis,)).fetchall()
+        finally:
+            connection.close()
+        return {(row[0], row[1], row[2]) : (row[3], row[4]) for row in rows}
+    
+    def write(self, analysis, records):
+        """Stores (inserts or replaces) values for the given analysis in one 
+        transaction.
+        
+        Parameters
+        ----------
+        analysis : str
+            Identifier of the analysis and of its settings.
+        records : iterable of tuple
+            The values to store, each a tuple (feature_name, patient_id, 
+            nodule_id, fingerprint, value).
+        """
+        connection = self._connect()
+        try:
+            with connection:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO statistics (analysis, "+\
+                    "feature_name, patient_id, nodule_id, fingerprint, "+\
+                    "value) VALUES (?, ?, ?, ?, ?, ?)", 
+                    [(analysis,) + tuple(_to_python(x) for x in record) 
+                     for record in records])
+        finally:
+            connection.close()
+    
+    def __init__(self, db_file):
+        """Opens the db_file if this exists, otherwise creates a new file.
+        
+        Parameters
+        ----------
+        db_file : str
+            Path to the database file (.db).
+        """
+        self._db_file = db_file
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS statistics (analysis text, "+\
+                    "feature_name text, patient_id text, nodule_id integer, "+\
+                    "fingerprint text, value real, PRIMARY KEY (analysis, "+\
+                    "feature_name, patient_id, nodule_id))")
+        finally:
+            connection.close()
+
+class ParquetFeatureStore():
+    """Read-only access to the feature values exported by 
+    DBDriver.export_parquet(), with the same read methods as DBDriver for 
+    the analyses. Only the columns requested are read (memory-mapped) and 
+    the filters on the number of levels and noise scale skip the other 
+    partitions entirely. Requires pyarrow."""
+    
+    #Columns stored in each row (the others identify the partition)
+    _row_columns = ['patient_id', 'nodule_id', 'annotation_id', 
+                    'window_lower', 'window_upper']
+    
+    def _read(self, columns, filters = None):
+        """Table with the given columns of the rows matching filters (list
+        of (column, operator, value) as in pyarrow.parquet.read_table())"""
+        import pyarrow.parquet as pq
+        return pq.read_table(self._folder, columns = columns, 
+                             filters = filters or None, 
+                             partitioning = self._partitioning, 
+                             memory_map = True)
+    
+    def get_feature_names(self):
+        return self._feature_names
+    
+    def get_feature_matrix(self, feature_names = None, filters = None):
+        if feature_names is None:
+            feature_names = self.get_feature_names()
+        if filters is None:
+            filters = dict()
+        
+        #Convert the filters into the pyarrow format
+        expressions = list()
+        for column, accepted in filters.items():
+            if column not in DBDriver._key_columns:
+                raise Exception(f'Cannot filter by {column}')
+            if not isinstance(accepted, (list, tuple, set, np.ndarray)):
+                accepted = [accepted]
+            expressions.append((column, 'in', 
+                                [_to_python(x) for x in accepted]))
+        
+        key_columns = list(DBDriver._key_columns.keys())
+        table = self._read(key_columns + list(feature_names), expressions)
+        table = table.sort_by([(column, 'ascending') 
+                               for column in key_columns])
+        
+        values = np.empty((table.num_rows, len(feature_names)), 
+                          dtype = np.float64)
+        for f, feature_name in enumerate(feature_names):
+            values[:, f] = table.column(feature_name).to_numpy()
+        coords = OrderedDict()
+        for column, dtype in DBDriver._key_columns.items():
+            coords[column] = table.column(column).to_numpy().astype(dtype)
+        return values, coords
+    get_feature_matrix.__doc__ = DBDriver.get_feature_matrix.__doc__
+    
+    def _unique(self, column, filters = None):
+        import pyarrow.compute as pc
+        values = pc.unique(self._read([column], filters).column(column))
+        return sorted(values.to_pylist())
+    
+    def get_patients_ids(self):
+        return self._unique('patient_id')
+    get_patients_ids.__doc__ = DBDriver.get_patients_ids.__doc__
+    
+    def get_nodule_ids_by_patient(self, patient_id):
+        return self._unique('nodule_id', [('patient_id', '=', patient_id)])
+    get_nodule_ids_by_patient.__doc__ = \
+        DBDriver.get_nodule_ids_by_patient.__doc__
+    
+    def get_annotation_ids_by_nodule(self, patient_id, nodule_id):
+        return self._unique('annotation_id', 
+                            [('patient_id', '=', patient_id), 
+                             ('nodule_id', '=', _to_python(nodule_id)),
+                             ('annotation_id', '!=', -1)])
+    get_annotation_ids_by_nodule.__doc__ = \
+        DBDriver.get_annotation_ids_by_nodule.__doc__
+    
+    def __init__(self, folder):
+        """Opens the dataset in the given folder.
+        
+        Parameters
+        ----------
+        folder : str
+            The root folder of the dataset (see DBDriver.export_parquet()).
+        """
+        import pyarrow as pa
+        import pyarrow.dataset as ds
         
-        pass
-    
\ No newline at end of file
+        if not isdir(folder):
+            raise Exception('Parquet dataset not found')
+        self._folder = folder
+        self._partitioning = ds.partitioning(
+            pa.schema([('num_levels', pa.int64()), 
+                       ('noise_scale', pa.float64())]), flavor = 'hive')
+        schema = ds.dataset(folder, format = 'parquet', 
+                            partitioning = self._partitioning).schema
+        self._feature_names = [name for name in schema.names 
+                               if name not in DBDriver._key_columns]